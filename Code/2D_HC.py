@@ -4,7 +4,8 @@
     by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
     & W.R. Young, submitted to JFM.
 
-    This is a Dedalus script for 2D no-slip horizontal convection calculations. 
+    This is a Dedalus script for 2D horizontal convection calculations
+    (no-slip by default).
     It uses a Fourier basis in the x direction with periodic boundary
     conditions and Chebyshev basis in the z direction.
 
@@ -15,6 +16,59 @@
 
     To run using 24 threads, use:
     $ mpiexec -n 24 python3 2D_HC.py
+    or, in hybrid mode, 6 ranks of 4 threads each (see threads.py):
+    $ OMP_NUM_THREADS=4 mpiexec -n 6 --map-by slot:PE=4 python3 2D_HC.py --threads 4
+
+    Ra, Pr, the boundary conditions (no-slip or no-stress), the resolution
+    and the stop time are command-line options (see options.py); e.g.
+    $ mpiexec -n 24 python3 2D_HC.py --Ra 1e8 --bc nostress
+
+    Checkpoints are written every hour of wall time and before the job's
+    wall time (--stop-wall-time, in hours) runs out; resume with
+    $ mpiexec -n 24 python3 2D_HC.py --restart checkpoints
+
+    A run can start from the state of another run interpolated onto the
+    new grid (see continuation.py):
+    $ mpiexec -n 24 python3 2D_HC.py --Ra 1e10 --init ../Ra1e9/checkpoints
+
+    Nu is monitored during the run (see nusselt.py); with --equilibrate TOL
+    the run stops once Nu is stationary to a relative error TOL.
+
+    With --rundb PATH, the time series of Nu, ke, Re and the bottom
+    buoyancy are streamed into the run database (see rundb.py).
+
+    With --dt-control predictive, dt comes from the predictive controller
+    of timestep.py, with fewer global reductions (and, with --dt-tol, a
+    temporal smoothness limit).
+
+    With --z-layer N, the z basis gets N more Chebyshev modes in a surface
+    layer of thickness ~ Ra^(-1/5) below z = Lz (see problems.z_basis):
+    $ mpiexec -n 24 python3 2D_HC.py --Ra 1e11 --resolution 4096 256 --z-layer 128
+
+    With --resolution-check, the spectral tails of b, u and w are
+    monitored and the cheapest adequate resolution is recommended; with
+    --regrid, an under-resolved run stops to continue on that grid
+    (see resolution.py).
+
+    With --averages, time means of the fields, the surface flux F(x) and
+    the lateral flux J(x) of Figure 3 are accumulated during the run and
+    written to averages.h5 (see averages.py).
+
+    With --async-output process (or thread), the output is written in the
+    background by writer processes of --io-ranks ranks (see output.py).
+
+    With --snapshot-encoding float32 or quantized (and
+    --snapshot-compression gzip), snapshots are stored in reduced
+    precision with a recorded error bound (see encoding.py).
+
+    With --snapshot-space coeff (and --coeff-fraction 0.5), snapshots are
+    stored as (truncated) spectral coefficients, to be evaluated on any
+    grid or at any points (see coefficients.py).
+
+    With --timing, each step is split into linear solves, transforms,
+    transposes, output, ... and a cpu-hour report is written (timing.py).
+
+    Campaigns of many cases are run from a manifest with sweep.py.
 
     Snapshots must be merged prior to analysis:
     $ python3 merge.py snapshots/
@@ -27,48 +81,42 @@ import numpy as np
 from mpi4py import MPI
 import time
 
-from dedalus import public as de
 from dedalus.extras import flow_tools
 
+import options
+import problems
+import checkpoint
+import continuation
+import randomfield
+import nusselt
+import diagnostics
+import timing
+import timestep
+import rundb
+import resolution
+import threads
+import output
+import averages
+
 import logging
 logger = logging.getLogger(__name__)
 
 # Parameters
-Lx, Lz = (4., 1.)
-Ra = 1.*1e9
-Pr = 1
+args = options.parse_args(dim=2)
+Lx, Lz = (problems.Lx, problems.Lz)
+Ra = args.Ra
+Pr = args.Pr
+nx, nz = args.resolution
 k = np.pi/(Lx)
+P, R = problems.diffusivities(Ra, Pr)
 
-# Create bases and domain
-x_basis = de.Fourier('x', 1024, interval=(0, Lx), dealias=3/2)
-z_basis = de.Chebyshev('z', 256, interval=(0, Lz), dealias=3/2)
-domain = de.Domain([x_basis, z_basis], grid_dtype=np.float64)
-
-# Non-dimensional 2D Boussinesq hydrodynamics
-problem = de.IVP(domain, variables=['p','b','u','w','bz','uz','wz','bx'])
-problem.meta['p','b','u','w']['z']['dirichlet'] = True
-problem.parameters['P'] = (Ra * Pr)**(-1/2)
-problem.parameters['R'] = (Ra / Pr)**(-1/2)
-problem.parameters['k'] = k
-problem.add_equation("dx(u) + wz = 0")
-problem.add_equation("dt(b) - P*(dx(dx(b)) + dz(bz))             = -(u*dx(b) + w*bz)")
-problem.add_equation("dt(u) - R*(dx(dx(u)) + dz(uz)) + dx(p)     = -(u*dx(u) + w*uz)")
-problem.add_equation("dt(w) - R*(dx(dx(w)) + dz(wz)) + dz(p) - b = -(u*dx(w) + w*wz)")
-problem.add_equation("bz - dz(b) = 0")
-problem.add_equation("bx - dx(b) = 0")
-problem.add_equation("uz - dz(u) = 0")
-problem.add_equation("wz - dz(w) = 0")
-problem.add_bc("left(bz) = 0")
-problem.add_bc("left(u) = 0")  # For free-slip, change this to left(uz) = 0.
-problem.add_bc("left(w) = 0")
-problem.add_bc("right(u) = 0") # For free-slip, change this to right(uz) = 0.
-problem.add_bc("right(b) = cos(2*k*x)")
-problem.add_bc("right(w) = 0", condition="(nx != 0)")
-problem.add_bc("right(p) = 0", condition="(nx == 0)")
-
-# Build solver
-solver = problem.build_solver(de.timesteppers.RK443)
-logger.info('Solver built')
+# Threads per rank in hybrid mode (see threads.py)
+threads.configure(args.threads, (options.comm or MPI.COMM_WORLD).rank)
+
+# Domain, non-dimensional 2D Boussinesq hydrodynamics and solver
+# (see problems.py; the solver is reused if this process just ran the same case)
+solver = problems.ivp_solver(problems.config(args, dim=2), comm=options.comm)
+domain = solver.domain
 
 # Initial conditions
 x = domain.grid(0)
@@ -76,46 +124,123 @@ z = domain.grid(1)
 b = solver.state['b']
 bz = solver.state['bz']
 
-# Random perturbations, initialized globally for same results in parallel
-gshape = domain.dist.grid_layout.global_shape(scales=1)
-slices = domain.dist.grid_layout.slices(scales=1)
-rand = np.random.RandomState(seed=42)
-noise = rand.standard_normal(gshape)[slices]
+# Random perturbations, the same for any number of ranks (each rank only
+# generates its own block, see randomfield.py)
+noise = randomfield.white(domain, seed=42)
 
 # Coldish fluid in the container
 b['g'] = -0.6
 b.differentiate('z', out=bz)
 
+# Continuation from a (coarser, lower-Ra or 2D) run
+if args.init:
+    source = continuation.initial_state(solver, args.init, index=args.init_index,
+                                        noise=args.init_noise,
+                                        noise_modes=args.init_noise_modes,
+                                        noise_slope=args.init_noise_slope)
+    if args.init_time:
+        solver.sim_time = solver.initial_sim_time = source['sim_time']
+        solver.iteration = solver.initial_iteration = source['iteration']
+
 # Integration parameters
-solver.stop_sim_time = 18000
+solver.stop_sim_time = args.stop_sim_time
 solver.stop_wall_time = np.inf
-solver.stop_iteration = np.inf
+solver.stop_iteration = args.stop_iteration
 dt = 0.125 # Initial time step
 
-# Analysis
-snapshots = solver.evaluator.add_file_handler("snapshots", sim_dt=2, max_writes=200)
-snapshots.add_task("b", name="b")
-snapshots.add_task("bz", name="bz")
-snapshots.add_task("u", name="u")
-snapshots.add_task("w", name="w")
+# Analysis (appended to on restarts)
+mode = 'append' if args.restart or args.init_time else 'overwrite'
+# (written in the background with --async-output, see output.py, and
+# snapshots in reduced precision with --snapshot-encoding, see encoding.py,
+# or as coefficients with --snapshot-space coeff, see coefficients.py)
+encoded = None
+if args.snapshot_encoding != 'float64' or args.snapshot_compression != 'none':
+    encoded = (args.snapshot_encoding, args.snapshot_tol, args.snapshot_compression)
+coeff = args.snapshot_space == 'coeff'
+truncate = args.coeff_fraction if coeff and args.coeff_fraction < 1 else None
+writes = None
+if args.async_output != 'off' or encoded or coeff:
+    writes = output.AsyncOutput(solver, args.io_ranks, int(2**20*args.output_buffer),
+                                mode=args.async_output)
+snapshots = output.file_handler(solver, writes, "snapshots", sim_dt=2, max_writes=200, mode=mode,
+                                encoded=encoded, truncate=truncate)
+layout = 'c' if coeff else 'g'
+snapshots.add_task("b", name="b", layout=layout)
+if not coeff:    # (coefficients.py differentiates the coefficients of b)
+    snapshots.add_task("bz", name="bz")
+snapshots.add_task("u", name="u", layout=layout)
+snapshots.add_task("w", name="w", layout=layout)
 #snapshots.add_system(solver.state)  # Save all fields
 
 # Diagnostics
-analysis2 = solver.evaluator.add_file_handler("diagnostics", iter=10)
-analysis2.add_task("integ(0.5 * (u*u + w*w))/4", name="ke")
-analysis2.add_task("integ( P*(bx*bx + bz*bz))/4", name="chi")
-analysis2.add_task("integ( R*(dx(u)*dx(u) + uz*uz + dx(w)*dx(w) + wz*wz) )/4", name="ep")
-analysis2.add_task("integ(w*b)/4", name="wb")
-
-# CFL
-CFL = flow_tools.CFL(solver, initial_dt=dt, cadence=10, safety=1,
-                     max_change=1.5, min_change=0.5, max_dt=0.125, threshold=0.05)
+if args.diagnostics == 'dedalus':
+    analysis2 = output.file_handler(solver, writes, "diagnostics", iter=10, mode=mode)
+    analysis2.add_task("integ(0.5 * (u*u + w*w))/4", name="ke")
+    analysis2.add_task("integ( P*(bx*bx + bz*bz))/4", name="chi")
+    analysis2.add_task("integ( R*(dx(u)*dx(u) + uz*uz + dx(w)*dx(w) + wz*wz) )/4", name="ep")
+    analysis2.add_task("integ(w*b)/4", name="wb")
+else:
+    # Same diagnostics and flow properties from shared products
+    flow = diagnostics.Diagnostics(solver, {'u': 'u', 'w': 'w', 'b': 'b', 'bx': 'bx',
+                                            'bz': 'bz', 'ux': 'dx(u)', 'uz': 'uz',
+                                            'wx': 'dx(w)', 'wz': 'wz', 'bb': 'left(b)'},
+                                   iter=10, base_path='diagnostics', mode=mode,
+                                   output=writes)
+    flow.add_average('ke', {'u*u': 0.5, 'w*w': 0.5})
+    flow.add_average('chi', {'bx*bx': P, 'bz*bz': P})
+    flow.add_average('ep', {'ux*ux': R, 'uz*uz': R, 'wx*wx': R, 'wz*wz': R})
+    flow.add_average('wb', {'w*b': 1})
+    flow.add_average('b_bottom', {'bb': 1})
+    flow.add_max('Re', {'u*u': 1, 'w*w': 1}, lambda s: np.sqrt(s)/R)
+    flow.add_average('K', {'u*u': 0.5, 'w*w': 0.5}, write=False)
+
+# CFL (or the predictive controller of timestep.py)
+if args.dt_control == 'predictive':
+    CFL = timestep.PredictiveCFL(solver, initial_dt=dt, cadence=10, safety=1,
+                                 max_change=1.5, min_change=0.5, max_dt=0.125,
+                                 threshold=0.05, tol=args.dt_tol)
+else:
+    CFL = flow_tools.CFL(solver, initial_dt=dt, cadence=10, safety=1,
+                         max_change=1.5, min_change=0.5, max_dt=0.125, threshold=0.05)
 CFL.add_velocities(('u', 'w'))
 
 # Flow properties
-flow = flow_tools.GlobalFlowProperty(solver, cadence=10)
-flow.add_property("sqrt(u*u + w*w) / R", name='Re')
-flow.add_property("(u*u + w*w)/2", name='K')
+if args.diagnostics == 'dedalus':
+    # Averages are integrals (with the Chebyshev quadrature) over the volume
+    flow = flow_tools.GlobalFlowProperty(solver, cadence=10)
+    flow.add_property("sqrt(u*u + w*w) / R", name='Re')
+    flow.add_property("(u*u + w*w)/2", name='K', precompute_integral=True)
+    flow.add_property("P*(bx*bx + bz*bz)", name='chi', precompute_integral=True)
+    flow.add_property("left(b)", name='b_bottom', precompute_integral=True)
+
+# Nusselt number and equilibration
+Nu = nusselt.NusseltMonitor(solver, flow, nusselt.chi_diffusive(P, k, Lz),
+                            window=args.equilibrate_window, tol=args.equilibrate, cadence=10)
+
+# Time averages of the mean fields and fluxes (see averages.py)
+means = averages.TimeAverages(solver, averages.tasks(2, args.averages_moments),
+                              iter=args.averages_cadence, start=args.averages_start,
+                              enabled=args.averages)
+
+# Checkpoints (with the running sums of the averages)
+checkpoints = checkpoint.Checkpoint(solver, CFL, 'checkpoints',
+                                    sim_dt=args.checkpoint_dt,
+                                    wall_dt=3600*args.checkpoint_wall_dt,
+                                    stop_wall_time=3600*args.stop_wall_time,
+                                    accumulators=[means])
+if args.restart:
+    dt = checkpoints.restore(args.restart)
+
+# Resolution adequacy (see resolution.py)
+spectra = resolution.SpectralMonitor(solver, ('b', 'u', 'w'), cadence=args.resolution_cadence,
+                                     tol=args.resolution_tol, enabled=args.resolution_check)
+
+# Run database (see rundb.py)
+record = rundb.Recorder(solver, flow, args.rundb, problems.config(args, dim=2),
+                        Nu.chi_diff, cadence=10)
+
+# Per-step timings (see timing.py)
+timers = timing.StepTimers(solver, enabled=args.timing)
 
 # Main loop
 try:
@@ -124,6 +249,14 @@ try:
     while solver.ok:
         dt = CFL.compute_dt()
         dt = solver.step(dt)
+        if Nu.process():
+            checkpoints.request_stop('Nu equilibrated')
+        if spectra.process() and args.regrid:
+            regrid = spectra.regrid('regrid.json')
+            checkpoints.request_stop('Under-resolved, regridding to %s'
+                                     %'x'.join(map(str, regrid['resolution'])))
+        record.process()
+        checkpoints.process()
         if (solver.iteration-1) % 10 == 0:
             logger.info('Iteration: %i, Time: %e, dt: %e' %(solver.iteration, solver.sim_time, dt))
 except:
@@ -135,3 +268,14 @@ finally:
     logger.info('Sim end time: %f' %solver.sim_time)
     logger.info('Run time: %.2f sec' %(end_time-start_time))
     logger.info('Run time: %f cpu-hr' %((end_time-start_time)/60/60*domain.dist.comm_cart.size))
+    Nu.write('nusselt.json')
+    record.close(Nu)
+    spectra.write('resolution.json')
+    means.write('averages.h5')
+    timers.report()
+    if args.diagnostics == 'shared':
+        flow.flush()
+    if writes:
+        writes.close()
+    if args.dt_control == 'predictive':
+        CFL.report()
@@ -4,7 +4,8 @@
     by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
     & W.R. Young, submitted to JFM.
 
-    This is a Dedalus script for 3D no-slip horizontal convection calculations.
+    This is a Dedalus script for 3D horizontal convection calculations
+    (no-slip by default).
     It uses a Fourier bases in the x and y directions with periodic boundary
     conditions and Chebyshev basis in the z direction.
 
@@ -16,6 +17,63 @@
 
     To run using 24 threads, use:
     $ mpiexec -n 24 python3 3D_HC.py
+    or, in hybrid mode, 6 ranks of 4 threads each (see threads.py):
+    $ OMP_NUM_THREADS=4 mpiexec -n 6 --map-by slot:PE=4 python3 3D_HC.py --threads 4
+
+    Ra, Pr, the boundary conditions (no-slip or no-stress), the resolution
+    and the stop time are command-line options (see options.py); e.g.
+    $ mpiexec -n 24 python3 3D_HC.py --Ra 1e8 --bc nostress
+
+    Checkpoints are written every hour of wall time and before the job's
+    wall time (--stop-wall-time, in hours) runs out; resume with
+    $ mpiexec -n 24 python3 3D_HC.py --restart checkpoints
+
+    A run can start from the state of another run interpolated onto the
+    new grid (see continuation.py):
+    $ mpiexec -n 24 python3 3D_HC.py --Ra 1e10 --init ../Ra1e9/checkpoints
+
+    Nu is monitored during the run (see nusselt.py); with --equilibrate TOL
+    the run stops once Nu is stationary to a relative error TOL.
+
+    With --rundb PATH, the time series of Nu, ke, Re and the bottom
+    buoyancy are streamed into the run database (see rundb.py).
+
+    With --dt-control predictive, dt comes from the predictive controller
+    of timestep.py, with fewer global reductions (and, with --dt-tol, a
+    temporal smoothness limit).
+
+    With --z-layer N, the z basis gets N more Chebyshev modes in a surface
+    layer of thickness ~ Ra^(-1/5) below z = Lz (see problems.z_basis):
+    $ mpiexec -n 24 python3 3D_HC.py --Ra 1e9 --resolution 512 128 64 --z-layer 128
+
+    With --resolution-check, the spectral tails of b, u, v and w are
+    monitored and the cheapest adequate resolution is recommended; with
+    --regrid, an under-resolved run stops to continue on that grid
+    (see resolution.py).
+
+    With --averages, time means of the fields, the surface flux F(x) and
+    the lateral flux J(x) of Figure 3 are accumulated during the run and
+    written to averages.h5 (see averages.py).
+
+    With --async-output process (or thread), the output is written in the
+    background by writer processes of --io-ranks ranks (see output.py).
+
+    With --snapshot-encoding float32 or quantized (and
+    --snapshot-compression gzip), snapshots are stored in reduced
+    precision with a recorded error bound (see encoding.py).
+
+    With --snapshot-space coeff (and --coeff-fraction 0.5), snapshots are
+    stored as (truncated) spectral coefficients, to be evaluated on any
+    grid or at any points (see coefficients.py).
+
+    The process mesh and FFTW planning rigor tuned for the resolution, the
+    number of ranks and the machine by autotune.py are used unless --mesh
+    (or --no-tuning) is given.
+
+    With --timing, each step is split into linear solves, transforms,
+    transposes, output, ... and a cpu-hour report is written (timing.py).
+
+    Campaigns of many cases are run from a manifest with sweep.py.
 
     Snapshots must be merged prior to analysis:
     $ python3 merge.py snapshots/
@@ -28,54 +86,44 @@ import numpy as np
 from mpi4py import MPI
 import time
 
-from dedalus import public as de
 from dedalus.extras import flow_tools
 
+import options
+import problems
+import checkpoint
+import continuation
+import nusselt
+import diagnostics
+import timing
+import timestep
+import rundb
+import resolution
+import threads
+import autotune
+import output
+import averages
+
 import logging
 logger = logging.getLogger(__name__)
 
 # Parameters
-Lx, Ly, Lz = (4., 1., 1.)
-Ra = 1.*1e7
-Pr = 1
+args = options.parse_args(dim=3)
+Lx, Ly, Lz = (problems.Lx, problems.Ly, problems.Lz)
+Ra = args.Ra
+Pr = args.Pr
+nx, ny, nz = args.resolution
 k = np.pi/(Lx)
+P, R = problems.diffusivities(Ra, Pr)
 
-# Create bases and domain
-x_basis = de.Fourier('x', 256, interval=(0, Lx), dealias=3/2)
-y_basis = de.Fourier('y', 64, interval=(0, Ly), dealias=3/2)
-z_basis = de.Chebyshev('z', 64, interval=(0, Lz), dealias=3/2)
-domain = de.Domain([x_basis, y_basis, z_basis], grid_dtype=np.float64)
-
-# Nondimensional 3D Boussinesq hydrodynamics
-problem = de.IVP(domain, variables=['p','b','u','v','w','bz','uz','wz','vz','bx','by'])
-problem.meta['p','b','u','w','v']['z']['dirichlet'] = True
-problem.parameters['P'] = (Ra * Pr)**(-1/2)
-problem.parameters['R'] = (Ra / Pr)**(-1/2)
-problem.parameters['k'] = k
-problem.add_equation("dx(u) + dy(v) + wz = 0")
-problem.add_equation("dt(b) - P*(dx(dx(b)) + dy(dy(b)) + dz(bz))             = -(u*dx(b) + v*dy(b) + w*bz)")
-problem.add_equation("dt(u) - R*(dx(dx(u)) + dy(dy(u)) + dz(uz)) + dx(p)     = -(u*dx(u) + v*dy(u) + w*uz)")
-problem.add_equation("dt(v) - R*(dx(dx(v)) + dy(dy(v)) + dz(vz)) + dy(p)     = -(u*dx(v) + v*dy(v) + w*vz)")
-problem.add_equation("dt(w) - R*(dx(dx(w)) + dy(dy(w)) + dz(wz)) + dz(p) - b = -(u*dx(w) + v*dy(w) + w*wz)")
-problem.add_equation("bx - dx(b) = 0")
-problem.add_equation("by - dy(b) = 0")
-problem.add_equation("bz - dz(b) = 0")
-problem.add_equation("uz - dz(u) = 0")
-problem.add_equation("wz - dz(w) = 0")
-problem.add_equation("vz - dz(v) = 0")
-problem.add_bc("left(bz) = 0")
-problem.add_bc("left(u) = 0")  # For free-slip, change this to left(uz)=0.
-problem.add_bc("left(v) = 0")  # For free-slip, change this to left(vz)=0.
-problem.add_bc("left(w) = 0")
-problem.add_bc("right(b) = cos(2*k*x)")
-problem.add_bc("right(u) = 0") # For free-slip, change this to right(uz)=0.
-problem.add_bc("right(v) = 0") # For free-slip, change this to right(vz)=0.
-problem.add_bc("right(w) = 0", condition="(nx !=0)")
-problem.add_bc("right(p) = 0", condition="(nx == 0)")
-
-# Build solver
-solver = problem.build_solver(de.timesteppers.RK443)
-logger.info('Solver built')
+# Domain, nondimensional 3D Boussinesq hydrodynamics and solver
+# (see problems.py; the solver is reused if this process just ran the same case)
+# (with the process mesh and FFT planning tuned by autotune.py, if cached)
+comm = options.comm or MPI.COMM_WORLD
+threads.configure(args.threads, comm.rank)
+mesh = autotune.setup(args, comm.size, comm.rank)
+solver = problems.ivp_solver(problems.config(args, dim=3), comm=options.comm,
+                             mesh=mesh)
+domain = solver.domain
 
 # Initial conditions (motionless and homogeneous with b=0)
 x = domain.grid(0)
@@ -85,50 +133,134 @@ bz = solver.state['bz']
 b['g'] = 0.
 b.differentiate('z', out=bz)
 
+# Continuation from a (coarser, lower-Ra or 2D) run
+if args.init:
+    source = continuation.initial_state(solver, args.init, index=args.init_index,
+                                        noise=args.init_noise,
+                                        noise_modes=args.init_noise_modes,
+                                        noise_slope=args.init_noise_slope)
+    if args.init_time:
+        solver.sim_time = solver.initial_sim_time = source['sim_time']
+        solver.iteration = solver.initial_iteration = source['iteration']
+
 # Initial timestep
 dt = 0.125
 
 # Integration parameters
-solver.stop_sim_time = 2500
+solver.stop_sim_time = args.stop_sim_time
 solver.stop_wall_time = np.inf
-solver.stop_iteration = np.inf
-
-# Analysis
-snapshots = solver.evaluator.add_file_handler('snapshots', sim_dt=25, max_writes=20)
-snapshots.add_task("b", name="b")
-snapshots.add_task("u", name="u")
-snapshots.add_task("v", name="v")
-snapshots.add_task("w", name="w")
+solver.stop_iteration = args.stop_iteration
+
+# Analysis (appended to on restarts)
+mode = 'append' if args.restart or args.init_time else 'overwrite'
+# (written in the background with --async-output, see output.py, and
+# snapshots in reduced precision with --snapshot-encoding, see encoding.py,
+# or as coefficients with --snapshot-space coeff, see coefficients.py)
+encoded = None
+if args.snapshot_encoding != 'float64' or args.snapshot_compression != 'none':
+    encoded = (args.snapshot_encoding, args.snapshot_tol, args.snapshot_compression)
+coeff = args.snapshot_space == 'coeff'
+truncate = args.coeff_fraction if coeff and args.coeff_fraction < 1 else None
+writes = None
+if args.async_output != 'off' or encoded or coeff:
+    writes = output.AsyncOutput(solver, args.io_ranks, int(2**20*args.output_buffer),
+                                mode=args.async_output)
+snapshots = output.file_handler(solver, writes, 'snapshots', sim_dt=25, max_writes=20, mode=mode,
+                                encoded=encoded, truncate=truncate)
+layout = 'c' if coeff else 'g'
+snapshots.add_task("b", name="b", layout=layout)
+snapshots.add_task("u", name="u", layout=layout)
+snapshots.add_task("v", name="v", layout=layout)
+snapshots.add_task("w", name="w", layout=layout)
 #snapshots.add_system(solver.state) # Save everything
 
 # y-averaged sections
-analysis1 = solver.evaluator.add_file_handler("2d_averages", sim_dt=0.25,max_writes=50)
+analysis1 = output.file_handler(solver, writes, "2d_averages", sim_dt=0.25, max_writes=50,
+                                mode=mode)
 analysis1.add_task("integ(b,'y')", name="b")
 analysis1.add_task("integ(bz,'y')", name="bz")
 analysis1.add_task("integ(u,'y')", name="u")
 analysis1.add_task("integ(w,'y')", name="w")
 
 # Diagnostics
-analysis2 = solver.evaluator.add_file_handler("diagnostics", iter=10)
-analysis2.add_task("integ(0.5 * (u*u + v*v +  w*w))/4", name="ke")
-analysis2.add_task("integ(0.5 * (u*u))/4", name="u2")
-analysis2.add_task("integ(0.5 * (v*v))/4", name="v2")
-analysis2.add_task("integ(0.5 * (w*w))/4", name="w2")
-analysis2.add_task("integ( P*(bx*bx + by*by + bz*bz))/4", name="chi")
-analysis2.add_task("integ( P*(bx*bx))/4", name="bx2")
-analysis2.add_task("integ( P*(by*by))/4", name="by2")
-analysis2.add_task("integ( P*(bz*bz))/4", name="bz2")
-analysis2.add_task("integ(w*b)/4", name="wb")
-
-# CFL
-CFL = flow_tools.CFL(solver, initial_dt=dt, cadence=4, safety=1,
-                     max_change=1.5, min_change=0.5, max_dt=0.125, threshold=0.05)
+if args.diagnostics == 'dedalus':
+    analysis2 = output.file_handler(solver, writes, "diagnostics", iter=10, mode=mode)
+    analysis2.add_task("integ(0.5 * (u*u + v*v +  w*w))/4", name="ke")
+    analysis2.add_task("integ(0.5 * (u*u))/4", name="u2")
+    analysis2.add_task("integ(0.5 * (v*v))/4", name="v2")
+    analysis2.add_task("integ(0.5 * (w*w))/4", name="w2")
+    analysis2.add_task("integ( P*(bx*bx + by*by + bz*bz))/4", name="chi")
+    analysis2.add_task("integ( P*(bx*bx))/4", name="bx2")
+    analysis2.add_task("integ( P*(by*by))/4", name="by2")
+    analysis2.add_task("integ( P*(bz*bz))/4", name="bz2")
+    analysis2.add_task("integ(w*b)/4", name="wb")
+else:
+    # Same diagnostics and flow properties from shared products
+    flow = diagnostics.Diagnostics(solver, {'u': 'u', 'v': 'v', 'w': 'w', 'b': 'b',
+                                            'bx': 'bx', 'by': 'by', 'bz': 'bz',
+                                            'bb': 'left(b)'},
+                                   iter=10, base_path='diagnostics', mode=mode,
+                                   output=writes)
+    flow.add_average('ke', {'u*u': 0.5, 'v*v': 0.5, 'w*w': 0.5})
+    flow.add_average('u2', {'u*u': 0.5})
+    flow.add_average('v2', {'v*v': 0.5})
+    flow.add_average('w2', {'w*w': 0.5})
+    flow.add_average('chi', {'bx*bx': P, 'by*by': P, 'bz*bz': P})
+    flow.add_average('bx2', {'bx*bx': P})
+    flow.add_average('by2', {'by*by': P})
+    flow.add_average('bz2', {'bz*bz': P})
+    flow.add_average('wb', {'w*b': 1})
+    flow.add_average('b_bottom', {'bb': 1})
+    flow.add_max('Re', {'u*u': 1, 'v*v': 1, 'w*w': 1}, lambda s: np.sqrt(s)/R)
+    flow.add_average('K', {'u*u': 0.5, 'v*v': 0.5, 'w*w': 0.5}, write=False)
+
+# CFL (or the predictive controller of timestep.py)
+if args.dt_control == 'predictive':
+    CFL = timestep.PredictiveCFL(solver, initial_dt=dt, cadence=4, safety=1,
+                                 max_change=1.5, min_change=0.5, max_dt=0.125,
+                                 threshold=0.05, tol=args.dt_tol)
+else:
+    CFL = flow_tools.CFL(solver, initial_dt=dt, cadence=4, safety=1,
+                         max_change=1.5, min_change=0.5, max_dt=0.125, threshold=0.05)
 CFL.add_velocities(('u', 'v', 'w'))
 
 # Flow properties
-flow = flow_tools.GlobalFlowProperty(solver, cadence=10)
-flow.add_property("sqrt(u*u + v*v + w*w) / R", name='Re')
-flow.add_property("(u*u + v*v + w*w)/2", name='K')
+if args.diagnostics == 'dedalus':
+    # Averages are integrals (with the Chebyshev quadrature) over the volume
+    flow = flow_tools.GlobalFlowProperty(solver, cadence=10)
+    flow.add_property("sqrt(u*u + v*v + w*w) / R", name='Re')
+    flow.add_property("(u*u + v*v + w*w)/2", name='K', precompute_integral=True)
+    flow.add_property("P*(bx*bx + by*by + bz*bz)", name='chi', precompute_integral=True)
+    flow.add_property("left(b)", name='b_bottom', precompute_integral=True)
+
+# Nusselt number and equilibration
+Nu = nusselt.NusseltMonitor(solver, flow, nusselt.chi_diffusive(P, k, Lz),
+                            window=args.equilibrate_window, tol=args.equilibrate, cadence=10)
+
+# Time averages of the mean fields and fluxes (see averages.py)
+means = averages.TimeAverages(solver, averages.tasks(3, args.averages_moments),
+                              iter=args.averages_cadence, start=args.averages_start,
+                              enabled=args.averages)
+
+# Checkpoints (with the running sums of the averages)
+checkpoints = checkpoint.Checkpoint(solver, CFL, 'checkpoints',
+                                    sim_dt=args.checkpoint_dt,
+                                    wall_dt=3600*args.checkpoint_wall_dt,
+                                    stop_wall_time=3600*args.stop_wall_time,
+                                    accumulators=[means])
+if args.restart:
+    dt = checkpoints.restore(args.restart)
+
+# Resolution adequacy (see resolution.py)
+spectra = resolution.SpectralMonitor(solver, ('b', 'u', 'v', 'w'), cadence=args.resolution_cadence,
+                                     tol=args.resolution_tol, enabled=args.resolution_check)
+
+# Run database (see rundb.py)
+record = rundb.Recorder(solver, flow, args.rundb, problems.config(args, dim=3),
+                        Nu.chi_diff, cadence=10)
+
+# Per-step timings (see timing.py)
+timers = timing.StepTimers(solver, enabled=args.timing)
 
 # Main loop
 try:
@@ -137,6 +269,14 @@ try:
     while solver.ok:
         dt = CFL.compute_dt()
         dt = solver.step(dt)
+        if Nu.process():
+            checkpoints.request_stop('Nu equilibrated')
+        if spectra.process() and args.regrid:
+            regrid = spectra.regrid('regrid.json')
+            checkpoints.request_stop('Under-resolved, regridding to %s'
+                                     %'x'.join(map(str, regrid['resolution'])))
+        record.process()
+        checkpoints.process()
         if (solver.iteration-1) % 10 == 0:
             logger.info('Iteration: %i, Time: %e, dt: %e' %(solver.iteration, solver.sim_time, dt))
 except:
@@ -148,3 +288,16 @@ finally:
     logger.info('Sim end time: %f' %solver.sim_time)
     logger.info('Run time: %.2f sec' %(end_time-start_time))
     logger.info('Run time: %f cpu-hr' %((end_time-start_time)/60/60*domain.dist.comm_cart.size))
+    Nu.write('nusselt.json')
+    record.close(Nu)
+    spectra.write('resolution.json')
+    means.write('averages.h5')
+    timers.report()
+    if args.fft_wisdom:
+        autotune.save_wisdom(args.fft_wisdom, comm.rank)
+    if args.diagnostics == 'shared':
+        flow.flush()
+    if writes:
+        writes.close()
+    if args.dt_control == 'predictive':
+        CFL.report()
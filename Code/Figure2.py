@@ -11,68 +11,32 @@
     
 """
 
-from dedalus import public as de
-from dedalus.extras import flow_tools
-
-import h5py
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
 
+import reader
+import streamfunction
+
 import logging
 logger = logging.getLogger(__name__)
 
 plt.rcParams['contour.negative_linestyle'] = 'solid'
 plt.close('all')
 
-# Load snapshots
-snaps2D = h5py.File("../Data/snapshot-3D-noslip-Ra3p2e11.h5")
-
-wsnap2D = snaps2D['w'][:].mean(axis=1)
-usnap2D = snaps2D['u'][:].mean(axis=1)
-b2D = snaps2D['b'][:].mean(axis=1)
-
-# Build a dedalus boundary-value problem to calculate
-# the streamfunction given the y-averaged velocity (u,w).
-
-# Bases and domain
-x_basis = de.Fourier('x', 512, interval=(0, 4), dealias=3/2)
-z_basis = de.Chebyshev('z', 128, interval=(0, 1), dealias=3/2)
-domain = de.Domain([x_basis, z_basis], grid_dtype=np.float64)
-
-# The BVP problem  
-problem = de.LBVP(domain, variables=['psi','psiz'])
-
-# Input (u,w) as parameters
-u = domain.new_field()
-uz = domain.new_field()
-wx = domain.new_field()
-u['g'] = usnap2D
-w = domain.new_field()
-w['g'] = wsnap2D
-u.differentiate(1,out=uz)
-w.differentiate(0,out=wx)
-
-problem.parameters['uz'] = uz
-problem.parameters['u'] = u
-problem.parameters['w'] = w
-problem.parameters['wx'] = wx
-
-# Elliptic equations
-problem.add_equation("dz(psiz) + dx(dx(psi))  = - uz + wx")
-problem.add_equation("psiz - dz(psi) = 0")
-problem.add_bc("right(psi) = 0")
-problem.add_bc("left(psi) = 0")
-
-# Solve the problem
-solver = problem.build_solver()
-logger.info('Solver built')
-solver.solve()
-
-# Get solutions
-psi2D = solver.state['psi']['g']
-z = snaps2D['z'][:]
-x = snaps2D['x'][:]
+# Load snapshots (y-averages streamed over blocks, see reader.py)
+snaps2D = reader.Snapshots("../Data/snapshot-3D-noslip-Ra3p2e11.h5")
+
+wsnap2D = snaps2D['w'].mean('y')
+usnap2D = snaps2D['u'].mean('y')
+b2D = snaps2D['b'].mean('y')
+
+# Grid
+z = snaps2D.grid('z')
+x = snaps2D.grid('x')
+
+# Streamfunction of the y-averaged velocity (u,w) (see streamfunction.py)
+psi2D = streamfunction.invert(usnap2D, wsnap2D, z=z)
 
 psi2D -= psi2D.mean()
 psi2D = psi2D/psi2D.max()
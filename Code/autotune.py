@@ -0,0 +1,275 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    autotune.py: process mesh and FFT planning of 3D_HC.py, tuned once
+    per resolution, rank count and machine.
+
+    Without --mesh, 3D_HC.py gets Dedalus' default decomposition, whose
+    transposes can cost 2-3x those of a good 2D mesh, and the FFTs are
+    planned from scratch at every launch. Here short fixed-iteration runs
+    (see benchmark.py) time every process mesh p1 x p2 = ranks (and the
+    default one) with each FFTW planning rigor, and the fastest is stored
+    in a cache keyed by (resolution, ranks, machine), with the FFTW wisdom
+    of a last run of the winner (one file per rank). The modes of a
+    surface layer (--z-layer N) count in nz, as they do in sweep.py:
+
+    $ python3 autotune.py --resolution 256 64 64 --ranks 16
+    $ python3 autotune.py --resolution 512 128 64 --ranks 64 --rigors measure patient
+
+    At startup, 3D_HC.py looks up its (resolution, ranks, machine) in the
+    cache and, unless --mesh or --no-tuning is given, takes the tuned mesh
+    and planning rigor and imports the wisdom, so the FFTs are planned
+    from it. The wisdom goes to the FFTW of Dedalus' transforms (resolved
+    through its FFTW extension module), and is checked to be held by its
+    planner after an import. The cache is
+    ~/.cache/horizontal-convection/autotune.json, or --tuning-cache (or
+    $HC_TUNING_CACHE).
+
+    Cesar Rocha et al.
+"""
+
+import argparse
+import ctypes
+import datetime
+import json
+import os
+import platform
+import re
+import socket
+import sys
+
+import logging
+logger = logging.getLogger(__name__)
+
+default_cache = os.environ.get('HC_TUNING_CACHE', os.path.join(
+    os.path.expanduser('~'), '.cache', 'horizontal-convection', 'autotune.json'))
+
+rigors = ['estimate', 'measure', 'patient', 'exhaustive']
+
+
+def machine():
+    """ Name of the kind of machine: host name without node numbers,
+        architecture and cores (nodes of a cluster share it). """
+    host = re.sub(r'[\d-]+$', '', socket.gethostname().split('.')[0]) or 'host'
+    return '%s-%s-%icpu' %(host, platform.machine(), os.cpu_count() or 1)
+
+
+def cache_key(resolution, ranks, host=None, layer=0):
+    """ Key of a resolution (with `layer` more z modes) and rank count. """
+    resolution = list(resolution)
+    resolution[-1] += layer or 0
+    return '%s/%i/%s' %('x'.join(map(str, resolution)), ranks, host or machine())
+
+
+def load_cache(path=None):
+    path = path or default_cache
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_cache(cache, path=None):
+    path = path or default_cache
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(cache, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def wisdom_path(key, rank, path=None):
+    directory = os.path.join(os.path.dirname(path or default_cache), 'wisdom',
+                             key.replace('/', '_'))
+    return os.path.join(directory, 'wisdom_p%i.fftw' %rank)
+
+
+def fftw_library():
+    """ The FFTW that Dedalus' transforms plan with: the handle of its FFTW
+        extension module, through which symbols resolve to the FFTW it is
+        linked against (statically or not); None without Dedalus or if the
+        extension does not export FFTW. """
+    try:
+        from dedalus.libraries.fftw import fftw_wrappers
+        library = ctypes.CDLL(fftw_wrappers.__file__)
+        library.fftw_execute
+    except (ImportError, OSError, AttributeError):
+        return None
+    return library
+
+
+def address(library, name):
+    """ Address of a symbol of a library (to tell FFTW instances apart). """
+    return ctypes.cast(getattr(library, name), ctypes.c_void_p).value
+
+
+def wisdom(library):
+    """ Wisdom held by the planner of an FFTW library. """
+    library.fftw_export_wisdom_to_string.restype = ctypes.c_void_p
+    pointer = library.fftw_export_wisdom_to_string()
+    if not pointer:
+        return ''
+    text = ctypes.string_at(pointer).decode()
+    library.fftw_free(ctypes.c_void_p(pointer))
+    return text
+
+
+def import_wisdom(path):
+    """ Import a wisdom file into Dedalus' FFTW; True if the planner then
+        holds all of its entries. """
+    library = fftw_library()
+    if not os.path.exists(path):
+        return False
+    if library is None:
+        logger.warning("Dedalus' FFTW library not found; wisdom %s not imported" %path)
+        return False
+    if not library.fftw_import_wisdom_from_filename(path.encode()):
+        logger.warning('FFTW could not import the wisdom %s' %path)
+        return False
+    with open(path) as f:
+        entries = [line.strip().rstrip(')') for line in f
+                   if line.strip().startswith('(fftw_')]
+    held = wisdom(library)
+    if not all(entry in held for entry in entries):
+        logger.warning('The wisdom %s did not reach the FFTW planner' %path)
+        return False
+    return True
+
+
+def export_wisdom(path):
+    library = fftw_library()
+    if library is None:
+        logger.warning("Dedalus' FFTW library not found; no wisdom exported")
+        return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return bool(library.fftw_export_wisdom_to_filename(path.encode()))
+
+
+def save_wisdom(directory, rank=0):
+    """ Export the wisdom of the plans of this rank to directory. """
+    if export_wisdom(os.path.join(directory, 'wisdom_p%i.fftw' %rank)) and rank == 0:
+        logger.info('FFTW wisdom written to %s' %directory)
+
+
+def set_planning_rigor(rigor):
+    """ FFTW planning rigor of the transforms planned from now on. """
+    from dedalus.tools.config import config
+    flag = 'FFTW_' + rigor.upper()
+    config['transforms-fftw']['PLANNING_RIGOR'] = flag
+    # Modules that read the setting at import time
+    for name, module in list(sys.modules.items()):
+        if name.startswith('dedalus.') and hasattr(module, 'FFTW_RIGOR'):
+            setattr(module, 'FFTW_RIGOR', flag)
+
+
+def setup(args, ranks, rank=0):
+    """ Process mesh of 3D_HC.py: --mesh, or the tuned one of the cache
+        (whose planning rigor and wisdom are then used as well). """
+    rigor = args.fft_rigor
+    mesh = args.mesh
+    key = cache_key(args.resolution, ranks, layer=args.z_layer)
+    entry = None if args.no_tuning else load_cache(args.tuning_cache).get(key)
+    if entry and mesh is None:
+        mesh = entry['mesh']
+        rigor = rigor or entry.get('fft_rigor')
+        if import_wisdom(wisdom_path(key, rank, args.tuning_cache)) and rank == 0:
+            logger.info('Imported the FFTW wisdom of %s' %key)
+        if rank == 0:
+            logger.info('Tuned for %s: mesh %s, FFTW %s (%.3g sec/step)'
+                        %(key, mesh, rigor, entry['time_per_step']))
+    if rigor:
+        set_planning_rigor(rigor)
+    return mesh
+
+
+def candidates(resolution, ranks, layer=0):
+    """ Process meshes of `ranks` ranks worth timing (None is the default
+        decomposition). """
+    nx, ny, nz = resolution
+    nz += layer
+    meshes = [None]
+    for p1 in range(1, ranks + 1):
+        if ranks % p1 == 0:
+            p2 = ranks // p1
+            if p1 <= ny and p2 <= nz and p1 > 1 and p2 > 1:
+                meshes.append([p1, p2])
+    return meshes
+
+
+def tune(resolution, ranks, rigors=('estimate', 'measure'), iterations=50,
+         mpiexec='mpiexec -n {ranks}', cache=None, layer=0):
+    """ Time the candidate meshes and planning rigors and cache the
+        fastest; returns its cache entry. """
+    import benchmark
+    cache = os.path.abspath(cache) if cache else None    # the runs are in scratch directories
+    key = cache_key(resolution, ranks, layer=layer)
+    base = ['--resolution'] + list(map(str, resolution)) + ['--no-tuning']
+    if layer:
+        base += ['--z-layer', str(layer)]
+    results = []
+    for mesh in candidates(resolution, ranks, layer):
+        for rigor in rigors:
+            argv = base + ['--fft-rigor', rigor]
+            if mesh:
+                argv += ['--mesh'] + list(map(str, mesh))
+            try:
+                r = benchmark.time_run(3, argv, ranks, iterations, mpiexec)
+            except RuntimeError as error:
+                logger.warning('Mesh %s, FFTW %s failed: %s' %(mesh, rigor, str(error)[-300:]))
+                continue
+            results.append(dict(mesh=mesh, fft_rigor=rigor,
+                                time_per_step=r['time_per_step']))
+            logger.info('Mesh %s, FFTW %s: %.4g sec/step' %(mesh, rigor, r['time_per_step']))
+    if not results:
+        raise RuntimeError("No candidate of %s ran" %key)
+    best = min(results, key=lambda r: r['time_per_step'])
+    entry = dict(best, candidates=results, iterations=iterations,
+                 date=datetime.datetime.now().isoformat(timespec='seconds'))
+
+    # A last short run of the winner stores the wisdom of its plans
+    argv = base + ['--fft-rigor', best['fft_rigor'],
+                   '--fft-wisdom', os.path.dirname(wisdom_path(key, 0, cache))]
+    if best['mesh']:
+        argv += ['--mesh'] + list(map(str, best['mesh']))
+    try:
+        benchmark.time_run(3, argv, ranks, 2, mpiexec)
+    except RuntimeError as error:
+        logger.warning('No FFTW wisdom stored: %s' %str(error)[-300:])
+
+    entries = load_cache(cache)
+    entries[key] = entry
+    save_cache(entries, cache)
+    default = [r for r in results if r['mesh'] is None]
+    logger.info('%s: mesh %s with FFTW %s, %.4g sec/step%s'
+                %(key, best['mesh'], best['fft_rigor'], best['time_per_step'],
+                  ' (default mesh: %.4g)' %min(r['time_per_step'] for r in default)
+                  if default else ''))
+    return entry
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s :: %(message)s')
+    parser = argparse.ArgumentParser(description="Tune the process mesh and FFT planning"
+                                                 " of 3D_HC.py.")
+    parser.add_argument('--resolution', type=int, nargs=3, default=[256, 64, 64],
+                        metavar=('nx', 'ny', 'nz'))
+    parser.add_argument('--z-layer', type=int, default=0, metavar='N',
+                        help="modes of the surface layer (see problems.z_basis)")
+    parser.add_argument('--ranks', type=int, nargs='+', default=[os.cpu_count()],
+                        help="rank counts to tune for")
+    parser.add_argument('--rigors', nargs='+', choices=rigors, default=['estimate', 'measure'],
+                        help="FFTW planning rigors to try (default estimate measure)")
+    parser.add_argument('--iterations', type=int, default=50,
+                        help="iterations of each timed run (default %(default)i)")
+    parser.add_argument('--mpiexec', default='mpiexec -n {ranks}',
+                        help="launcher command (default '%(default)s')")
+    parser.add_argument('--cache', default=None,
+                        help="tuning cache (default %s)" %default_cache)
+    args = parser.parse_args()
+
+    for ranks in args.ranks:
+        tune(args.resolution, ranks, args.rigors, args.iterations, args.mpiexec, args.cache,
+             args.z_layer)
@@ -0,0 +1,176 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    averages.py: time averages accumulated during a run.
+
+    Figure 3 (the surface flux F(x), the lateral flux J(x) and the surface
+    buoyancy) and the mean fields are time averages, which otherwise have
+    to be rebuilt from many stored snapshots. With --averages, TimeAverages
+    accumulates them during the run: every --averages-cadence iterations
+    after --averages-start, the coefficients of each quantity are added to
+    a running sum with the simulation time elapsed since the previous
+    sample as weight (averages are linear, so they are accumulated in
+    coefficient space and transformed to the grid only when written).
+    The quantities (y-means in 3D) are
+
+        b, u, w, bz     mean fields, functions of (x, z)
+        bs              surface buoyancy b(x, Lz)
+        F               surface flux F/kappa = bz(x, Lz)
+        J               lateral flux J/kappa = int (u b / kappa - bx) dz
+
+    in the units of Figure 3 (kappa = P), and with --averages-moments the
+    means of b*b, u*u, w*w, u*b and w*b, for variances and eddy fluxes.
+
+    The sums are part of the checkpoints (see checkpoint.py), so restarted
+    runs carry on averaging; averages.h5 (the means on the grid, x and z,
+    and the averaging interval) is written at the end of a run:
+
+    $ mpiexec -n 24 python3 2D_HC.py --Ra 6.4e10 --averages --averages-start 5000
+
+    Cesar Rocha et al.
+"""
+
+import h5py
+import numpy as np
+
+from dedalus.core.evaluator import DictionaryHandler
+
+import problems
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def tasks(dim, moments=False):
+    """ Expressions of the averaged quantities of the dim-dimensional
+        problem (y-means in 3D). """
+    if dim == 3:
+        mean = lambda e: "integ(%s, 'y')/%r" %(e, problems.Ly)
+    else:
+        mean = lambda e: e
+    exprs = {name: mean(name) for name in ('b', 'u', 'w', 'bz')}
+    exprs['bs'] = mean('right(b)')
+    exprs['F'] = mean('right(bz)')
+    exprs['J'] = mean("integ(u*b/P - bx, 'z')")
+    if moments:
+        for a, b in [('b', 'b'), ('u', 'u'), ('w', 'w'), ('u', 'b'), ('w', 'b')]:
+            exprs[a + b] = mean('%s*%s' %(a, b))
+    return exprs
+
+
+class TimeAverages(DictionaryHandler):
+    """ Running time averages of tasks {name: expression}, sampled every
+        `iter` iterations once sim_time >= start. """
+
+    name = 'averages'
+
+    def __init__(self, solver, tasks, iter=10, start=0., enabled=True):
+        domain = solver.domain
+        DictionaryHandler.__init__(self, domain, solver.evaluator.vars, iter=iter)
+        self.solver = solver
+        self.start = start
+        self.enabled = enabled
+        self.comm = domain.dist.comm_cart
+        for name, expression in tasks.items():
+            self.add_task(expression, layout='c', name=name)
+        self.sums = {}
+        self.constant = {}
+        self.time = 0.          # total weight (averaging time)
+        self.samples = 0
+        self.first = None       # sim_time of the first sample
+        self.last = None        # sim_time of the last sample
+        if enabled:
+            solver.evaluator.add_handler(self)
+
+    def process(self, **kw):
+        DictionaryHandler.process(self, **kw)
+        t = kw.get('sim_time', self.solver.sim_time)
+        if t < self.start:
+            return
+        if self.last is None:
+            # The first sample only starts the interval
+            self.first = self.last = t
+            for name, field in self.fields.items():
+                self.sums[name] = np.zeros_like(field['c'])
+                self.constant[name] = [bool(field.meta[axis]['constant'])
+                                       for axis in range(self.domain.dim)]
+            return
+        weight = t - self.last
+        for name, field in self.fields.items():
+            self.sums[name] += weight * field['c']
+        self.time += weight
+        self.samples += 1
+        self.last = t
+
+    def arrays(self):
+        """ Local sums, for checkpoints. """
+        return self.sums
+
+    def get_state(self):
+        return dict(time=self.time, samples=self.samples, first=self.first,
+                    last=self.last, constant=self.constant)
+
+    def set_state(self, state, arrays):
+        self.time = state['time']
+        self.samples = state['samples']
+        self.first = state['first']
+        self.last = state['last']
+        self.constant = state['constant']
+        self.sums = {name: np.array(arrays[name]) for name in self.constant}
+
+    def means(self):
+        """ Local grid data of the time means (scales 1) as
+            {name: (slices, data)}; constant axes are reduced to size 1
+            and held by the ranks at their start only. """
+        domain = self.domain
+        layout = domain.dist.grid_layout
+        slices = layout.slices(scales=1)
+        work = domain.new_field()
+        means = {}
+        for name, total in self.sums.items():
+            work['c'] = total / self.time
+            work.set_scales(1)
+            data = work['g']
+            local = list(slices)
+            for axis, constant in enumerate(self.constant[name]):
+                if constant:
+                    if slices[axis].start != 0:
+                        data = None
+                        break
+                    data = data.take([0], axis=axis)
+                    local[axis] = slice(0, 1)
+            means[name] = (tuple(local), None if data is None else np.copy(data))
+        return means
+
+    def write(self, path='averages.h5'):
+        """ Gather the time means to rank 0 and write them. """
+        if not self.enabled:
+            return
+        if not self.time:
+            if self.comm.rank == 0:
+                logger.info('No time averages (t < %g or fewer than two samples)' %self.start)
+            return
+        gathered = self.comm.gather(self.means(), root=0)
+        if self.comm.rank != 0:
+            return
+        gshape = self.domain.dist.grid_layout.global_shape(scales=1)
+        with h5py.File(path, 'w') as file:
+            for key, value in dict(time=self.time, samples=self.samples, start=self.first,
+                                   end=self.last, cadence=self.iter).items():
+                file.attrs[key] = value
+            for axis, basis in enumerate(self.domain.bases):
+                file.create_dataset(basis.name, data=basis.grid(1.))
+            for name, constant in self.constant.items():
+                shape = [1 if c else n for c, n in zip(constant, gshape)]
+                data = np.zeros(shape)
+                for means in gathered:
+                    local, block = means[name]
+                    if block is not None:
+                        data[local] = block.real
+                file.create_dataset(name, data=np.squeeze(
+                    data, axis=tuple(i for i, c in enumerate(constant) if c)))
+        logger.info('Time averages over t = %g to %g (%i samples) written to %s'
+                    %(self.first, self.last, self.samples, path))
@@ -0,0 +1,298 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    benchmark.py: fixed-iteration benchmarks of 2D_HC.py and 3D_HC.py.
+
+    Each benchmark runs the solver scripts under mpiexec for a fixed
+    number of iterations, in a scratch directory, and reads the loop time
+    from their log.
+
+    Time per step with the shared diagnostics engine (diagnostics.py) and
+    with the original Dedalus diagnostics tasks, at the resolutions of the
+    scripts (1024x256 and 256x64x64):
+    $ python3 benchmark.py diagnostics --ranks 8 --iterations 200
+
+    Strong and weak scaling over rank counts, resolutions and (3D) process
+    meshes, with iterations per second, cpu-hours per simulation time unit
+    and parallel efficiency (bench_scaling.json and bench_scaling.png):
+    $ python3 benchmark.py scaling --dims 2 --ranks 1 2 4 8 --resolutions 512x128 1024x256
+    $ python3 benchmark.py scaling --dims 3 --ranks 4 8 16 --meshes auto 2x2 2x4 4x4
+    $ python3 benchmark.py scaling --mode weak --dims 2 --ranks 1 2 4 8 --resolutions 256x256
+
+    Pure MPI vs. hybrid MPI + threads (see threads.py) on the cores of one
+    node, with the share of the step spent in transposes:
+    $ python3 benchmark.py hybrid --cores 24 --threads 1 2 4 6 --dims 2
+
+    Cesar Rocha et al.
+"""
+
+import argparse
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+import options
+import threads
+
+import logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(name)s %(levelname)s :: %(message)s')
+logger = logging.getLogger('benchmark')
+
+here = os.path.dirname(os.path.abspath(__file__))
+scripts = {2: os.path.join(here, '2D_HC.py'), 3: os.path.join(here, '3D_HC.py')}
+
+
+def time_run(dim, argv, ranks, iterations, mpiexec='mpiexec -n {ranks}', env=None):
+    """ Run the dim-dimensional solver for `iterations` iterations on
+        `ranks` ranks and return its timings (and the per-category
+        breakdown of timing.py if argv contains --timing). """
+    command = (shlex.split(mpiexec.format(ranks=ranks)) +
+               [sys.executable, scripts[dim], '--stop-iteration', str(iterations),
+                '--checkpoint-wall-dt', 'inf'] + list(argv))
+    with tempfile.TemporaryDirectory() as scratch:
+        result = subprocess.run(command, cwd=scratch, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, universal_newlines=True,
+                                env=dict(os.environ, **(env or {})))
+        breakdown = None
+        if os.path.exists(os.path.join(scratch, 'timing.json')):
+            with open(os.path.join(scratch, 'timing.json')) as f:
+                t = json.load(f)
+            breakdown = {c: float(np.mean(v))/max(t['steps'], 1)
+                         for c, v in zip(t['categories'], np.transpose(t['totals']))}
+    log = result.stdout
+    if result.returncode != 0:
+        raise RuntimeError("%s failed:\n%s" %(' '.join(command), log[-2000:]))
+    run_time = float(re.findall(r'Run time: ([\d.]+) sec', log)[-1])
+    steps = int(re.findall(r'Iterations: (\d+)', log)[-1])
+    sim_time = float(re.findall(r'Sim end time: ([-+\d.e]+)', log)[-1])
+    return dict(dim=dim, ranks=ranks, argv=list(argv), iterations=steps,
+                run_time=run_time, time_per_step=run_time/max(steps, 1),
+                sim_time=sim_time, cpu_hours=run_time*ranks/3600,
+                step_breakdown=breakdown, log=log)
+
+
+def diagnostics(args):
+    """ Shared diagnostics engine vs. one Dedalus task per diagnostic. """
+    results = []
+    for dim in (2, 3):
+        times = {}
+        for engine in ('dedalus', 'shared'):
+            r = time_run(dim, ['--diagnostics', engine], args.ranks[-1], args.iterations,
+                         args.mpiexec)
+            r.pop('log')
+            r['diagnostics'] = engine
+            results.append(r)
+            times[engine] = r['time_per_step']
+            logger.info('%iD, %s diagnostics: %.2f ms per step'
+                        %(dim, engine, 1e3*r['time_per_step']))
+        logger.info('%iD speedup: %.3f' %(dim, times['dedalus']/times['shared']))
+    return results
+
+
+def meshes(ranks, requested):
+    """ Process meshes of `ranks` ranks among the requested ones ('auto'
+        is Dedalus' default, 'AxB' a 2D mesh). """
+    found = []
+    for mesh in requested:
+        if mesh == 'auto':
+            found.append(None)
+            continue
+        p1, p2 = map(int, mesh.lower().split('x'))
+        if p1*p2 == ranks:
+            found.append([p1, p2])
+    return found
+
+
+def weak_resolution(resolution, factor):
+    """ Resolution with `factor` times as many points, refining the
+        horizontal axes in turn. """
+    resolution = list(resolution)
+    axis = 0
+    while factor > 1:
+        resolution[axis] *= 2
+        factor //= 2
+        axis = (axis + 1) % (len(resolution) - 1)
+    return resolution
+
+
+def efficiency(results, mode):
+    """ Parallel efficiency relative to the smallest rank count of each
+        series (same dim, base resolution and mesh kind). """
+    series = {}
+    for r in results:
+        key = (r['dim'], tuple(r['base_resolution']), r['mesh'] is None)
+        series.setdefault(key, []).append(r)
+    for rs in series.values():
+        base = min(rs, key=lambda r: r['ranks'])
+        for r in rs:
+            if mode == 'strong':
+                r['efficiency'] = (base['time_per_step']*base['ranks'] /
+                                   (r['time_per_step']*r['ranks']))
+            else:
+                r['efficiency'] = base['time_per_step']/r['time_per_step']
+    return results
+
+
+def plot_scaling(results, mode, path):
+    """ Iterations per second and parallel efficiency vs. ranks. """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(9, 3.5))
+    series = {}
+    for r in results:
+        label = '%iD %s' %(r['dim'], 'x'.join(map(str, r['base_resolution'])))
+        if r['mesh']:
+            label += ' (2D mesh)'
+        series.setdefault(label, []).append(r)
+    for label, rs in sorted(series.items()):
+        rs = sorted(rs, key=lambda r: r['ranks'])
+        ranks = [r['ranks'] for r in rs]
+        ax1.loglog(ranks, [r['iterations_per_sec'] for r in rs], 'o-', label=label)
+        ax2.semilogx(ranks, [r['efficiency'] for r in rs], 'o-', label=label)
+        if mode == 'strong':
+            ax1.loglog(ranks, rs[0]['iterations_per_sec']*np.array(ranks)/ranks[0],
+                       'k:', linewidth=0.8)
+    ax1.set_xlabel('ranks')
+    ax1.set_ylabel('iterations per second')
+    ax2.set_xlabel('ranks')
+    ax2.set_ylabel('%s scaling efficiency' %mode)
+    ax2.set_ylim(0, 1.1)
+    ax2.axhline(1, color='k', linestyle=':', linewidth=0.8)
+    ax1.legend(fontsize=7)
+    plt.tight_layout()
+    plt.savefig(path, bbox_inches='tight', dpi=150)
+    plt.close(fig)
+
+
+def scaling(args):
+    """ Strong or weak scaling over ranks, resolutions and meshes. """
+    results = []
+    for dim in args.dims:
+        resolutions = ([list(map(int, r.lower().split('x'))) for r in args.resolutions
+                        if len(r.split('x')) == dim]
+                       or [options.defaults[dim]['resolution']])
+        for base_resolution in resolutions:
+            for ranks in sorted(args.ranks):
+                resolution = base_resolution
+                if args.mode == 'weak':
+                    resolution = weak_resolution(base_resolution, ranks//min(args.ranks))
+                for mesh in (meshes(ranks, args.meshes) if dim == 3 else [None]):
+                    argv = ['--resolution'] + list(map(str, resolution)) + ['--timing']
+                    if mesh:
+                        argv += ['--mesh'] + list(map(str, mesh))
+                    try:
+                        r = time_run(dim, argv, ranks, args.iterations, args.mpiexec)
+                    except RuntimeError as error:
+                        logger.warning('%s' %error)
+                        continue
+                    r.pop('log')
+                    r.update(base_resolution=base_resolution, resolution=resolution,
+                             mesh=mesh, iterations_per_sec=r['iterations']/r['run_time'],
+                             cpu_hours_per_time_unit=(r['cpu_hours']/r['sim_time']
+                                                      if r['sim_time'] > 0 else None))
+                    results.append(r)
+                    logger.info('%iD %s on %i ranks (mesh %s): %.2f iterations/sec'
+                                %(dim, 'x'.join(map(str, resolution)), ranks, mesh,
+                                  r['iterations_per_sec']))
+    efficiency(results, args.mode)
+    if results and args.plot:
+        plot_scaling(results, args.mode, os.path.splitext(
+            args.output or 'bench_scaling.json')[0] + '.png')
+    return results
+
+
+def hybrid(args):
+    """ Pure MPI vs. hybrid ranks x threads layouts of the cores of a node. """
+    cores = args.cores or os.cpu_count()
+    results = []
+    for dim in args.dims:
+        resolution = ([list(map(int, r.lower().split('x'))) for r in args.resolutions
+                       if len(r.split('x')) == dim]
+                      or [options.defaults[dim]['resolution']])[0]
+        for n in sorted(args.threads):
+            if cores % n:
+                continue
+            ranks = cores // n
+            argv = ['--resolution'] + list(map(str, resolution)) + ['--timing',
+                                                                   '--threads', str(n)]
+            launcher = (args.hybrid_mpiexec if n > 1 else args.mpiexec).format(
+                ranks='{ranks}', threads=n)
+            try:
+                r = time_run(dim, argv, ranks, args.iterations, launcher,
+                             env=threads.environment(n))
+            except RuntimeError as error:
+                logger.warning('%s' %error)
+                continue
+            r.pop('log')
+            breakdown = r['step_breakdown'] or {}
+            r.update(resolution=resolution, threads=n, cores=cores,
+                     cpu_hours=r['run_time']*cores/3600,
+                     iterations_per_sec=r['iterations']/r['run_time'],
+                     transpose_fraction=(breakdown.get('transpose', 0.)/r['time_per_step']
+                                         if breakdown else None))
+            results.append(r)
+        base = [r for r in results if r['dim'] == dim and r['threads'] == 1]
+        for r in results:
+            if r['dim'] != dim:
+                continue
+            r['speedup'] = base[0]['time_per_step']/r['time_per_step'] if base else None
+            logger.info('%iD %s, %i ranks x %i threads: %.2f iterations/sec%s%s'
+                        %(dim, 'x'.join(map(str, resolution)), r['ranks'], r['threads'],
+                          r['iterations_per_sec'],
+                          ', %.2fx pure MPI' %r['speedup'] if r['speedup'] else '',
+                          ', %.0f%% in transposes' %(100*r['transpose_fraction'])
+                          if r['transpose_fraction'] is not None else ''))
+    return results
+
+
+benchmarks = {'diagnostics': diagnostics, 'scaling': scaling, 'hybrid': hybrid}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of the solvers.")
+    parser.add_argument('benchmark', choices=sorted(benchmarks))
+    parser.add_argument('--ranks', type=int, nargs='+', default=[os.cpu_count()],
+                        help="rank counts (diagnostics uses the last one)")
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--mpiexec', default='mpiexec -n {ranks}',
+                        help="launcher command (default '%(default)s')")
+    parser.add_argument('--dims', type=int, nargs='+', choices=[2, 3], default=[2, 3],
+                        help="scaling: solvers to run (default 2 3)")
+    parser.add_argument('--mode', choices=['strong', 'weak'], default='strong',
+                        help="scaling: fixed resolution (strong) or fixed points per"
+                             " rank, refining x (and y) with the ranks (weak)")
+    parser.add_argument('--resolutions', nargs='+', default=[],
+                        help="scaling: resolutions such as 512x128 or 128x32x32"
+                             " (default: those of the scripts)")
+    parser.add_argument('--meshes', nargs='+', default=['auto'],
+                        help="scaling: 3D process meshes such as 2x4; 'auto' is the"
+                             " default decomposition (default auto)")
+    parser.add_argument('--cores', type=int, default=None,
+                        help="hybrid: cores of the node (default: all)")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help="hybrid: threads per rank (1 is pure MPI; default 1 2 4 8)")
+    parser.add_argument('--hybrid-mpiexec',
+                        default='mpiexec -n {ranks} --map-by slot:PE={threads} --bind-to core',
+                        help="hybrid: launcher binding each rank to {threads} cores"
+                             " (default '%(default)s')")
+    parser.add_argument('--no-plot', dest='plot', action='store_false',
+                        help="scaling: do not plot the results")
+    parser.add_argument('--output', default=None,
+                        help="JSON file for the results (default bench_<benchmark>.json)")
+    args = parser.parse_args()
+
+    results = benchmarks[args.benchmark](args)
+    with open(args.output or 'bench_%s.json' %args.benchmark, 'w') as f:
+        json.dump(results, f, indent=1)
@@ -0,0 +1,307 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    checkpoint.py: full-state checkpoints and restarts for 2D_HC.py and
+    3D_HC.py.
+
+    Checkpoints hold the spectral coefficients of every state variable
+    (p, b, u, w, bz, ...), the iteration, the simulation time, the time
+    step and state of the CFL controller, the schedule of the file
+    handlers and the running sums of accumulators such as
+    averages.TimeAverages. Each rank writes its own block to
+
+        checkpoints/checkpoints_s<n>/checkpoints_s<n>_p<rank>.h5
+
+    and rank 0 adds checkpoints_s<n>/info.json once every rank is done, so
+    incomplete sets (e.g. a job killed while writing) are never used.
+    A run restarted on the same number of ranks continues bit-for-bit;
+    restarts on a different number of ranks reassemble the blocks.
+
+    $ mpiexec -n 24 python3 2D_HC.py --stop-wall-time 10
+    $ mpiexec -n 24 python3 2D_HC.py --restart checkpoints
+
+    Cesar Rocha et al.
+"""
+
+import glob
+import json
+import os
+import shutil
+import signal
+import time
+
+import h5py
+import numpy as np
+from mpi4py import MPI
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Wall-clock reference for --stop-wall-time: the job starts roughly when
+# the solver scripts import this module.
+process_start = time.time()
+
+
+class Checkpoint:
+    """ Periodic checkpoints and wall-time aware stopping.
+
+        Call process() after every solver step. Checkpoints are written
+        every sim_dt simulation time units and/or every wall_dt seconds;
+        when the elapsed wall time comes within `margin` seconds of
+        stop_wall_time, or the job receives SIGTERM/SIGUSR1 from the
+        scheduler, a final checkpoint is written and the solver stops.
+        Other monitors stop the run the same way with request_stop().
+
+        The CFL controller updates dt on iterations with
+        (iteration-1) % cadence == 0, using velocities from the previous
+        iteration. Those velocities are not part of the state, so writes
+        are deferred to the next iteration where dt is not recomputed;
+        this is what makes restarts bit-for-bit.
+
+        Accumulators (with a name, arrays() of local coefficient-layout
+        arrays, get_state() and set_state(state, arrays)) are saved and
+        restored with the state. """
+
+    def __init__(self, solver, cfl, base_path='checkpoints', sim_dt=None,
+                 wall_dt=None, stop_wall_time=np.inf, margin=300., keep=2,
+                 check_cadence=10, accumulators=()):
+        self.solver = solver
+        self.cfl = cfl
+        self.base_path = base_path
+        self.sim_dt = sim_dt
+        self.wall_dt = wall_dt
+        self.stop_wall_time = stop_wall_time
+        self.margin = margin
+        self.keep = keep
+        self.check_cadence = check_cadence
+        self.comm = solver.domain.dist.comm_cart
+        self.layout = solver.domain.dist.coeff_layout
+        self.cadence = getattr(cfl, 'cadence', 1)
+        self.accumulators = [a for a in accumulators if getattr(a, 'enabled', True)]
+        self.last_sim_div = solver.sim_time // sim_dt if sim_dt else None
+        self.last_wall = time.time()
+        self.write_time = 0.
+        self.pending = False
+        self.stopping = False
+        self.signaled = False
+        for sig in (signal.SIGTERM, signal.SIGUSR1):
+            signal.signal(sig, self._signal)
+
+    def _signal(self, signum, frame):
+        logger.warning('Received signal %i, checkpointing and stopping' %signum)
+        self.signaled = True
+
+    def cfl_update(self):
+        """ True if the CFL recomputes dt at the current iteration from the
+            velocities of the previous one (never for controllers that
+            evaluate them on demand, see timestep.py). """
+        if hasattr(self.cfl, 'get_state'):
+            return False
+        return (self.solver.iteration-1) % self.cadence == 0
+
+    def admissible(self):
+        """ True if a checkpoint can be written now (with cadence=1 the CFL
+            recomputes dt at every iteration, so any iteration will do). """
+        return self.cadence == 1 or not self.cfl_update()
+
+    def request_stop(self, reason):
+        """ Checkpoint and stop at the next possible iteration. Must be
+            called on every rank. """
+        if not self.stopping:
+            logger.info('%s, checkpointing and stopping' %reason)
+        self.stopping = True
+
+    def process(self):
+        """ Schedule checkpoints and stops; call after each step. """
+        solver = self.solver
+        if self.sim_dt:
+            sim_div = solver.sim_time // self.sim_dt
+            if sim_div > self.last_sim_div:
+                self.last_sim_div = sim_div
+                self.pending = True
+        if solver.iteration % self.check_cadence == 0:
+            # Collective, so that every rank agrees on when to stop
+            now = time.time()
+            flags = np.array([self.signaled, now - process_start + self.margin +
+                              self.write_time > self.stop_wall_time,
+                              bool(self.wall_dt) and now - self.last_wall > self.wall_dt],
+                             dtype=int)
+            self.comm.Allreduce(flags.copy(), flags, op=MPI.MAX)
+            if flags[0] or flags[1]:
+                self.stopping = True
+            if flags[2]:
+                self.pending = True
+        if (self.pending or self.stopping) and self.admissible():
+            self.write()
+            if self.stopping:
+                logger.info('Stopping at iteration %i' %solver.iteration)
+                solver.stop_iteration = solver.iteration
+
+    def write(self):
+        """ Write a checkpoint of the current state. """
+        solver = self.solver
+        comm = self.comm
+        start = time.time()
+        set_num = None
+        if comm.rank == 0:
+            set_num = (latest_set_number(self.base_path) or 0) + 1
+        set_num = comm.bcast(set_num, root=0)
+        name = '%s_s%i' %(os.path.basename(os.path.normpath(self.base_path)), set_num)
+        path = os.path.join(self.base_path, name)
+        if comm.rank == 0:
+            os.makedirs(path, exist_ok=True)
+        comm.Barrier()
+        slices = self.layout.slices(scales=1)
+        with h5py.File(os.path.join(path, '%s_p%i.h5' %(name, comm.rank)), 'w') as file:
+            file.attrs['start'] = [s.start for s in slices]
+            file.attrs['global_shape'] = self.layout.global_shape(scales=1)
+            for field in solver.state.fields:
+                file.create_dataset(field.name, data=field['c'])
+            for accumulator in self.accumulators:
+                group = file.create_group(accumulator.name)
+                for key, data in accumulator.arrays().items():
+                    group.create_dataset(key, data=data)
+            if hasattr(self.cfl, 'arrays'):
+                group = file.create_group('cfl')
+                for key, data in self.cfl.arrays().items():
+                    group.create_dataset(key, data=data)
+        comm.Barrier()
+        if comm.rank == 0:
+            info = dict(iteration=int(solver.iteration),
+                        sim_time=float(solver.sim_time),
+                        dt=float(self.cfl.stored_dt),
+                        nprocs=int(comm.size),
+                        resolution=[int(basis.base_grid_size)
+                                    for basis in solver.domain.bases],
+                        z_bases=[[int(sub.base_grid_size)] + list(map(float, sub.interval))
+                                 for sub in getattr(solver.domain.bases[-1], 'subbases',
+                                                    [solver.domain.bases[-1]])],
+                        handlers=[[h.last_sim_div, h.last_iter_div]
+                                  for h in solver.evaluator.handlers])
+            if hasattr(self.cfl, 'get_state'):
+                info['cfl'] = self.cfl.get_state()
+            if self.accumulators:
+                info['accumulators'] = {a.name: a.get_state() for a in self.accumulators}
+            with open(os.path.join(path, 'info.json'), 'w') as f:
+                json.dump(info, f, indent=1, default=float)
+            for old in complete_sets(self.base_path)[:-self.keep]:
+                shutil.rmtree(old)
+        self.pending = False
+        self.last_wall = time.time()
+        self.write_time = self.last_wall - start
+        logger.info('Checkpoint %s written at iteration %i, t = %f (%.1f sec)'
+                    %(name, solver.iteration, solver.sim_time, self.write_time))
+
+    def restore(self, path):
+        """ Restore the solver from a checkpoint set, or from the latest
+            complete set in a checkpoint directory. Call after every file
+            handler has been added. Returns the time step. """
+        solver = self.solver
+        sets = complete_sets(path)
+        if sets:
+            path = sets[-1]
+        with open(os.path.join(path, 'info.json')) as f:
+            info = json.load(f)
+        logger.info('Restarting from %s at iteration %i, t = %f'
+                    %(path, info['iteration'], info['sim_time']))
+
+        slices = self.layout.slices(scales=1)
+        name = os.path.basename(os.path.normpath(path))
+        files = [os.path.join(path, '%s_p%i.h5' %(name, p))
+                 for p in range(info['nprocs'])]
+        own = files[self.comm.rank] if self.comm.rank < len(files) else None
+        for field in solver.state.fields:
+            field['c'] = read_block(files, field.name, slices, first=own)
+        for accumulator in self.accumulators:
+            state = info.get('accumulators', {}).get(accumulator.name)
+            if state is None:
+                logger.warning('No %s in the checkpoint; they restart from scratch'
+                               %accumulator.name)
+                continue
+            accumulator.set_state(state, read_group(files, accumulator.name, slices,
+                                                    first=own))
+
+        solver.iteration = solver.initial_iteration = info['iteration']
+        solver.sim_time = solver.initial_sim_time = info['sim_time']
+        self.cfl.stored_dt = info['dt']
+        if 'cfl' in info and hasattr(self.cfl, 'arrays'):
+            self.cfl.set_state(info['cfl'], read_group(files, 'cfl', slices, first=own))
+        elif 'cfl' in info and hasattr(self.cfl, 'set_state'):
+            self.cfl.set_state(info['cfl'])
+        if len(info['handlers']) == len(solver.evaluator.handlers):
+            for handler, (sim_div, iter_div) in zip(solver.evaluator.handlers,
+                                                   info['handlers']):
+                handler.last_sim_div = sim_div
+                handler.last_iter_div = iter_div
+        else:
+            logger.warning('File handlers differ from the checkpointed run;'
+                           ' their schedules restart from scratch')
+        if self.cfl_update() and hasattr(self.cfl, 'frequencies'):
+            # Only with cadence=1: the CFL needs the velocities of the
+            # previous iteration, approximated here by the restored ones.
+            logger.warning('Restarting at a CFL update; not bit-for-bit')
+            solver.evaluator.evaluate_handlers([self.cfl.frequencies],
+                                               world_time=time.time(), wall_time=0.,
+                                               sim_time=solver.sim_time,
+                                               timestep=info['dt'],
+                                               iteration=solver.iteration)
+        if self.sim_dt:
+            self.last_sim_div = solver.sim_time // self.sim_dt
+        return info['dt']
+
+
+def complete_sets(base_path):
+    """ Checkpoint sets in base_path with info.json, oldest first. """
+    sets = [os.path.dirname(p) for p in glob.glob(os.path.join(base_path, '*_s*', 'info.json'))]
+    return sorted(sets, key=set_number)
+
+
+def set_number(path):
+    return int(os.path.normpath(path).rsplit('_s', 1)[1])
+
+
+def latest_set_number(base_path):
+    """ Largest set number in base_path, complete or not. """
+    sets = glob.glob(os.path.join(base_path, '*_s*'))
+    return max((set_number(p) for p in sets), default=None)
+
+
+def read_group(files, name, slices, first=None):
+    """ Blocks `slices` of every dataset of group `name` (see read_block),
+        by dataset name; empty if the checkpoint has no such group. """
+    with h5py.File(files[0], 'r') as file:
+        keys = list(file[name].keys()) if name in file else []
+    return {key: read_block(files, '%s/%s' %(name, key), slices, first=first)
+            for key in keys}
+
+
+def read_block(files, name, slices, first=None):
+    """ Assemble the block `slices` of dataset `name` from process files
+        holding blocks of the global array (their 'start' attribute).
+        The file `first` is tried alone before scanning all files. """
+    shape = tuple(s.stop - s.start for s in slices)
+    for candidates in ([first] if first else [], files):
+        data = None
+        filled = 0
+        for path in candidates:
+            with h5py.File(path, 'r') as file:
+                dset = file[name]
+                start = file.attrs['start']
+                if data is None:
+                    data = np.zeros(shape, dtype=dset.dtype)
+                src, dst = [], []
+                for s, lo, n in zip(slices, start, dset.shape):
+                    a, b = max(s.start, lo), min(s.stop, lo + n)
+                    if a >= b:
+                        break
+                    src.append(slice(a - lo, b - lo))
+                    dst.append(slice(a - s.start, b - s.start))
+                else:
+                    data[tuple(dst)] = dset[tuple(src)]
+                    filled += np.prod([d.stop - d.start for d in dst])
+        if data is not None and filled == np.prod(shape):
+            return data
+    raise ValueError("Checkpoint does not cover the local block of %s" %name)
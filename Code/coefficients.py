@@ -0,0 +1,271 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    coefficients.py: fields reconstructed from coefficient snapshots.
+
+    With --snapshot-space coeff, the snapshot tasks are written as the
+    spectral coefficients of the solver (no backward transforms at write
+    time), optionally truncated to the lowest --coeff-fraction of the x
+    modes and Chebyshev z degrees, and without bz, which is the
+    derivative of b. The files record the bases of the domain (attribute
+    'bases', see output.describe). With the Dedalus 2 conventions
+
+        x (real Fourier, first axis): modes k = 0 .. N/2-1,
+            f = Re[c_0 + 2 sum_{k>0} c_k exp(i 2 pi k (x - a)/L)]
+        y (Fourier, 3D): modes in FFT order (np.fft.fftfreq),
+            f = sum_k c_k exp(i 2 pi k (y - a)/L)
+        z (Chebyshev): f = sum_n c_n T_n(2 (z - a)/(b - a) - 1)
+            (a compound basis concatenates the series of its subbases)
+
+    a field is a sum of separable modes, so it can be evaluated on any
+    grid (finer or coarser than the run's), at arbitrary points, and
+    differentiated or integrated along any axis exactly:
+
+        snap = coefficients.Snapshot('snapshots/snapshots_s1.h5')
+        b = snap.evaluate('b', x=np.linspace(0, 4, 2049), z=snap.grid('z', 2))
+        bz = snap.evaluate('b', derivative={'z': 1})             # on the run's grid
+        F = snap.evaluate('b', derivative={'z': 1}, z=[1.])      # surface flux
+        B = snap.evaluate('b', integrate=('x',))                 # integral over x, (z,)
+        values = snap.at('w', x=xs, z=zs)                        # points (xs, zs)
+
+    Snapshot reads merged files (merge.py merges coefficient sets as it
+    does grid ones), and continuation.py starts runs (--init) from them.
+
+    Cesar Rocha et al.
+"""
+
+import json
+
+import h5py
+import numpy as np
+from numpy.polynomial import chebyshev
+
+import encoding
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def mode_numbers(basis, n):
+    """ Mode numbers of the first n stored coefficients of a Fourier basis. """
+    if basis['real']:
+        return np.arange(n)
+    return np.fft.fftfreq(basis['size'], 1./basis['size'])[:n]
+
+
+def derivative_matrix(n, order):
+    """ Chebyshev coefficients of the order-th derivative of T_0..T_{n-1}
+        (columns), on [-1, 1]. """
+    D = np.zeros((n, n))
+    for j in range(n):
+        d = chebyshev.chebder(np.eye(n)[j], order)
+        D[:len(d), j] = d
+    return D
+
+
+def matrix(basis, n, points, order=0):
+    """ Matrix (len(points), n) evaluating the order-th derivative of the
+        series of the first n coefficients of `basis` at points. """
+    points = np.asarray(points, dtype=float)
+    a, b = basis['interval']
+    if basis['type'] == 'Fourier':
+        L = b - a
+        k = 2*np.pi*mode_numbers(basis, n)/L
+        M = np.exp(1j*np.outer(points - a, k)) * (1j*k)**order
+        if basis['real']:
+            M[:, 1:] *= 2
+        return M
+    if basis['type'] == 'Chebyshev':
+        zeta = np.clip((2*points - (a + b))/(b - a), -1, 1)
+        M = chebyshev.chebvander(zeta, n - 1)
+        if order:
+            M = M @ derivative_matrix(n, order) * (2/(b - a))**order
+        return M
+    # Compound: each point takes the series of the subbasis it falls in
+    M = np.zeros((len(points), n))
+    done = np.zeros(len(points), dtype=bool)
+    start = 0
+    for sub in basis['subbases']:
+        size = min(sub['size'], n - start)
+        if size <= 0:
+            break
+        a, b = sub['interval']
+        inside = ~done & (points >= a - 1e-12) & (points <= b + 1e-12)
+        M[inside, start:start+size] = matrix(dict(sub, type='Chebyshev'), size,
+                                             points[inside], order)
+        done |= inside
+        start += sub['size']
+    return M
+
+
+def matrix_derivative(basis, n, order):
+    """ Matrix (n, n) mapping the first n coefficients of `basis` to those
+        of their order-th derivative. """
+    a, b = basis['interval']
+    if basis['type'] == 'Fourier':
+        k = 2*np.pi*mode_numbers(basis, n)/(b - a)
+        return np.diag((1j*k)**order)
+    if basis['type'] == 'Chebyshev':
+        return derivative_matrix(n, order) * (2/(b - a))**order
+    D = np.zeros((n, n))
+    start = 0
+    for sub in basis['subbases']:
+        size = min(sub['size'], n - start)
+        if size <= 0:
+            break
+        block = slice(start, start + size)
+        D[block, block] = matrix_derivative(dict(sub, type='Chebyshev'), size, order)
+        start += sub['size']
+    return D
+
+
+def integral(basis, n):
+    """ Vector (n,) of the integrals over the interval of the first n modes. """
+    a, b = basis['interval']
+    if basis['type'] == 'Fourier':
+        v = np.zeros(n)
+        v[0] = b - a
+        return v
+    if basis['type'] == 'Chebyshev':
+        m = np.arange(n)
+        v = np.zeros(n)
+        even = m % 2 == 0
+        v[even] = (b - a)/2 * 2/(1 - m[even]**2)
+        return v
+    v = np.zeros(n)
+    start = 0
+    for sub in basis['subbases']:
+        size = min(sub['size'], n - start)
+        if size <= 0:
+            break
+        v[start:start+size] = integral(dict(sub, type='Chebyshev'), size)
+        start += sub['size']
+    return v
+
+
+def grid(basis, scale=1.):
+    """ Grid of `basis` at `scale` (that of the Dedalus transforms). """
+    if basis['type'] == 'Compound':
+        return np.concatenate([grid(dict(sub, type='Chebyshev'), scale)
+                               for sub in basis['subbases']])
+    n = int(np.ceil(scale*basis['size']))
+    a, b = basis['interval']
+    if basis['type'] == 'Fourier':
+        return a + (b - a)*np.arange(n)/n
+    return (a + b)/2 - (b - a)/2*np.cos(np.pi*(np.arange(n) + 1/2)/n)
+
+
+def padded(dset, index, slices):
+    """ Block `slices` (of the full coefficient array) of write `index` of
+        a possibly truncated dataset, zero beyond the stored modes. """
+    shape = tuple(s.stop - s.start for s in slices)
+    stored = tuple(slice(s.start, max(min(s.stop, n), s.start))
+                   for s, n in zip(slices, dset.shape[1:]))
+    block = np.zeros(shape, dtype=complex)
+    if all(s.stop > s.start for s in stored):
+        block[tuple(slice(0, s.stop - s.start) for s in stored)] = \
+            encoding.read(dset, (index,) + stored)
+    return block
+
+
+class Snapshot:
+    """ Merged coefficient snapshot file. """
+
+    def __init__(self, path):
+        self.file = h5py.File(path, 'r')
+        if self.file.attrs.get('space') != 'coeff':
+            raise ValueError("%s holds no coefficient snapshots (--snapshot-space coeff)"
+                             %path)
+        self.bases = json.loads(self.file.attrs['bases'])
+        self.axes = tuple(basis['name'] for basis in self.bases)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    @property
+    def tasks(self):
+        return list(self.file['tasks'].keys())
+
+    @property
+    def sim_time(self):
+        return self.file['scales']['sim_time'][:]
+
+    def basis(self, axis):
+        return self.bases[self.axes.index(axis)]
+
+    def grid(self, axis, scale=1.):
+        return grid(self.basis(axis), scale)
+
+    def coefficients(self, name, index=-1):
+        """ Stored coefficients of write `index` of a task (complex). """
+        dset = self.file['tasks'][name]
+        if 'start' in dset.attrs and np.any(dset.attrs['start']):
+            raise ValueError("%s is the block of one process; merge the set first"
+                             %self.file.filename)
+        return encoding.read(dset, index).astype(complex)
+
+    def operators(self, c, derivative, points):
+        """ Per axis, the matrix or integral vector applied to the modes of
+            c; `points` maps axes to the points of each. """
+        operators = []
+        for axis, (basis, n) in enumerate(zip(self.bases, c.shape)):
+            name = basis['name']
+            order = derivative.get(name, 0)
+            if points[name] is None:
+                v = integral(basis, n)
+                if order:
+                    v = matrix_derivative(basis, n, order).T @ v
+                operators.append(v)
+            else:
+                operators.append(matrix(basis, n, points[name], order))
+        return operators
+
+    def evaluate(self, name, index=-1, derivative=None, integrate=(), scale=1., **points):
+        """ Task `name` (write `index`) on the tensor grid of the points
+            given for each axis (default: its grid at `scale`), with
+            derivatives {axis: order} and integrated over the axes of
+            `integrate` (which are dropped). """
+        c = self.coefficients(name, index)
+        derivative = derivative or {}
+        for axis in self.axes:
+            if axis in integrate:
+                points[axis] = None
+            elif axis not in points:
+                points[axis] = self.grid(axis, scale)
+            else:
+                points[axis] = np.atleast_1d(points[axis])
+        operators = self.operators(c, derivative, points)
+        # Contract the last axes first, keeping the real Fourier axis (the
+        # first) for last, and take the real part at the end
+        for axis in reversed(range(len(operators))):
+            op = operators[axis]
+            if op.ndim == 1:
+                c = np.tensordot(c, op, axes=([axis], [0]))
+            else:
+                c = np.moveaxis(np.tensordot(op, c, axes=([1], [axis])), 0, axis)
+        return c.real
+
+    def at(self, name, index=-1, derivative=None, **points):
+        """ Task `name` (write `index`) at arbitrary points, given as arrays
+            of coordinates of every axis (broadcast together). """
+        c = self.coefficients(name, index)
+        derivative = derivative or {}
+        coordinates = np.broadcast_arrays(*[np.asarray(points[axis], dtype=float)
+                                            for axis in self.axes])
+        shape = coordinates[0].shape
+        points = {axis: np.ravel(x) for axis, x in zip(self.axes, coordinates)}
+        operators = self.operators(c, derivative, points)
+        letters = 'abcdefgh'[:c.ndim]
+        subscripts = ','.join('p' + l for l in letters) + ',' + letters + '->p'
+        values = np.einsum(subscripts, *operators, c, optimize=True)
+        return values.real.reshape(shape)
+
@@ -0,0 +1,218 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    continuation.py: initial conditions interpolated from another run.
+
+    A new case (higher Ra and/or resolution) starts from the equilibrated
+    state of a previous one instead of from cold fluid at rest. The source
+    is a checkpoint set (see checkpoint.py) or a merged snapshot file of a
+    2D or 3D run (grid or coefficient snapshots, see coefficients.py).
+    Fields are interpolated spectrally: the source is loaded on its own
+    Fourier/Chebyshev domain and evaluated on the grid of the new domain,
+    which pads or truncates its coefficients. A 2D source lifts to a 3D
+    run by extending it uniformly in y (v = 0), and a small perturbation
+    of b seeds the 3D instabilities. Between different vertical bases
+    (e.g. to or from a run with a surface layer, see problems.z_basis),
+    the source is interpolated to the new z grid with the Chebyshev
+    polynomials of its subbases.
+
+    $ mpiexec -n 24 python3 2D_HC.py --Ra 6.4e9 --resolution 2048 512 \
+        --init ../2D_noslip_Ra1e9_Pr1/checkpoints
+    $ mpiexec -n 64 python3 3D_HC.py --init snapshots/snapshots_s10.h5
+
+    Cesar Rocha et al.
+"""
+
+import json
+import os
+
+import h5py
+import numpy as np
+from mpi4py import MPI
+
+from dedalus import public as de
+
+import checkpoint
+import coefficients
+import encoding
+import randomfield
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def initial_state(solver, path, index=-1, noise=0., seed=42, noise_modes=None,
+                  noise_slope=0.):
+    """ Set the state of `solver` from the run stored at `path`: a
+        checkpoint set, a checkpoint directory (latest complete set) or a
+        merged snapshot file (write `index`). Variables missing from the
+        source are zero; derivative variables (bz, uz, ...) are recomputed
+        on the new grid. `noise` is the amplitude of a random perturbation
+        of b, vanishing at the top and bottom: white noise, or band-limited
+        to noise_modes = (lo, hi) with spectral slope noise_slope (see
+        randomfield.py); the same for any number of ranks. """
+    domain = solver.domain
+    source = load_source(path, index)
+    logger.info('Initial state from %s (resolution %s)'
+                %(path, 'x'.join(map(str, source['resolution']))))
+    lift = len(source['resolution']) < domain.dim
+    if lift:
+        # 2D -> 3D: the 2D source is small, so every rank evaluates all of it
+        bases = [domain.bases[0], domain.bases[-1]]
+        comm, mesh = MPI.COMM_SELF, None
+    else:
+        bases = domain.bases
+        comm, mesh = domain.dist.comm, domain.dist.mesh
+    src_bases = [type(basis)(basis.name, n, interval=basis.interval, dealias=1)
+                 for basis, n in zip(bases[:-1], source['resolution'][:-1])]
+    scales = [basis.base_grid_size/n for basis, n in zip(bases, source['resolution'])]
+    # The vertical basis of the source; unless both are single Chebyshev
+    # bases or the same compound basis, the source stays on its own z grid
+    # and is resampled with the matrix `resample`
+    target_z = z_bases(bases[-1])
+    source_z = source.get('z_bases') or [[source['resolution'][-1]] + list(bases[-1].interval)]
+    src_bases.append(z_basis(source_z))
+    resample = None
+    if len(source_z) > 1 or len(target_z) > 1:
+        scales[-1] = 1
+        if source_z != target_z:
+            resample = resampling(source_z, np.ravel(domain.grid(domain.dim-1, scales=1)))
+    src_domain = de.Domain(src_bases, grid_dtype=np.float64, comm=comm, mesh=mesh)
+    slices = domain.dist.grid_layout.slices(scales=1)
+
+    for field in solver.state.fields:
+        field.set_scales(1, keep_data=False)
+        if field.name not in source['fields'] or derivative(solver, field.name):
+            field['g'] = 0.
+            continue
+        src = src_domain.new_field()
+        source['fields'][field.name](src)
+        src.set_scales(scales, keep_data=True)
+        data = src['g'] if resample is None else src['g'] @ resample.T
+        if lift:
+            field['g'] = data[slices[0], np.newaxis, slices[-1]]
+        else:
+            field['g'] = data
+
+    if noise:
+        b = solver.state['b']
+        z = domain.grid(domain.dim-1, scales=1)
+        zb, zt = domain.bases[-1].interval
+        if noise_modes:
+            perturbation = randomfield.spectral(domain, seed, noise_modes, noise_slope)
+        else:
+            perturbation = randomfield.white(domain, seed)
+        b.set_scales(1, keep_data=True)
+        b['g'] += noise * perturbation * (zt - z) * (z - zb)
+
+    for field in solver.state.fields:
+        parent = derivative(solver, field.name)
+        if parent:
+            solver.state[parent].differentiate(field.name[-1], out=field)
+    return source
+
+
+def z_bases(basis):
+    """ [n, zb, zt] of each Chebyshev basis of a (compound) vertical basis
+        (as stored in the info.json of checkpoints). """
+    subbases = getattr(basis, 'subbases', [basis])
+    return [[int(sub.base_grid_size)] + [float(a) for a in sub.interval]
+            for sub in subbases]
+
+
+def z_basis(structure, dealias=1):
+    """ Vertical basis of the [n, zb, zt] list of z_bases. """
+    if len(structure) == 1:
+        n, zb, zt = structure[0]
+        return de.Chebyshev('z', n, interval=(zb, zt), dealias=dealias)
+    subbases = [de.Chebyshev('z%i' %(i+1), n, interval=(zb, zt), dealias=dealias)
+                for i, (n, zb, zt) in enumerate(structure)]
+    return de.Compound('z', tuple(subbases), dealias=dealias)
+
+
+def resampling(structure, z):
+    """ Matrix interpolating values on the grid of the (compound) vertical
+        basis `structure` to the points z, with the Chebyshev polynomial of
+        the subbasis each point falls in. """
+    n_total = sum(n for n, zb, zt in structure)
+    M = np.zeros((len(z), n_total))
+    done = np.zeros(len(z), dtype=bool)
+    start = 0
+    for n, zb, zt in structure:
+        grid = (zb + zt)/2 - (zt - zb)/2 * np.cos(np.pi*(np.arange(n) + 1/2)/n)
+        inside = ~done & (z >= zb - 1e-12) & (z <= zt + 1e-12)
+        x = np.clip((2*z[inside] - (zb + zt))/(zt - zb), -1, 1)
+        T = np.polynomial.chebyshev.chebvander((2*grid - (zb + zt))/(zt - zb), n - 1)
+        M[inside, start:start+n] = np.polynomial.chebyshev.chebvander(x, n - 1) @ np.linalg.inv(T)
+        done |= inside
+        start += n
+    return M
+
+
+def derivative(solver, name):
+    """ Name of the variable that `name` is the derivative of (e.g. 'b' for
+        'bz'), or None if `name` is not a derivative variable. """
+    axes = [basis.name for basis in solver.domain.bases]
+    if len(name) > 1 and name[-1] in axes and name[:-1] in solver.state.field_names:
+        return name[:-1]
+    return None
+
+
+def load_source(path, index=-1):
+    """ Describe the run at `path`: its grid resolution and, for every
+        variable, a function that loads it into a field of the source
+        domain (distributed like that field). """
+    if os.path.isdir(path):
+        sets = checkpoint.complete_sets(path)
+        path = sets[-1] if sets else path
+        with open(os.path.join(path, 'info.json')) as f:
+            info = json.load(f)
+        name = os.path.basename(os.path.normpath(path))
+        files = [os.path.join(path, '%s_p%i.h5' %(name, p))
+                 for p in range(info['nprocs'])]
+        with h5py.File(files[0], 'r') as file:
+            names = [name for name, item in file.items() if isinstance(item, h5py.Dataset)]
+
+        def loader(name):
+            def load(field):
+                layout = field.domain.dist.coeff_layout
+                field['c'] = checkpoint.read_block(files, name, layout.slices(scales=1))
+            return load
+        return dict(resolution=info['resolution'], z_bases=info.get('z_bases'),
+                    sim_time=info['sim_time'], iteration=info['iteration'],
+                    fields={name: loader(name) for name in names})
+
+    with h5py.File(path, 'r') as file:
+        names = list(file['tasks'].keys())
+        resolution = file['tasks'][names[0]].shape[1:]
+        sim_time = float(file['scales']['sim_time'][index])
+        iteration = int(file['scales']['iteration'][index])
+        coeff = file.attrs.get('space') == 'coeff'
+        bases = json.loads(file.attrs['bases']) if coeff else None
+
+    if coeff:
+        # Coefficient snapshots (see coefficients.py), zero beyond the
+        # stored modes
+        def loader(name):
+            def load(field):
+                slices = field.domain.dist.coeff_layout.slices(scales=1)
+                with h5py.File(path, 'r') as file:
+                    field['c'] = coefficients.padded(file['tasks'][name], index, slices)
+            return load
+        structure = [[sub['size']] + sub['interval'] for sub in
+                     bases[-1].get('subbases', [bases[-1]])]
+        return dict(resolution=[basis['size'] for basis in bases], z_bases=structure,
+                    sim_time=sim_time, iteration=iteration,
+                    fields={name: loader(name) for name in names})
+
+    def loader(name):
+        def load(field):
+            slices = field.domain.dist.grid_layout.slices(scales=1)
+            with h5py.File(path, 'r') as file:
+                field['g'] = encoding.read(file['tasks'][name], (index,) + slices)
+        return load
+    return dict(resolution=list(resolution), sim_time=sim_time, iteration=iteration,
+                fields={name: loader(name) for name in names})
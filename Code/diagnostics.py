@@ -0,0 +1,215 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    diagnostics.py: shared evaluation of the volume-averaged diagnostics.
+
+    All diagnostics of 2D_HC.py and 3D_HC.py (ke, u2/v2/w2, chi and its
+    components, ep, wb, and the flow properties Re and K) are linear
+    combinations of volume integrals of quadratic products of a few
+    fields. Evaluating them as separate Dedalus tasks transforms every
+    product back to coefficient space, evaluates dx(u) and dx(w) twice for
+    ep and transposes once per task. Here the fields are evaluated once
+    per cadence on the dealiased grid, each distinct product is
+    integrated once with Fourier/Chebyshev quadrature weights, and all
+    integrals are reduced across ranks in a single Allreduce.
+
+    Diagnostics is a Dedalus dictionary handler, so it is evaluated inside
+    solver.step together with the other handlers. It writes the averages
+    to diagnostics/diagnostics_s<n>.h5 (already merged, with the layout of
+    the file handler it replaces) and provides volume_average() and max()
+    like flow_tools.GlobalFlowProperty. With an output.AsyncOutput, the
+    writes are performed by its background writer.
+
+    Both approaches are compared with
+    $ python3 benchmark.py diagnostics
+
+    Cesar Rocha et al.
+"""
+
+import glob
+import os
+import shutil
+import time
+
+import numpy as np
+from mpi4py import MPI
+
+from dedalus import public as de
+from dedalus.core.evaluator import DictionaryHandler
+
+import writer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def fejer_weights(x, n):
+    """ Fejer's first quadrature rule on [-1, 1] at the points x of the
+        n-point Gauss-Chebyshev grid. """
+    theta = np.arccos(np.clip(x, -1, 1))
+    k = np.arange(1, n//2 + 1)
+    s = np.cos(2*np.multiply.outer(theta, k)) / (4*k**2 - 1)
+    return 2/n * (1 - 2*s.sum(axis=-1))
+
+
+def quadrature_weights(domain, scales):
+    """ Local quadrature weights on the grid at `scales`, such that
+        sum(weights * f) is the volume integral of f. """
+    gshape = domain.dist.grid_layout.global_shape(scales=scales)
+    weights = 1.
+    for axis, basis in enumerate(domain.bases):
+        a, b = basis.interval
+        n = gshape[axis]
+        grid = domain.grid(axis, scales=scales)
+        if isinstance(basis, de.Fourier):
+            w = np.full(grid.shape, (b - a)/n)
+        elif isinstance(basis, de.Chebyshev):
+            w = (b - a)/2 * fejer_weights((2*grid - (a + b))/(b - a), n)
+        elif isinstance(basis, de.Compound):
+            # Fejer weights of each subbasis on its own part of the grid
+            scale = domain.remedy_scales(scales)[axis]
+            w = []
+            for sub in basis.subbases:
+                a, b = sub.interval
+                z = sub.grid(scale)
+                w.append((b - a)/2 * fejer_weights((2*z - (a + b))/(b - a), len(z)))
+            w = np.concatenate(w).reshape(grid.shape)
+        else:
+            raise ValueError("No quadrature for basis %r" %basis)
+        weights = weights * w
+    return weights
+
+
+class Diagnostics(DictionaryHandler):
+    """ Volume averages and maxima of quadratic products of fields.
+
+        fields: {name: expression} evaluated once per cadence, e.g.
+                {'u': 'u', 'ux': 'dx(u)'}
+        Averages and maxima are declared with add_average and add_max in
+        terms of products 'a*b' of these fields. """
+
+    def __init__(self, solver, fields, iter=10, base_path='diagnostics',
+                 mode='overwrite', flush=10, output=None):
+        domain = solver.domain
+        DictionaryHandler.__init__(self, domain, solver.evaluator.vars, iter=iter)
+        solver.evaluator.add_handler(self)
+        self.solver = solver
+        self.scales = domain.dealias
+        for name, expression in fields.items():
+            self.add_task(expression, layout='g', name=name, scales=self.scales)
+        self.comm = domain.dist.comm_cart
+        self.weights = quadrature_weights(domain, self.scales)
+        self.volume = np.prod([b.interval[1] - b.interval[0] for b in domain.bases])
+        self.products = []
+        self.averages = {}
+        self.maxima = {}
+        self.values = {}
+        self.output = []
+        self.masked = set()
+
+        # Output (rank 0), one new set per run like a Dedalus file handler
+        # (absolute, as sweep.py changes directory between cases)
+        self.base_path = base_path = base_path and os.path.abspath(base_path)
+        self.flush_every = flush
+        self.rows = []
+        self.path = None
+        self.writer = getattr(output, 'writer', None)
+        if base_path and self.comm.rank == 0:
+            if mode == 'overwrite' and os.path.exists(base_path):
+                shutil.rmtree(base_path)
+            os.makedirs(base_path, exist_ok=True)
+            name = os.path.basename(os.path.normpath(base_path))
+            sets = glob.glob(os.path.join(base_path, '%s_s*.h5' %name))
+            num = max([int(s[:-3].rsplit('_s', 1)[1]) for s in sets], default=0) + 1
+            self.path = os.path.join(base_path, '%s_s%i.h5' %(name, num))
+        self.start_time = time.time()
+
+    def _product(self, product):
+        if '*' not in product:
+            # Linear term
+            key = (product.strip(), None)
+        else:
+            a, b = product.split('*')
+            key = (a.strip(), b.strip())
+        if key not in self.products:
+            self.products.append(key)
+        return key
+
+    def add_average(self, name, terms, write=True):
+        """ Volume average of sum(c * a*b for 'a*b', c in terms.items());
+            a term 'a' without a product is linear. """
+        self.averages[name] = {self._product(p): c for p, c in terms.items()}
+        if write:
+            self.output.append(name)
+
+    def add_max(self, name, terms, function=None, write=False):
+        """ Global maximum of function(sum(c * a*b)) over the grid. """
+        self.maxima[name] = ({self._product(p): c for p, c in terms.items()},
+                             function or (lambda s: s))
+        if write:
+            self.output.append(name)
+
+    def process(self, **kw):
+        DictionaryHandler.process(self, **kw)
+        g = {}
+        for name, field in self.fields.items():
+            field.set_scales(self.scales, keep_data=True)
+            g[name] = field['g']
+
+        # Integrals of all products, one weighted dot product each
+        weighted = {}
+        local = np.zeros(len(self.products))
+        for i, (a, b) in enumerate(self.products):
+            if a not in weighted:
+                weighted[a] = self.weights * g[a]
+            local[i] = np.sum(weighted[a]) if b is None else np.vdot(weighted[a], g[b]).real
+        maxima = np.full(len(self.maxima), -np.inf)
+        for i, (terms, function) in enumerate(self.maxima.values()):
+            if g[next(iter(terms))[0]].size:
+                s = sum(c * g[a] * g[b] for (a, b), c in terms.items())
+                maxima[i] = np.max(function(s))
+        self.comm.Allreduce(MPI.IN_PLACE, local, op=MPI.SUM)
+        self.comm.Allreduce(MPI.IN_PLACE, maxima, op=MPI.MAX)
+
+        integrals = dict(zip(self.products, local))
+        for name, terms in self.averages.items():
+            self.values[name] = sum(c * integrals[p] for p, c in terms.items()) / self.volume
+        for name, value in zip(self.maxima, maxima):
+            self.values[name] = value
+
+        if self.path:
+            self.rows.append((kw.get('sim_time', self.solver.sim_time),
+                              time.time() - self.start_time,
+                              kw.get('iteration', self.solver.iteration),
+                              kw.get('timestep', np.nan),
+                              [np.nan if name in self.masked else self.values[name]
+                               for name in self.output]))
+            if len(self.rows) >= self.flush_every:
+                self.flush()
+
+    def mask(self, names):
+        """ Write NaN for the outputs `names` from now on (e.g. of a case
+            of an ensemble that is done). """
+        self.masked.update(names)
+
+    def volume_average(self, name):
+        return self.values[name]
+
+    def max(self, name):
+        return self.values[name]
+
+    def flush(self):
+        """ Append the buffered writes to the output file (rank 0), through
+            the background writer if there is one (see output.py); call at
+            the end of a run. """
+        if not self.rows:
+            return
+        args = (self.path, self.output, len(self.domain.bases), self.rows)
+        if self.writer:
+            self.writer.submit('append_rows', *args, nbytes=8*len(self.rows)*(4 + len(self.output)))
+        else:
+            writer.append_rows(*args)
+        self.rows = []
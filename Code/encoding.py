@@ -0,0 +1,106 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    encoding.py: reduced-precision and compressed snapshot datasets.
+
+    The snapshots of 2D_HC.py and 3D_HC.py are float64 grid data, most of
+    whose digits are noise for the analyses (Nu comes from the
+    diagnostics, and the streamfunction and mean fields need a few
+    significant digits). With --snapshot-encoding, the snapshot tasks are
+    stored as
+
+        float64     as before;
+        float32     relative error at most 2^-24;
+        quantized   integers q = round(f / (2 tol)), i.e. an absolute
+                    error at most tol (--snapshot-tol, in units of the
+                    surface buoyancy contrast), which compress very well;
+
+    and, with --snapshot-compression, in compressed chunks of one write.
+    Coefficient snapshots (--snapshot-space coeff) are complex: float32
+    stores them as complex64, and they cannot be quantized.
+    Each dataset records its encoding and error bound in its attributes
+    ('encoding', 'error_bound' or 'relative_error_bound',
+    'quantization_step'), which merge.py carries over to the merged files;
+    reader.py, continuation.py and streamfunction.py decode back to
+    float64 with read().
+
+    $ mpiexec -n 64 python3 3D_HC.py --snapshot-encoding quantized --snapshot-tol 1e-5 \\
+          --snapshot-compression gzip
+
+    Cesar Rocha et al.
+"""
+
+import numpy as np
+
+encodings = ['float64', 'float32', 'quantized']
+compressions = ['none', 'gzip', 'lzf']
+
+
+def attributes(encoding, tol=None):
+    """ Dataset attributes recording an encoding and its error bound. """
+    if encoding == 'float64':
+        return {}
+    if encoding == 'float32':
+        return dict(encoding='float32', relative_error_bound=2.**-24)
+    if encoding == 'quantized':
+        if not tol or tol <= 0:
+            raise ValueError("Quantization needs a positive error bound")
+        return dict(encoding='quantized', error_bound=tol, quantization_step=2*tol)
+    raise ValueError("Unknown encoding %r" %encoding)
+
+
+def dtype(encoding, default=float):
+    """ Stored type of an encoding (complex64 for complex float32 data). """
+    if encoding == 'float32' and np.issubdtype(default, np.complexfloating):
+        return np.complex64
+    if encoding == 'quantized' and np.issubdtype(default, np.complexfloating):
+        raise ValueError("Quantization of complex data (coefficients) is not supported")
+    return {'float32': np.float32, 'quantized': np.int32}.get(encoding, default)
+
+
+def creation(encoding, compression, count, default=float):
+    """ Keyword arguments of create_dataset for writes of shape `count`. """
+    kw = dict(dtype=dtype(encoding, default))
+    if compression not in (None, 'none') and np.prod(count):
+        kw.update(chunks=(1,) + tuple(count), compression=compression, shuffle=True)
+    return kw
+
+
+def encode(data, encoding, tol=None):
+    """ Data as stored with an encoding. """
+    if encoding == 'float32':
+        return data.astype(dtype(encoding, data.dtype))
+    if encoding == 'quantized':
+        q = np.rint(data / (2*tol))
+        if q.size and np.abs(q).max() >= 2**31:
+            raise ValueError("Quantization step %g too small for values up to %g"
+                             %(2*tol, np.abs(data).max()))
+        return q.astype(np.int32)
+    return data
+
+
+def decode(data, attrs):
+    """ Stored data of a dataset with attributes attrs as float64 (or
+        complex128). """
+    encoding = attrs.get('encoding', 'float64')
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode()
+    if encoding == 'quantized':
+        return data * float(attrs['quantization_step'])
+    if encoding == 'float32':
+        return data.astype(np.result_type(data.dtype, float))
+    return data
+
+
+def read(dset, key=Ellipsis):
+    """ dset[key] decoded to float64 (or complex128). """
+    return decode(dset[key], dset.attrs)
+
+
+def decoded_dtype(dset):
+    if 'encoding' not in dset.attrs:
+        return dset.dtype
+    return np.result_type(dset.dtype, float)
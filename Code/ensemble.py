@@ -0,0 +1,237 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    ensemble.py: many small 2D cases advanced together in one process.
+
+    Low-Ra cases (e.g. those of the inset of Figure 6, Ra up to ~4e4) are
+    tiny problems: as separate mpiexec jobs of 2D_HC.py they spend more
+    time starting up and building solvers than time stepping. Here the 2D
+    cases of a manifest (see sweep.py) that share a resolution are run in
+    batches of up to --batch cases, each batch being one Dedalus problem
+    (problems.boussinesq_ensemble). Every pencil holds the equations of
+    all the cases of a batch, so the pencil matrices are built and
+    factored once per batch, each stage of a step is one sparse solve per
+    pencil for all cases, and the transforms and the overhead of a step
+    are shared by the batch. The cases of a batch take a common time step,
+    the smallest CFL step among them (they are similar at low Ra); cases
+    that reach their stop time or equilibrate are done, and frozen in
+    their final state (no longer limiting the step nor written to the
+    diagnostics), while the others carry on.
+
+    Cases with a surface layer (z_layer) or a resolution check (regrid)
+    are left to sweep.py, like the 3D ones; a case's own rundb is used.
+
+    Each case gets the runs/<name>/ directory of sweep.py with nusselt.json
+    and case.json, so sweeps skip it; the diagnostics of a batch (ke_i,
+    chi_i, b_bottom_i of its case i) are in runs/ensemble_<nx>x<nz>_<n>/.
+
+    $ python3 ensemble.py manifest.json --batch 16
+    $ python3 ensemble.py manifest.json --equilibrate 1e-3 --rundb ../Data/runs
+
+    Cesar Rocha et al.
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+import problems
+import diagnostics
+import nusselt
+import rundb
+import sweep
+import timestep
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CaseFlow:
+    """ Flow properties of case i of the diagnostics of a batch, as read
+        by nusselt.NusseltMonitor and rundb.Recorder. """
+
+    def __init__(self, flow, i):
+        self.flow = flow
+        self.i = i
+
+    def volume_average(self, name):
+        return self.flow.volume_average('%s_%i' %(name, self.i))
+
+    def max(self, name):
+        return self.flow.max('%s_%i' %(name, self.i))
+
+
+def unsupported(case):
+    """ What keeps a case out of the batches (None if nothing): 3D cases,
+        surface layers (whose thickness depends on Ra, so no two cases
+        share a domain) and resolution checks are left to sweep.py. """
+    if case['dim'] != 2:
+        return '3D'
+    if case.get('z_layer'):
+        return 'surface-layer'
+    if case.get('regrid'):
+        return 'regrid'
+    return None
+
+
+def batches(cases, size):
+    """ The cases that can be batched (see unsupported) grouped by
+        resolution, in batches of at most size. """
+    groups = {}
+    for case in cases:
+        if unsupported(case) is None:
+            groups.setdefault(tuple(case['resolution']), []).append(case)
+    return [group[i:i+size] for group in groups.values()
+            for i in range(0, len(group), size)]
+
+
+def run(cases, output, name, equilibrate=None, window=1000., rundb_path=None):
+    """ Run a batch of 2D cases sharing a resolution as one problem. """
+    configs = [problems.Config(2, case['bc'], case['Ra'], case['Pr'],
+                               tuple(case['resolution'])) for case in cases]
+    solver = problems.ensemble_solver(configs)
+    path = os.path.join(output, name)
+
+    # Coldish fluid in the containers
+    for i in range(len(cases)):
+        b = solver.state['b_%i' %i]
+        b['g'] = -0.6
+        b.differentiate('z', out=solver.state['bz_%i' %i])
+
+    # Integration parameters
+    solver.stop_sim_time = max(case['stop_sim_time'] for case in cases)
+    solver.stop_wall_time = np.inf
+    solver.stop_iteration = np.inf
+    dt = 0.125 # Initial time step
+
+    # Diagnostics of all cases
+    fields = {}
+    for i in range(len(cases)):
+        for v in ('u', 'w', 'bx', 'bz'):
+            fields['%s_%i' %(v, i)] = '%s_%i' %(v, i)
+        fields['bb_%i' %i] = 'left(b_%i)' %i
+    flow = diagnostics.Diagnostics(solver, fields, iter=10,
+                                   base_path=os.path.join(path, 'diagnostics'))
+    for i, config in enumerate(configs):
+        P, R = problems.diffusivities(config.Ra, config.Pr)
+        u, w, bx, bz, bb = ('%s_%i' %(v, i) for v in ('u', 'w', 'bx', 'bz', 'bb'))
+        flow.add_average('ke_%i' %i, {u+'*'+u: 0.5, w+'*'+w: 0.5})
+        flow.add_average('chi_%i' %i, {bx+'*'+bx: P, bz+'*'+bz: P})
+        flow.add_average('b_bottom_%i' %i, {bb: 1})
+        flow.add_max('Re_%i' %i, {u+'*'+u: 1, w+'*'+w: 1}, lambda s, R=R: np.sqrt(s)/R)
+        flow.add_average('K_%i' %i, {u+'*'+u: 0.5, w+'*'+w: 0.5}, write=False)
+
+    # Common time step, the smallest of the cases
+    CFL = timestep.PredictiveCFL(solver, initial_dt=dt, cadence=10, safety=1,
+                                 max_change=1.5, min_change=0.5, max_dt=0.125,
+                                 threshold=0.05)
+    groups = [CFL.add_velocities(('u_%i' %i, 'w_%i' %i)) for i in range(len(cases))]
+
+    # Nusselt number and run database of each case
+    k = np.pi/problems.Lx
+    monitors, records = [], []
+    for i, (case, config) in enumerate(zip(cases, configs)):
+        P, R = problems.diffusivities(config.Ra, config.Pr)
+        monitors.append(nusselt.NusseltMonitor(solver, CaseFlow(flow, i),
+                                               nusselt.chi_diffusive(P, k, problems.Lz),
+                                               window=window, tol=equilibrate, cadence=10,
+                                               label='%s: ' %case['name']))
+        records.append(rundb.Recorder(solver, CaseFlow(flow, i),
+                                      case.get('rundb', rundb_path), config,
+                                      monitors[i].chi_diff, cadence=10))
+    done = [False] * len(cases)
+    frozen = {}
+
+    def freeze(i):
+        """ Keep the final state of a finished case, which no longer limits
+            the common step or writes diagnostics. """
+        frozen[i] = {name: np.copy(solver.state[name]['c'])
+                     for name in ('%s_%i' %(v, i) for v in problems.variables_2d)}
+        CFL.exclude(groups[i])
+        flow.mask('%s_%i' %(v, i) for v in ('ke', 'chi', 'b_bottom', 'Re'))
+
+    def finish(i, returncode=0):
+        case = cases[i]
+        os.makedirs(os.path.join(output, case['name']), exist_ok=True)
+        monitors[i].write(os.path.join(output, case['name'], 'nusselt.json'))
+        records[i].close(monitors[i])
+        if returncode is not None:
+            sweep.write_status(case, output, returncode=returncode, ensemble=name,
+                               sim_time=solver.sim_time, wall_time=time.time()-start_time)
+        done[i] = True
+
+    # Main loop
+    start_time = time.time()
+    try:
+        logger.info('Starting loop of %s: %s' %(name, ', '.join(c['name'] for c in cases)))
+        while solver.ok and not all(done):
+            dt = CFL.compute_dt()
+            dt = solver.step(dt)
+            for state in frozen.values():
+                for name, data in state.items():
+                    solver.state[name]['c'] = data
+            for i, case in enumerate(cases):
+                if done[i]:
+                    continue
+                converged = monitors[i].process()
+                records[i].process()
+                if converged or solver.sim_time >= case['stop_sim_time']:
+                    finish(i)
+                    freeze(i)
+            if (solver.iteration-1) % 100 == 0:
+                logger.info('Iteration: %i, Time: %e, dt: %e, cases running: %i'
+                            %(solver.iteration, solver.sim_time, dt, done.count(False)))
+    except:
+        logger.error('Exception raised, triggering end of main loop.')
+        raise
+    finally:
+        end_time = time.time()
+        for i in range(len(cases)):
+            if not done[i]:
+                # Unfinished (no case.json, so sweeps rerun it)
+                finish(i, returncode=None)
+        flow.flush()
+        CFL.report()
+        logger.info('Iterations: %i' %solver.iteration)
+        logger.info('Run time: %.2f sec for %i cases' %(end_time-start_time, len(cases)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s :: %(message)s')
+    parser = argparse.ArgumentParser(description="Run the 2D cases of a manifest in batches.")
+    parser.add_argument('manifest', help="JSON manifest of cases (see sweep.py)")
+    parser.add_argument('--output', default='runs',
+                        help="directory holding one subdirectory per case")
+    parser.add_argument('--batch', type=int, default=16,
+                        help="most cases advanced together (default %(default)i)")
+    parser.add_argument('--equilibrate', type=float, default=None, metavar='TOL',
+                        help="a case is done once Nu is stationary to a relative"
+                             " error TOL (see nusselt.py)")
+    parser.add_argument('--equilibrate-window', type=float, default=1000.,
+                        help="simulation time window of the Nu statistics"
+                             " (default %(default)g)")
+    parser.add_argument('--rundb', default=None,
+                        help="run database the cases stream their time series into")
+    parser.add_argument('--force', action='store_true',
+                        help="rerun cases that already finished")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    cases = sweep.load_manifest(args.manifest)
+    if not args.force:
+        cases = [case for case in cases if not sweep.is_done(case, output)]
+    for reason in ('3D', 'surface-layer', 'regrid'):
+        skipped = [case['name'] for case in cases if unsupported(case) == reason]
+        if skipped:
+            logger.info('Skipping the %s cases %s (run them with sweep.py)'
+                        %(reason, ', '.join(skipped)))
+    rundb_path = os.path.abspath(args.rundb) if args.rundb else None
+    for n, batch in enumerate(batches(cases, args.batch)):
+        name = 'ensemble_%s_%i' %('x'.join(map(str, batch[0]['resolution'])), n)
+        run(batch, output, name, args.equilibrate, args.equilibrate_window, rundb_path)
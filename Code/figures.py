@@ -0,0 +1,204 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    figures.py: incremental build of the figures in Figz/.
+
+    The inputs of each FigureN.py are read from its source: the Data/
+    files it opens, the modules of this directory it imports (and those
+    they import in turn) and the script itself. A figure is rebuilt only
+    if one of them changed since its last build (by content for code, by
+    size and modification time for data) or one of its outputs is
+    missing; stale figures are rendered in parallel worker processes.
+    The build record is Figz/.figures.json.
+
+    $ python3 figures.py                 # rebuild stale figures
+    $ python3 figures.py Figure4 -n 4    # only Figure4 (if stale)
+    $ python3 figures.py --preview       # 72 dpi PNGs in Figz/preview/, no EPS
+    $ python3 figures.py --list          # show which figures are stale
+
+    Cesar Rocha et al.
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import runpy
+import time
+import traceback
+
+import logging
+logger = logging.getLogger(__name__)
+
+here = os.path.dirname(os.path.abspath(__file__))
+figz = os.path.join(here, '..', 'Figz')
+record_path = os.path.join(figz, '.figures.json')
+preview_dir = os.path.join(figz, 'preview')
+preview_dpi = 72
+
+
+def scripts():
+    return sorted(glob.glob(os.path.join(here, 'Figure*.py')),
+                  key=lambda s: int(re.findall(r'\d+', os.path.basename(s))[0]))
+
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def imports(source):
+    """ Names of the top-level modules imported by a source. """
+    names = re.findall(r'^\s*from\s+(\w+)', source, re.M)
+    for modules in re.findall(r'^\s*import\s+([\w., ]+)', source, re.M):
+        names += [m.split()[0].split('.')[0] for m in modules.split(',') if m.strip()]
+    return names
+
+
+def inputs(script):
+    """ Code and data files the figure depends on: the modules of this
+        directory it imports, directly or through each other. """
+    code = [script]
+    data = set()
+    for path in code:    # grows as local imports are found
+        with open(path) as f:
+            source = f.read()
+        for name in imports(source):
+            module = os.path.join(here, name + '.py')
+            if os.path.exists(module) and module not in code:
+                code.append(module)
+        data.update(re.findall(r'''["'](\.\./Data/[^"']+)["']''', source))
+    return code, [os.path.normpath(os.path.join(here, d)) for d in sorted(data)]
+
+
+def outputs(script, preview=False):
+    with open(script) as f:
+        paths = re.findall(r'''savefig\(\s*["']([^"']+)["']''', f.read())
+    paths = [os.path.normpath(os.path.join(here, p)) for p in paths]
+    if preview:
+        paths = [os.path.join(preview_dir, os.path.basename(p)) for p in paths
+                 if p.endswith('.png')]
+    return paths
+
+
+def signature(script):
+    """ Hash of the figure's code and the state of its data files. """
+    code, data = inputs(script)
+    h = hashlib.sha256()
+    for path in code:
+        h.update(file_hash(path).encode())
+    for path in data:
+        if os.path.exists(path):
+            st = os.stat(path)
+            h.update(('%s %i %i' %(path, st.st_size, st.st_mtime_ns)).encode())
+        else:
+            h.update(('%s missing' %path).encode())
+    return h.hexdigest()
+
+
+def load_record():
+    if os.path.exists(record_path):
+        with open(record_path) as f:
+            return json.load(f)
+    return {}
+
+
+def stale(script, record, preview=False):
+    entry = record.get('preview' if preview else 'full', {}).get(os.path.basename(script))
+    if entry is None or entry['signature'] != signature(script):
+        return True
+    return not all(os.path.exists(p) for p in outputs(script, preview))
+
+
+def render(job):
+    """ Run one figure script (in a fresh worker process). """
+    script, preview = job
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from matplotlib.figure import Figure
+
+    if preview:
+        savefig = Figure.savefig
+
+        def preview_savefig(self, fname, *args, **kw):
+            if not str(fname).endswith('.png'):
+                return
+            kw['dpi'] = preview_dpi
+            return savefig(self, os.path.join(preview_dir, os.path.basename(fname)),
+                           *args, **kw)
+        Figure.savefig = preview_savefig
+
+    os.chdir(here)
+    start = time.time()
+    try:
+        runpy.run_path(script, run_name='__main__')
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    finally:
+        plt.close('all')
+    return script, error, time.time() - start
+
+
+def build(names=None, preview=False, processes=None, force=False):
+    """ Rebuild the stale figures (all of `names` if force). """
+    record = load_record()
+    mode = 'preview' if preview else 'full'
+    todo = [s for s in scripts()
+            if (not names or os.path.basename(s)[:-3] in names)
+            and (force or stale(s, record, preview))]
+    if not todo:
+        logger.info('All figures are up to date')
+        return []
+    if preview:
+        os.makedirs(preview_dir, exist_ok=True)
+    # Signatures before rendering, so that a change during the build
+    # leaves the figure stale
+    signatures = {s: signature(s) for s in todo}
+    failed = []
+    with multiprocessing.Pool(processes, maxtasksperchild=1) as pool:
+        for script, error, elapsed in pool.imap_unordered(render, [(s, preview) for s in todo]):
+            name = os.path.basename(script)
+            if error:
+                logger.error('%s failed:\n%s' %(name, error))
+                failed.append(name)
+                continue
+            logger.info('Built %s (%.1f sec)' %(name, elapsed))
+            record.setdefault(mode, {})[name] = dict(signature=signatures[script],
+                                                     outputs=outputs(script, preview))
+    with open(record_path, 'w') as f:
+        json.dump(record, f, indent=1, sort_keys=True)
+    return failed
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s :: %(message)s')
+    parser = argparse.ArgumentParser(description="Rebuild the stale figures.")
+    parser.add_argument('figures', nargs='*', help="e.g. Figure2 Figure4 (default: all)")
+    parser.add_argument('-n', '--processes', type=int, default=None,
+                        help="worker processes (default: number of cores)")
+    parser.add_argument('--preview', action='store_true',
+                        help="%i dpi PNGs in Figz/preview/ and no EPS" %preview_dpi)
+    parser.add_argument('--force', action='store_true', help="rebuild even if up to date")
+    parser.add_argument('--list', action='store_true', help="list stale figures and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        record = load_record()
+        for script in scripts():
+            code, data = inputs(script)
+            print('%-12s %-6s %s' %(os.path.basename(script)[:-3],
+                                    'stale' if stale(script, record, args.preview) else 'ok',
+                                    ' '.join(os.path.relpath(p, here) for p in code[1:] + data)))
+    else:
+        failed = build(args.figures, args.preview, args.processes, args.force)
+        if failed:
+            raise SystemExit('Failed: %s' %', '.join(failed))
@@ -0,0 +1,195 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    merge.py: merge the per-process output of 2D_HC.py and 3D_HC.py.
+
+    Dedalus writes each set of a file handler as one file per process,
+
+        snapshots/snapshots_s1/snapshots_s1_p0.h5, ..._p1.h5, ...
+
+    and this script joins them into snapshots/snapshots_s1.h5 with the
+    layout of dedalus.tools.post (tasks/, scales/), so the merged files
+    work with the Dedalus tools as well as with the analysis scripts.
+    Sets are merged in parallel worker processes. Each task is written as
+    a chunked, compressed dataset with one chunk per write (split along x
+    if a write is large), so reading a time slice or a single field only
+    touches the chunks it needs. Snapshots stored in reduced precision
+    (encoding.py) are merged as stored, with their encoding attributes,
+    and so are coefficient snapshots (coefficients.py), with the bases
+    recorded in the file attributes.
+
+    A set is first merged into snapshots_s1.h5.tmp and renamed when done;
+    tasks already merged into a .tmp file are kept, so an interrupted
+    merge resumes where it stopped:
+
+    $ python3 merge.py snapshots/
+    $ python3 merge.py snapshots/ 2d_averages/ diagnostics/ -n 8 --cleanup
+
+    Cesar Rocha et al.
+"""
+
+import argparse
+import glob
+import multiprocessing
+import os
+import re
+import shutil
+import time
+
+import h5py
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Target size of the chunks of merged datasets, and memory used to
+# assemble writes before they are compressed
+chunk_bytes = 2**22
+batch_bytes = 2**28
+
+
+def find_sets(base_path):
+    """ Unmerged sets in base_path, as (set directory, merged file). """
+    sets = []
+    name = os.path.basename(os.path.normpath(base_path))
+    for path in glob.glob(os.path.join(base_path, '%s_s*' %name)):
+        if os.path.isdir(path) and re.match(r'.*_s\d+$', path):
+            sets.append((path, path + '.h5'))
+    return sorted(sets, key=lambda s: int(s[0].rsplit('_s', 1)[1]))
+
+
+def process_files(set_path):
+    name = os.path.basename(os.path.normpath(set_path))
+    files = glob.glob(os.path.join(set_path, '%s_p*.h5' %name))
+    return sorted(files, key=lambda f: int(f.rsplit('_p', 1)[1][:-3]))
+
+
+def chunks(shape, itemsize):
+    """ One chunk per write, split along the first spatial axis until it
+        holds at most chunk_bytes. """
+    chunk = [1] + list(shape[1:])
+    while len(chunk) > 1 and chunk[1] > 1 and np.prod(chunk)*itemsize > chunk_bytes:
+        chunk[1] = (chunk[1] + 1)//2
+    return tuple(max(c, 1) for c in chunk)
+
+
+def copy_scales(source, target):
+    """ Copy the scales group, remaking dimension scales (their attached
+        datasets live in the process file and cannot be copied). """
+    for name, item in source.items():
+        if isinstance(item, h5py.Group):
+            copy_scales(item, target.create_group(name))
+            continue
+        dset = target.create_dataset(name, data=item[()])
+        for key, value in item.attrs.items():
+            if key not in ('CLASS', 'NAME', 'REFERENCE_LIST', 'DIMENSION_LIST'):
+                dset.attrs[key] = value
+        if item.is_scale:
+            dset.make_scale(name)
+
+
+def setup(joint, proc_path, compression):
+    """ Copy metadata and scales, and create the task datasets that do not
+        exist yet in the joint file. """
+    with h5py.File(proc_path, 'r') as proc:
+        for key, value in proc.attrs.items():
+            joint.attrs[key] = value
+        if 'scales' not in joint:
+            copy_scales(proc['scales'], joint.create_group('scales'))
+        tasks = joint.require_group('tasks')
+        for name, proc_dset in proc['tasks'].items():
+            if name in tasks:
+                continue
+            shape = (proc_dset.shape[0],) + tuple(proc_dset.attrs['global_shape'])
+            dset = tasks.create_dataset(name, shape=shape, dtype=proc_dset.dtype,
+                                        chunks=chunks(shape, proc_dset.dtype.itemsize)
+                                               if np.prod(shape) else None,
+                                        compression=compression,
+                                        shuffle=compression is not None)
+            for key, value in proc_dset.attrs.items():
+                if key not in ('global_shape', 'start', 'count', 'DIMENSION_LIST',
+                               'DIMENSION_LABELS'):
+                    dset.attrs[key] = value
+            for i, dim in enumerate(proc_dset.dims):
+                dset.dims[i].label = dim.label
+                for scalename in dim.keys():
+                    if scalename in joint['scales']:
+                        dset.dims[i].attach_scale(joint['scales'][scalename])
+
+
+def merge_set(set_path, merged_path, compression='gzip', cleanup=False):
+    """ Merge the process files of one set into merged_path. """
+    start = time.time()
+    files = process_files(set_path)
+    if not files:
+        return merged_path, 0.
+    tmp_path = merged_path + '.tmp'
+    with h5py.File(tmp_path, 'a') as joint:
+        setup(joint, files[0], compression)
+        for name, dset in joint['tasks'].items():
+            if dset.attrs.get('merged', False):
+                continue
+            # Assemble whole writes in memory, a batch at a time, so that
+            # every chunk is compressed and written once
+            size = max(np.prod(dset.shape[1:]) * dset.dtype.itemsize, 1)
+            batch = int(max(1, batch_bytes // size))
+            for t0 in range(0, dset.shape[0], batch):
+                t1 = min(t0 + batch, dset.shape[0])
+                data = np.zeros((t1 - t0,) + dset.shape[1:], dtype=dset.dtype)
+                for path in files:
+                    with h5py.File(path, 'r') as proc:
+                        proc_dset = proc['tasks'][name]
+                        if proc_dset.size:
+                            slices = tuple(slice(s, s+c) for s, c in
+                                           zip(proc_dset.attrs['start'], proc_dset.attrs['count']))
+                            data[(slice(None),) + slices] = proc_dset[t0:t1]
+                dset[t0:t1] = data
+            dset.attrs['merged'] = True
+        # The resume marks only concern the .tmp file
+        for dset in joint['tasks'].values():
+            del dset.attrs['merged']
+    os.replace(tmp_path, merged_path)
+    if cleanup:
+        shutil.rmtree(set_path)
+    return merged_path, time.time() - start
+
+
+def _merge_set(job):
+    return merge_set(*job)
+
+
+def merge(base_paths, processes=None, compression='gzip', cleanup=False):
+    """ Merge all unmerged sets of the file handlers in base_paths. """
+    jobs = []
+    for base_path in base_paths:
+        for set_path, merged_path in find_sets(base_path):
+            if os.path.exists(merged_path):
+                logger.info('Skipping %s (already merged)' %merged_path)
+                continue
+            jobs.append((set_path, merged_path, compression, cleanup))
+    # Largest sets first, so that the pool finishes evenly
+    jobs.sort(key=lambda job: -sum(os.path.getsize(f) for f in process_files(job[0])))
+    with multiprocessing.Pool(processes) as pool:
+        for merged_path, elapsed in pool.imap_unordered(_merge_set, jobs):
+            logger.info('Merged %s (%.1f sec)' %(merged_path, elapsed))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s :: %(message)s')
+    parser = argparse.ArgumentParser(description="Merge Dedalus process files.")
+    parser.add_argument('base_paths', nargs='+',
+                        help="file handler directories, e.g. snapshots/")
+    parser.add_argument('-n', '--processes', type=int, default=None,
+                        help="worker processes (default: number of cores)")
+    parser.add_argument('--compression', choices=['gzip', 'lzf', 'none'],
+                        default='gzip', help="compression filter (default %(default)s)")
+    parser.add_argument('--cleanup', action='store_true',
+                        help="delete the process files of merged sets")
+    args = parser.parse_args()
+    merge(args.base_paths, processes=args.processes,
+          compression=None if args.compression == 'none' else args.compression,
+          cleanup=args.cleanup)
@@ -0,0 +1,144 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    nusselt.py: in-run Nusselt number and equilibration detector.
+
+    The Nusselt number is the volume-averaged buoyancy variance dissipation
+    chi = P <|grad b|^2> normalized by its value for the purely diffusive
+    solution b = cos(2kx) cosh(2kz)/cosh(2kLz),
+
+        Nu = chi / chi_diff,    chi_diff = P k tanh(2k Lz) / Lz.
+
+    NusseltMonitor samples Nu in the main loop, keeps a trailing window of
+    simulation time and estimates its mean with an error bar corrected for
+    the autocorrelation of the samples. A run is equilibrated when the two
+    halves of the window agree (within their error bars or the tolerance)
+    and the error of the mean is below a relative tolerance; the run then
+    writes a checkpoint and stops:
+
+    $ mpiexec -n 24 python3 2D_HC.py --equilibrate 0.01
+
+    Cesar Rocha et al.
+"""
+
+import collections
+import json
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def chi_diffusive(P, k, Lz=1.):
+    """ Dissipation of buoyancy variance of the diffusive solution. """
+    return P * k * np.tanh(2*k*Lz) / Lz
+
+
+def integrated_time(x, c=5.):
+    """ Integrated autocorrelation time of the samples x, in samples,
+        with Sokal's self-consistent window (smallest M >= c*tau(M)). """
+    n = len(x)
+    if n < 2:
+        return 1.
+    y = np.asarray(x) - np.mean(x)
+    f = np.fft.rfft(y, n=2*n)
+    acf = np.fft.irfft(f * np.conj(f))[:n]
+    if acf[0] == 0:
+        return 1.
+    tau = 2*np.cumsum(acf/acf[0]) - 1
+    window = np.arange(n) >= c*tau
+    m = np.argmax(window) if window.any() else n-1
+    return max(tau[m], 1.)
+
+
+def mean_and_error(x, tau=None):
+    """ Mean of the samples x and its standard error, inflated by the
+        integrated autocorrelation time tau (in samples). """
+    n = len(x)
+    if tau is None:
+        tau = integrated_time(x)
+    return np.mean(x), np.std(x) * np.sqrt(tau/n) if n > 1 else np.inf
+
+
+class NusseltMonitor:
+    """ Streaming Nusselt number estimate and equilibration test.
+
+        Reads the volume average 'chi' of a flow_tools.GlobalFlowProperty
+        or a diagnostics.Diagnostics handler with the same cadence. Call
+        process() after each solver step; it returns True once Nu is
+        equilibrated to the relative tolerance `tol` (never if tol is
+        None). """
+
+    def __init__(self, solver, flow, chi_diff, window=1000., tol=None,
+                 cadence=10, check_dt=None, min_time=0., label=''):
+        self.solver = solver
+        self.label = label
+        self.flow = flow
+        self.chi_diff = chi_diff
+        self.window = window
+        self.tol = tol
+        self.cadence = cadence
+        self.check_dt = check_dt or window/10
+        self.min_time = min_time
+        self.samples = collections.deque()
+        self.next_check = solver.sim_time + self.check_dt
+        self.converged = False
+        self.stats = None
+
+    def process(self):
+        solver = self.solver
+        # The flow properties are evaluated at the start of the step
+        # following iterations that are multiples of the cadence
+        if (solver.iteration-1) % self.cadence != 0:
+            return self.converged
+        Nu = self.flow.volume_average('chi') / self.chi_diff
+        t = solver.sim_time
+        self.samples.append((t, Nu))
+        while self.samples[0][0] < t - self.window:
+            self.samples.popleft()
+        if t >= self.next_check and len(self.samples) > 1:
+            self.next_check = t + self.check_dt
+            self.stats = self.statistics()
+            logger.info('%sNu = %.4f +/- %.4f over t in [%.1f, %.1f] (tau = %.1f samples)'
+                        %(self.label, self.stats['Nu'], self.stats['error'], self.stats['t0'],
+                          self.stats['t1'], self.stats['tau']))
+            if self.tol is not None and self.equilibrated(self.stats):
+                logger.info('%sNu equilibrated to a relative error of %.2e'
+                            %(self.label, self.tol))
+                self.converged = True
+        return self.converged
+
+    def statistics(self):
+        """ Mean Nu over the window with error bars, and the means of the
+            two halves of the window (None before two samples). """
+        if len(self.samples) < 2:
+            return None
+        t, Nu = np.array(self.samples).T
+        tau = integrated_time(Nu)
+        half = len(Nu)//2
+        mean, error = mean_and_error(Nu, tau)
+        mean1, error1 = mean_and_error(Nu[:half], tau)
+        mean2, error2 = mean_and_error(Nu[half:], tau)
+        return dict(Nu=mean, error=error, tau=tau, n=len(Nu), t0=t[0], t1=t[-1],
+                    Nu_halves=[mean1, mean2], error_halves=[error1, error2])
+
+    def equilibrated(self, stats):
+        full = stats['t1'] - stats['t0'] >= 0.95*self.window
+        drift = abs(stats['Nu_halves'][1] - stats['Nu_halves'][0])
+        steady = drift <= max(2*np.hypot(*stats['error_halves']),
+                              self.tol * abs(stats['Nu']))
+        precise = stats['error'] <= self.tol * abs(stats['Nu'])
+        return full and steady and precise and stats['t1'] >= self.min_time
+
+    def write(self, path='nusselt.json'):
+        """ Write the latest estimate (rank 0 only). """
+        if self.solver.domain.dist.comm_cart.rank != 0 or len(self.samples) < 2:
+            return
+        stats = self.statistics()
+        stats.update(converged=self.converged, tol=self.tol, window=self.window)
+        with open(path, 'w') as f:
+            json.dump(stats, f, indent=1, default=float)
@@ -0,0 +1,216 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    options.py: command-line options shared by 2D_HC.py and 3D_HC.py.
+
+    The defaults reproduce the parameters of the original scripts, so
+    $ mpiexec -n 24 python3 2D_HC.py
+    runs the same case as before. Other cases are selected with, e.g.,
+    $ mpiexec -n 8 python3 2D_HC.py --Ra 1e8 --bc nostress --resolution 512 128
+
+    Cesar Rocha et al.
+"""
+
+import argparse
+
+import autotune
+
+# Communicator used to build the domain (None for MPI.COMM_WORLD).
+# sweep.py replaces it with a sub-communicator when several cases share
+# one mpiexec launch.
+comm = None
+
+# Defaults of the original 2D and 3D scripts
+defaults = {2: dict(Ra=1e9, Pr=1., bc='noslip', resolution=[1024, 256],
+                    stop_sim_time=18000.),
+            3: dict(Ra=1e7, Pr=1., bc='noslip', resolution=[256, 64, 64],
+                    stop_sim_time=2500.)}
+
+
+def parser(dim):
+    """ Argument parser for the dim-dimensional solver. """
+    d = defaults[dim]
+    p = argparse.ArgumentParser(description="%iD horizontal convection" %dim)
+    p.add_argument('--Ra', type=float, default=d['Ra'],
+                   help="Rayleigh number based on h (default %(default)g)")
+    p.add_argument('--Pr', type=float, default=d['Pr'],
+                   help="Prandtl number (default %(default)g)")
+    p.add_argument('--bc', choices=['noslip', 'nostress'], default=d['bc'],
+                   help="velocity boundary conditions (default %(default)s)")
+    p.add_argument('--resolution', type=int, nargs=dim, default=d['resolution'],
+                   metavar=('nx', 'nz') if dim == 2 else ('nx', 'ny', 'nz'),
+                   help="number of modes (default %s)"
+                   %' '.join(map(str, d['resolution'])))
+    p.add_argument('--z-layer', type=int, default=0, metavar='N',
+                   help="add N Chebyshev modes in a surface layer below z = Lz"
+                        " (a compound basis; nz then resolves the interior)")
+    p.add_argument('--z-layer-scale', type=float, default=8.,
+                   help="thickness of the surface layer in units of Ra^(-1/5)"
+                        " (default %(default)g)")
+    if dim == 3:
+        p.add_argument('--mesh', type=int, nargs=2, default=None, metavar=('p1', 'p2'),
+                       help="process mesh (default: the tuned one of autotune.py,"
+                            " if any, else Dedalus' 1D decomposition)")
+
+        # Process mesh and FFT planning (see autotune.py)
+        p.add_argument('--fft-rigor', choices=['estimate', 'measure', 'patient', 'exhaustive'],
+                       default=None,
+                       help="FFTW planning rigor (default: the tuned one, else Dedalus')")
+        p.add_argument('--fft-wisdom', metavar='DIR', default=None,
+                       help="write the FFTW wisdom of each rank to DIR at the end")
+        p.add_argument('--tuning-cache', metavar='PATH', default=None,
+                       help="cache of autotune.py (default %s)" %autotune.default_cache)
+        p.add_argument('--no-tuning', action='store_true',
+                       help="ignore the tuned mesh and FFT planning of autotune.py")
+    p.add_argument('--threads', type=int, default=None,
+                   help="threads per rank, for hybrid MPI + threads runs"
+                        " (default: the environment's; see threads.py)")
+    p.add_argument('--stop-sim-time', type=float, default=d['stop_sim_time'],
+                   help="simulation stop time (default %(default)g)")
+    p.add_argument('--stop-iteration', type=float, default=float('inf'),
+                   help="stop after so many iterations (e.g. for benchmarks)")
+    p.add_argument('--diagnostics', choices=['shared', 'dedalus'], default='shared',
+                   help="evaluate the diagnostics with the shared engine of"
+                        " diagnostics.py or as Dedalus tasks (default %(default)s)")
+
+    # Checkpoints and restarts (see checkpoint.py)
+    p.add_argument('--restart', metavar='PATH',
+                   help="restart from a checkpoint set, or from the latest"
+                        " complete set in a checkpoint directory")
+    p.add_argument('--checkpoint-dt', type=float, default=None,
+                   help="checkpoint every so many simulation time units")
+    p.add_argument('--checkpoint-wall-dt', type=float, default=1.,
+                   help="checkpoint every so many wall-clock hours"
+                        " (default %(default)g)")
+    p.add_argument('--stop-wall-time', type=float, default=float('inf'),
+                   help="wall-clock hours granted to the job; a checkpoint is"
+                        " written and the run stops shortly before")
+
+    # Continuation from another run (see continuation.py)
+    p.add_argument('--init', metavar='PATH',
+                   help="interpolate the initial state from a checkpoint or a"
+                        " merged snapshot file of another (e.g. coarser) run")
+    p.add_argument('--init-index', type=int, default=-1,
+                   help="snapshot write used by --init (default: last)")
+    p.add_argument('--init-noise', type=float, default=1e-3 if dim == 3 else 0.,
+                   help="amplitude of the perturbation added to b by --init"
+                        " (default %(default)g)")
+    p.add_argument('--init-noise-modes', type=float, nargs=2, default=None,
+                   metavar=('LO', 'HI'),
+                   help="band-limit the --init noise to the modes LO <= |m| <= HI"
+                        " (default: white noise; see randomfield.py)")
+    p.add_argument('--init-noise-slope', type=float, default=0.,
+                   help="spectral slope of band-limited noise (default %(default)g)")
+    p.add_argument('--init-time', action='store_true',
+                   help="continue from the time and iteration of the --init"
+                        " checkpoint (e.g. on a new grid, see resolution.py)")
+
+    # Nusselt number and equilibration (see nusselt.py)
+    p.add_argument('--equilibrate', type=float, default=None, metavar='TOL',
+                   help="stop once Nu is statistically stationary with a"
+                        " relative error below TOL")
+    p.add_argument('--equilibrate-window', type=float, default=1000.,
+                   help="simulation time window of the Nu statistics"
+                        " (default %(default)g)")
+
+    # Time-step control (see timestep.py)
+    p.add_argument('--dt-control', choices=['cfl', 'predictive'], default='cfl',
+                   help="flow_tools.CFL, or the predictive controller with"
+                        " adaptive reductions (default %(default)s)")
+    p.add_argument('--dt-tol', type=float, default=None,
+                   help="with --dt-control predictive, also limit dt by this"
+                        " tolerance of a temporal smoothness heuristic (the"
+                        " third time difference of b; not an error estimate)")
+
+    # Time averages (see averages.py)
+    p.add_argument('--averages', action='store_true',
+                   help="accumulate time means of b, u, w, bz, the surface flux F(x)"
+                        " and the lateral flux J(x), written to averages.h5")
+    p.add_argument('--averages-start', type=float, default=0.,
+                   help="simulation time the averages start at (default %(default)g)")
+    p.add_argument('--averages-cadence', type=int, default=10,
+                   help="iterations between samples (default %(default)i)")
+    p.add_argument('--averages-moments', action='store_true',
+                   help="also average b*b, u*u, w*w, u*b and w*b")
+
+    # Resolution adequacy (see resolution.py)
+    p.add_argument('--resolution-check', action='store_true',
+                   help="monitor the spectral tails of b and the velocity and recommend"
+                        " the cheapest adequate resolution")
+    p.add_argument('--resolution-tol', type=float, default=1e-6,
+                   help="largest relative amplitude of the spectral tails"
+                        " (default %(default)g)")
+    p.add_argument('--resolution-cadence', type=int, default=500,
+                   help="iterations between checks (default %(default)i)")
+    p.add_argument('--regrid', action='store_true',
+                   help="when under-resolved, write regrid.json, checkpoint and"
+                        " stop, to continue on the recommended grid")
+
+    # Asynchronous output (see output.py)
+    p.add_argument('--async-output', choices=['off', 'thread', 'process'], default='off',
+                   help="write the snapshots, averages and diagnostics in a"
+                        " background thread or writer process (default %(default)s)")
+    p.add_argument('--io-ranks', type=int, default=None, metavar='N',
+                   help="with --async-output, gather the output to N ranks"
+                        " (default: every rank)")
+    p.add_argument('--output-buffer', type=float, default=256.,
+                   help="MB of output queued per I/O rank before the solver"
+                        " waits for the writer (default %(default)g)")
+
+    # Snapshot encoding (see encoding.py)
+    p.add_argument('--snapshot-encoding', choices=['float64', 'float32', 'quantized'],
+                   default='float64',
+                   help="precision of the stored snapshots (default %(default)s)")
+    p.add_argument('--snapshot-tol', type=float, default=1e-5,
+                   help="absolute error bound of quantized snapshots"
+                        " (default %(default)g)")
+    p.add_argument('--snapshot-compression', choices=['none', 'gzip', 'lzf'],
+                   default='none',
+                   help="compression of the snapshot writes (default %(default)s)")
+    p.add_argument('--snapshot-space', choices=['grid', 'coeff'], default='grid',
+                   help="store the snapshots on the grid or as spectral"
+                        " coefficients (see coefficients.py; default %(default)s)")
+    p.add_argument('--coeff-fraction', type=float, default=1.,
+                   help="with --snapshot-space coeff, fraction of the x modes and"
+                        " z degrees stored (default %(default)g)")
+
+    # Run database (see rundb.py)
+    p.add_argument('--rundb', metavar='PATH', default=None,
+                   help="directory of the run database to stream the time"
+                        " series of Nu, ke, Re and b_bottom into")
+
+    # Instrumentation (see timing.py)
+    p.add_argument('--timing', action='store_true',
+                   help="time the parts of each step and write timing.jsonl"
+                        " and an end-of-run report")
+    return p
+
+
+def parse_args(dim, argv=None):
+    """ Parse the command line of the dim-dimensional solver. """
+    p = parser(dim)
+    args = p.parse_args(argv)
+    if args.snapshot_space == 'coeff' and args.snapshot_encoding == 'quantized':
+        p.error("coefficient snapshots cannot be quantized (use float32)")
+    if not 0 < args.coeff_fraction <= 1:
+        p.error("--coeff-fraction must be in (0, 1]")
+    return args
+
+
+def case_argv(case):
+    """ Command-line arguments reproducing a manifest case (see sweep.py). """
+    argv = ['--Ra', repr(float(case['Ra'])),
+            '--Pr', repr(float(case['Pr'])),
+            '--bc', case['bc'],
+            '--resolution'] + [str(int(n)) for n in case['resolution']]
+    argv += ['--stop-sim-time', repr(float(case['stop_sim_time']))]
+    if case.get('z_layer'):
+        argv += ['--z-layer', str(int(case['z_layer']))]
+    if case.get('regrid'):
+        argv += ['--resolution-check', '--regrid']
+    if case.get('rundb'):
+        argv += ['--rundb', case['rundb']]
+    return argv
@@ -0,0 +1,282 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    output.py: asynchronous output of snapshots and 2D averages.
+
+    A Dedalus file handler writes its tasks from solver.step on every
+    rank, so the step waits for the filesystem at every write. With
+    --async-output, AsyncFileHandler evaluates the same tasks at the same
+    cadence, copies the local data of each task and hands it on: the ranks
+    are split into --io-ranks groups of consecutive ranks, the first rank
+    of each group gathers the data of its group, and its background
+    writer (writer.py, a thread or a writer process) writes them while
+    the solver carries on. The data queued by an I/O rank are bounded by
+    --output-buffer MB; a write that does not fit waits for the writer
+    (backpressure), and the time lost waiting is reported at the end.
+
+    The files are those of a Dedalus file handler, sets of max_writes
+    writes in <name>/<name>_s<n>/<name>_s<n>_p<k>.h5, with one file per
+    I/O rank when the blocks of its group form a box (one per rank
+    otherwise), so merge.py, reader.py and the analysis scripts read them
+    as before. The diagnostics of diagnostics.py are written by the writer
+    of rank 0 as well.
+
+    The snapshot tasks may be stored in reduced precision or compressed
+    (see encoding.py), or as (truncated) spectral coefficients (see
+    coefficients.py); the handlers then write through an AsyncOutput even
+    without --async-output, synchronously. Each file records the bases of
+    the domain (attribute 'bases') and whether its tasks are on the grid
+    or coefficients (attribute 'space').
+
+    $ mpiexec -n 64 python3 3D_HC.py --async-output process --io-ranks 4
+    $ mpiexec -n 24 python3 2D_HC.py --async-output thread --output-buffer 512
+
+    Cesar Rocha et al.
+"""
+
+import atexit
+import glob
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from dedalus import public as de
+from dedalus.core.evaluator import DictionaryHandler
+
+import writer
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def describe(domain):
+    """ The bases of a domain, for reconstructions from coefficients
+        (see coefficients.py): type, size, interval and subbases. """
+    bases = []
+    for axis, basis in enumerate(domain.bases):
+        if isinstance(basis, de.Fourier):
+            kind = 'Fourier'
+        elif isinstance(basis, de.Compound):
+            kind = 'Compound'
+        else:
+            kind = 'Chebyshev'
+        description = dict(name=basis.name, type=kind, size=int(basis.base_grid_size),
+                           interval=list(map(float, basis.interval)),
+                           real=bool(kind == 'Fourier' and axis == 0))
+        if kind == 'Compound':
+            description['subbases'] = [dict(name=sub.name, type='Chebyshev',
+                                            size=int(sub.base_grid_size),
+                                            interval=list(map(float, sub.interval)))
+                                       for sub in basis.subbases]
+        bases.append(description)
+    return bases
+
+
+def box(blocks):
+    """ One block from blocks (global_shape, start, count, data, dtype)
+        of a task if together they fill a box, else None. """
+    starts = np.array([b[1] for b in blocks])
+    counts = np.array([b[2] for b in blocks])
+    lower, upper = starts.min(axis=0), (starts + counts).max(axis=0)
+    if np.prod(upper - lower) != np.sum(np.prod(counts, axis=1)):
+        return None
+    gshape, dtype = blocks[0][0], blocks[0][4]
+    data = np.zeros(upper - lower, dtype=dtype)
+    for _, start, count, block, _ in blocks:
+        data[tuple(slice(a, a+n) for a, n in zip(start - lower, count))] = block
+    return (gshape, lower, upper - lower, data, dtype)
+
+
+class AsyncOutput:
+    """ I/O groups of the ranks of a solver and the writers of their
+        first ranks (the I/O ranks).
+
+        io_ranks: number of I/O ranks (default: every rank writes its own
+                  file through its own writer)
+        max_bytes: largest size of the data queued by an I/O rank
+        mode: write in a writer 'process', in a 'thread', or synchronously
+              ('off', e.g. for encoded snapshots only) """
+
+    def __init__(self, solver, io_ranks=None, max_bytes=2**28, mode='process'):
+        self.solver = solver
+        self.comm = comm = solver.domain.dist.comm_cart
+        io_ranks = min(io_ranks or comm.size, comm.size)
+        size = -(-comm.size // io_ranks)
+        self.group = comm.Split(comm.rank // size, comm.rank)
+        self.members = self.group.allgather(comm.rank)
+        self.writer = None
+        if self.group.rank == 0:
+            self.writer = writer.Writer(max_bytes, mode)
+        self.handlers = []
+        atexit.register(self.close)
+
+    def add_file_handler(self, base_path, **kw):
+        handler = AsyncFileHandler(self.solver, self, base_path, **kw)
+        self.handlers.append(handler)
+        return handler
+
+    def write(self, path, meta, grids, tasks, labels, encoded=None, attrs=None):
+        """ Gather the blocks of the group (collective over the group) and
+            queue the files of the I/O rank. path(rank) is the file of a rank. """
+        gathered = self.group.gather(tasks, root=0)
+        if self.writer is None:
+            return
+        files = {}
+        for name in tasks:
+            blocks = [(rank, parts[name]) for rank, parts in zip(self.members, gathered)]
+            full = [block for rank, block in blocks if block[3] is not None]
+            joint = box(full) if full else None
+            if joint is not None:
+                files.setdefault(self.comm.rank, {})[name] = joint
+            else:
+                for rank, block in blocks:
+                    if block[3] is not None:
+                        files.setdefault(rank, {})[name] = block
+        if not files:
+            files[self.comm.rank] = {}
+        # Every file holds every task (empty where it has no data), as
+        # merge.py takes the tasks from the first file of a set
+        empty = {name: (block[0], np.zeros_like(block[1]), np.zeros_like(block[2]),
+                        None, block[4]) for name, block in tasks.items()}
+        for rank, parts in files.items():
+            parts = dict(empty, **parts)
+            nbytes = sum(p[3].nbytes for p in parts.values() if p[3] is not None)
+            self.writer.submit('append', path(rank), meta, grids, parts, labels, encoded,
+                               attrs, nbytes=nbytes)
+
+    def close(self):
+        """ Wait for the queued writes and report the time lost waiting. """
+        if self.writer is None or self.writer.closed:
+            return
+        self.writer.close()
+        stats = self.writer.stats
+        logger.info('Output: %i writes (%.1f MB) in the background; %i stalls on a full'
+                    ' buffer (%.2f sec), most queued %.1f MB'
+                    %(stats['writes'], stats['bytes']/2**20, stats['stalls'],
+                      stats['stall_time'], stats['max_queued']/2**20))
+
+
+class AsyncFileHandler(DictionaryHandler):
+    """ File handler whose writes are performed by an AsyncOutput; takes
+        the arguments of evaluator.add_file_handler, the encoding of its
+        tasks as encoded=(encoding, tol, compression) (encoding.py) and,
+        for tasks in coefficient space (layout='c'), the fraction
+        `truncate` of the x and (single-basis) z modes to keep. """
+
+    def __init__(self, solver, output, base_path, max_writes=np.inf, mode='overwrite',
+                 encoded=None, truncate=None, **kw):
+        domain = solver.domain
+        DictionaryHandler.__init__(self, domain, solver.evaluator.vars, **kw)
+        solver.evaluator.add_handler(self)
+        self.solver = solver
+        self.output = output
+        self.base_path = os.path.normpath(base_path)
+        self.name = os.path.basename(self.base_path)
+        self.max_writes = max_writes
+        self.encoded = encoded
+        self.truncate = truncate
+        self.labels = tuple(basis.name for basis in domain.bases)
+        self.attrs = dict(bases=json.dumps(describe(domain)))
+        comm = output.comm
+        num = None
+        if comm.rank == 0:
+            if mode == 'overwrite' and os.path.exists(self.base_path):
+                shutil.rmtree(self.base_path)
+            os.makedirs(self.base_path, exist_ok=True)
+            sets = glob.glob(os.path.join(self.base_path, '%s_s*' %self.name))
+            num = max([int(s.split('_s')[-1].split('.')[0]) for s in sets], default=0) + 1
+        self.set_num = comm.bcast(num, root=0)
+        self.set_writes = 0
+        self.write_num = 0
+        self.start_time = time.time()
+
+    def path(self, rank):
+        set_name = '%s_s%i' %(self.name, self.set_num)
+        return os.path.join(self.base_path, set_name, '%s_p%i.h5' %(set_name, rank))
+
+    def block(self, field):
+        """ Local data of a task as (global_shape, start, count, data,
+            dtype); axes of constant tasks (e.g. integrals) have size 1. """
+        domain = self.domain
+        layout = field.layout
+        scales = field.scales
+        gshape = np.array(layout.global_shape(scales=scales))
+        start = np.array([s.start for s in layout.slices(scales=scales)])
+        count = np.array(field.data.shape)
+        constant = np.array([field.meta[axis]['constant'] for axis in range(domain.dim)])
+        data = field.data
+        if constant.any():
+            if np.any(start[constant] != 0):
+                data = None
+            else:
+                data = data[tuple(slice(0, 1) if c else slice(None) for c in constant)]
+            gshape[constant] = 1
+            start[constant] = 0
+            count[constant] = 1
+        if self.truncate and layout is domain.dist.coeff_layout:
+            data = self.truncated(gshape, start, count, data, constant)
+        if data is not None and data.size == 0:
+            data = None
+        if data is not None:
+            data = np.copy(data)    # the task fields are reused
+        return (gshape, start, count, data, field.data.dtype)
+
+    def truncated_axes(self):
+        """ Axes whose modes are ordered by wavenumber or degree: x (the
+            real Fourier axis) and z unless it is a compound basis. """
+        bases = self.domain.bases
+        axes = [0] if isinstance(bases[0], de.Fourier) else []
+        if isinstance(bases[-1], de.Chebyshev):
+            axes.append(len(bases) - 1)
+        return axes
+
+    def truncated(self, gshape, start, count, data, constant):
+        """ Keep the first truncate*n modes along the truncated axes
+            (gshape and count are updated in place). """
+        for axis in self.truncated_axes():
+            if constant[axis]:
+                continue
+            gshape[axis] = int(np.ceil(self.truncate * gshape[axis]))
+            count[axis] = max(min(count[axis], gshape[axis] - start[axis]), 0)
+            if data is not None:
+                data = data[(slice(None),)*axis + (slice(0, count[axis]),)]
+        return data
+
+    def process(self, **kw):
+        DictionaryHandler.process(self, **kw)
+        if self.set_writes >= self.max_writes:
+            self.set_num += 1
+            self.set_writes = 0
+        self.set_writes += 1
+        self.write_num += 1
+        tasks = {name: self.block(field) for name, field in self.fields.items()}
+        meta = dict(sim_time=float(kw.get('sim_time', self.solver.sim_time)),
+                    wall_time=time.time() - self.start_time,
+                    world_time=time.time(),
+                    iteration=int(kw.get('iteration', self.solver.iteration)),
+                    timestep=float(kw.get('timestep', np.nan)),
+                    write_number=self.write_num)
+        grids = {}
+        for name, field in self.fields.items():
+            for basis, scale in zip(self.domain.bases, field.scales):
+                grids.setdefault(basis.name, {})[str(float(scale))] = basis.grid(scale)
+        attrs = dict(self.attrs, space='coeff' if any(
+            field.layout is self.domain.dist.coeff_layout for field in self.fields.values())
+            else 'grid')
+        self.output.write(self.path, meta, grids, tasks, self.labels, self.encoded, attrs)
+
+
+def file_handler(solver, output, base_path, encoded=None, truncate=None, **kw):
+    """ Dedalus file handler, or an asynchronous one with an AsyncOutput
+        (needed for encoded or truncated tasks). """
+    if output is None:
+        if encoded or truncate:
+            raise ValueError("Encoded or truncated output needs an AsyncOutput")
+        return solver.evaluator.add_file_handler(base_path, **kw)
+    return output.add_file_handler(base_path, encoded=encoded, truncate=truncate, **kw)
@@ -0,0 +1,290 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    problems.py: domains and problems of the 2D and 3D solvers.
+
+    A Config (dim, bc, Ra, Pr, resolution, dealias, layer) defines the
+    operator of a run. Domains (transform plans and transposes) are
+    cached by resolution and communicator, so that cases run one after
+    another in the same process (sweep.py --mpi) do not rebuild them.
+    Ra and Pr enter the pencil matrices, so the last initial value solver
+    is kept for its full Config, communicator and timestepper only: a
+    case repeating the previous one (e.g. with another initial noise)
+    reuses its factored matrices, any other case replaces it. A solver is
+    reset to a motionless state at t = 0 to be reused (also by steady.py);
+    the Runge-Kutta and first-order timesteppers carry no history between
+    steps. Newton solvers are not kept, as Newton iterates on their state.
+
+    The steady 2D states solve the nonlinear BVP of boussinesq_steady.
+    Many 2D cases on the same grid can also be one problem, whose pencils
+    hold the equations of all cases (boussinesq_ensemble, ensemble.py).
+
+    The vertical basis is a single Chebyshev basis on (0, Lz), or, with a
+    surface layer (--z-layer N), a compound basis that adds N modes in a
+    layer of thickness 8 Ra^(-1/5) below z = Lz, where the surface
+    boundary layer (of thickness ~ Ra^(-1/5)) carries the heat flux; nz
+    modes then cover the coarser interior, so the boundary layer is
+    resolved without refining the whole column.
+
+    Cesar Rocha et al.
+"""
+
+import collections
+import re
+import time
+
+import numpy as np
+
+from dedalus import public as de
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Size of the domain, x in (0, Lx), y in (0, Ly), z in (0, Lz)
+Lx, Ly, Lz = (4., 1., 1.)
+
+# Variables of the 2D problem
+variables_2d = ['p','b','u','w','bz','uz','wz','bx']
+
+Config = collections.namedtuple('Config', ['dim', 'bc', 'Ra', 'Pr', 'resolution', 'dealias',
+                                           'layer'])
+Config.__new__.__defaults__ = (3/2, None)
+
+domains = {}
+
+# Last initial value solver built, by Config, communicator, mesh and
+# timestepper (it holds the pencil matrices)
+solvers = {}
+
+
+def config(args, dim):
+    """ Config of the command-line options of options.py. """
+    layer = None
+    if args.z_layer:
+        layer = (args.z_layer, layer_thickness(args.Ra, args.z_layer_scale))
+    return Config(dim, args.bc, args.Ra, args.Pr, tuple(args.resolution), layer=layer)
+
+
+def layer_thickness(Ra, scale=8.):
+    """ Thickness of the surface layer of the compound vertical basis,
+        scale * Ra^(-1/5) (a few boundary-layer thicknesses). """
+    return float(np.clip(scale * Ra**(-1/5), 0.01, 0.5) * Lz)
+
+
+def z_basis(nz, dealias=3/2, layer=None):
+    """ Chebyshev basis on (0, Lz), or with layer = (n, thickness) a
+        compound basis of nz modes on (0, Lz - thickness) and n modes in
+        the surface layer (Lz - thickness, Lz). """
+    if layer is None:
+        return de.Chebyshev('z', nz, interval=(0, Lz), dealias=dealias)
+    n, thickness = layer
+    interior = de.Chebyshev('z1', nz, interval=(0, Lz - thickness), dealias=dealias)
+    surface = de.Chebyshev('z2', n, interval=(Lz - thickness, Lz), dealias=dealias)
+    return de.Compound('z', (interior, surface), dealias=dealias)
+
+
+def diffusivities(Ra, Pr):
+    """ Nondimensional diffusivity P and viscosity R. """
+    return (Ra * Pr)**(-1/2), (Ra / Pr)**(-1/2)
+
+
+def comm_key(comm):
+    return None if comm is None else comm.py2f()
+
+
+def build_domain(resolution, dealias=3/2, comm=None, mesh=None, layer=None):
+    """ Fourier(-Fourier)-Chebyshev domain of the given resolution, with
+        an optional surface layer (see z_basis). """
+    key = (tuple(resolution), dealias, comm_key(comm), None if mesh is None else tuple(mesh),
+           layer)
+    if key not in domains:
+        if len(resolution) == 2:
+            nx, nz = resolution
+            x_basis = de.Fourier('x', nx, interval=(0, Lx), dealias=dealias)
+            bases = [x_basis, z_basis(nz, dealias, layer)]
+        else:
+            nx, ny, nz = resolution
+            x_basis = de.Fourier('x', nx, interval=(0, Lx), dealias=dealias)
+            y_basis = de.Fourier('y', ny, interval=(0, Ly), dealias=dealias)
+            bases = [x_basis, y_basis, z_basis(nz, dealias, layer)]
+        domains[key] = de.Domain(bases, grid_dtype=np.float64, comm=comm, mesh=mesh)
+    return domains[key]
+
+
+def equations_2d(problem, bc='noslip', suffix='', steady=False):
+    """ Add the 2D Boussinesq equations and boundary conditions to
+        `problem`, with the variables and P and R named with `suffix`
+        (e.g. b_3, P_3 for the cases of an ensemble), and without the time
+        derivatives if steady. """
+    def s(expression):
+        if steady:
+            expression = re.sub(r'dt\(\w+\)\s*', '', expression)
+        return re.sub(r'\b(%s)\b' %'|'.join(variables_2d + ['P', 'R']),
+                      r'\g<1>' + suffix, expression)
+    problem.add_equation(s("dx(u) + wz = 0"))
+    problem.add_equation(s("dt(b) - P*(dx(dx(b)) + dz(bz))             = -(u*dx(b) + w*bz)"))
+    problem.add_equation(s("dt(u) - R*(dx(dx(u)) + dz(uz)) + dx(p)     = -(u*dx(u) + w*uz)"))
+    problem.add_equation(s("dt(w) - R*(dx(dx(w)) + dz(wz)) + dz(p) - b = -(u*dx(w) + w*wz)"))
+    problem.add_equation(s("bz - dz(b) = 0"))
+    problem.add_equation(s("bx - dx(b) = 0"))
+    problem.add_equation(s("uz - dz(u) = 0"))
+    problem.add_equation(s("wz - dz(w) = 0"))
+    problem.add_bc(s("left(bz) = 0"))
+    if bc == 'noslip':
+        problem.add_bc(s("left(u) = 0"))
+    else:
+        problem.add_bc(s("left(uz) = 0"))
+    problem.add_bc(s("left(w) = 0"))
+    if bc == 'noslip':
+        problem.add_bc(s("right(u) = 0"))
+    else:
+        problem.add_bc(s("right(uz) = 0"))
+    problem.add_bc(s("right(b) = cos(2*k*x)"))
+    problem.add_bc(s("right(w) = 0"), condition="(nx != 0)")
+    problem.add_bc(s("right(p) = 0"), condition="(nx == 0)")
+
+
+def boussinesq(domain, bc='noslip', Ra=1e9, Pr=1.):
+    """ Boussinesq equations with the surface buoyancy cos(2kx), on a 2D
+        or 3D domain, with no-slip or no-stress walls. """
+    dim = len(domain.bases)
+    k = np.pi/Lx
+    P, R = diffusivities(Ra, Pr)
+    # Dirichlet preconditioning applies to a single Chebyshev basis
+    dirichlet = isinstance(domain.bases[-1], de.Chebyshev)
+    if dim == 2:
+        # Non-dimensional 2D Boussinesq hydrodynamics
+        problem = de.IVP(domain, variables=variables_2d)
+        if dirichlet:
+            problem.meta['p','b','u','w']['z']['dirichlet'] = True
+        problem.parameters['P'] = P
+        problem.parameters['R'] = R
+        problem.parameters['k'] = k
+        equations_2d(problem, bc)
+    else:
+        # Nondimensional 3D Boussinesq hydrodynamics
+        problem = de.IVP(domain, variables=['p','b','u','v','w','bz','uz','wz','vz','bx','by'])
+        if dirichlet:
+            problem.meta['p','b','u','w','v']['z']['dirichlet'] = True
+        problem.parameters['P'] = P
+        problem.parameters['R'] = R
+        problem.parameters['k'] = k
+        problem.add_equation("dx(u) + dy(v) + wz = 0")
+        problem.add_equation("dt(b) - P*(dx(dx(b)) + dy(dy(b)) + dz(bz))             = -(u*dx(b) + v*dy(b) + w*bz)")
+        problem.add_equation("dt(u) - R*(dx(dx(u)) + dy(dy(u)) + dz(uz)) + dx(p)     = -(u*dx(u) + v*dy(u) + w*uz)")
+        problem.add_equation("dt(v) - R*(dx(dx(v)) + dy(dy(v)) + dz(vz)) + dy(p)     = -(u*dx(v) + v*dy(v) + w*vz)")
+        problem.add_equation("dt(w) - R*(dx(dx(w)) + dy(dy(w)) + dz(wz)) + dz(p) - b = -(u*dx(w) + v*dy(w) + w*wz)")
+        problem.add_equation("bx - dx(b) = 0")
+        problem.add_equation("by - dy(b) = 0")
+        problem.add_equation("bz - dz(b) = 0")
+        problem.add_equation("uz - dz(u) = 0")
+        problem.add_equation("wz - dz(w) = 0")
+        problem.add_equation("vz - dz(v) = 0")
+        problem.add_bc("left(bz) = 0")
+        if bc == 'noslip':
+            problem.add_bc("left(u) = 0")
+            problem.add_bc("left(v) = 0")
+        else:
+            problem.add_bc("left(uz) = 0")
+            problem.add_bc("left(vz) = 0")
+        problem.add_bc("left(w) = 0")
+        problem.add_bc("right(b) = cos(2*k*x)")
+        if bc == 'noslip':
+            problem.add_bc("right(u) = 0")
+            problem.add_bc("right(v) = 0")
+        else:
+            problem.add_bc("right(uz) = 0")
+            problem.add_bc("right(vz) = 0")
+        problem.add_bc("right(w) = 0", condition="(nx !=0)")
+        problem.add_bc("right(p) = 0", condition="(nx == 0)")
+    return problem
+
+
+def boussinesq_steady(domain, bc='noslip', Ra=1e9, Pr=1.):
+    """ Steady 2D Boussinesq equations, a nonlinear BVP (see steady.py). """
+    problem = de.NLBVP(domain, variables=variables_2d)
+    if isinstance(domain.bases[-1], de.Chebyshev):
+        problem.meta['p','b','u','w']['z']['dirichlet'] = True
+    P, R = diffusivities(Ra, Pr)
+    problem.parameters['P'] = P
+    problem.parameters['R'] = R
+    problem.parameters['k'] = np.pi/Lx
+    equations_2d(problem, bc, steady=True)
+    return problem
+
+
+def nlbvp_solver(config, comm=None):
+    """ Newton solver of the steady problem of a 2D config. """
+    domain = build_domain(config.resolution, config.dealias, comm, layer=config.layer)
+    solver = boussinesq_steady(domain, config.bc, config.Ra, config.Pr).build_solver()
+    logger.info('Solver built')
+    return solver
+
+
+def boussinesq_ensemble(domain, configs):
+    """ Independent 2D Boussinesq problems of the configs (any bc, Ra and
+        Pr) on one domain, as a single problem: the variables of case i
+        are p_i, b_i, ..., so each pencil holds all cases and is factored
+        and solved at once. """
+    problem = de.IVP(domain, variables=['%s_%i' %(v, i) for i in range(len(configs))
+                                        for v in variables_2d])
+    for i, config in enumerate(configs):
+        if isinstance(domain.bases[-1], de.Chebyshev):
+            problem.meta[tuple('%s_%i' %(v, i) for v in 'pbuw')]['z']['dirichlet'] = True
+        P, R = diffusivities(config.Ra, config.Pr)
+        problem.parameters['P_%i' %i] = P
+        problem.parameters['R_%i' %i] = R
+    problem.parameters['k'] = np.pi/Lx
+    for i, config in enumerate(configs):
+        equations_2d(problem, config.bc, suffix='_%i' %i)
+    return problem
+
+
+def reset(solver):
+    """ Zero state at t = 0, without the handlers of a previous run. """
+    evaluator = solver.evaluator
+    evaluator.handlers = [h for h in evaluator.handlers if h.group == 'F']
+    for group in list(evaluator.groups):
+        if group != 'F':
+            del evaluator.groups[group]
+    for field in solver.state.fields:
+        field['c'] = 0.
+    solver.sim_time = solver.initial_sim_time = 0.
+    solver.iteration = solver.initial_iteration = 0
+    solver.stop_sim_time = solver.stop_wall_time = solver.stop_iteration = np.inf
+    solver.start_time = time.time()
+    return solver
+
+
+def ivp_solver(config, comm=None, mesh=None, timestepper='RK443'):
+    """ Initial value solver of the Boussinesq problem of `config`, on the
+        cached domain of its resolution; the previous solver, reset, if it
+        was built for the same config. """
+    key = (config._replace(resolution=tuple(config.resolution)), comm_key(comm),
+           None if mesh is None else tuple(mesh), timestepper)
+    if key in solvers:
+        logger.info('Reusing solver of %s' %(config,))
+        return reset(solvers[key])
+    # Release the previous solver before building the next one
+    solvers.clear()
+    domain = build_domain(config.resolution, config.dealias, comm, mesh, config.layer)
+    problem = boussinesq(domain, config.bc, config.Ra, config.Pr)
+    solver = problem.build_solver(getattr(de.timesteppers, timestepper))
+    logger.info('Solver built')
+    solvers[key] = solver
+    return solver
+
+
+def ensemble_solver(configs, comm=None, timestepper='RK443'):
+    """ Initial value solver of an ensemble of 2D configs sharing their
+        resolution (see boussinesq_ensemble and ensemble.py). """
+    config = configs[0]
+    domain = build_domain(config.resolution, config.dealias, comm)
+    problem = boussinesq_ensemble(domain, configs)
+    solver = problem.build_solver(getattr(de.timesteppers, timestepper))
+    logger.info('Solver of an ensemble of %i cases built' %len(configs))
+    return solver
+
@@ -0,0 +1,126 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    randomfield.py: random initial perturbations generated blockwise.
+
+    Drawing rand.standard_normal(gshape)[slices] makes every rank fill the
+    whole global grid to keep its own block. Here the random numbers are
+    counter-based: the value at a global grid point (or coefficient) is a
+    hash of its flat global index and the seed (the SplitMix64 mixing
+    function, two streams per point for Box-Muller normals), so each rank
+    computes only its local block, in O(local size), and the global field
+    is the same for any number of ranks and any process mesh.
+
+        white(domain, seed)     white noise on the grid
+        spectral(domain, seed, modes=(lo, hi), slope)
+                                band-limited noise: random coefficients of
+                                the modes with lo <= |m| <= hi (|m| the
+                                length of the vector of Fourier wavenumbers
+                                and Chebyshev degrees, in mode numbers),
+                                with amplitudes |m|^slope, normalized to
+                                unit rms on the grid
+
+    Both return the local grid block (scales 1) and serve 2D and 3D
+    domains alike; continuation.py uses them for --init-noise (with
+    --init-noise-modes for band-limited noise).
+
+    Cesar Rocha et al.
+"""
+
+import numpy as np
+from mpi4py import MPI
+
+from dedalus import public as de
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def mix(x):
+    """ SplitMix64 finalizer of uint64 x (wrapping arithmetic). """
+    with np.errstate(over='ignore'):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def uniform(index, seed=0, stream=0):
+    """ Uniform numbers in (0, 1) at the integer counters `index`. """
+    with np.errstate(over='ignore'):
+        key = mix(np.uint64(seed) * np.uint64(0x9e3779b97f4a7c15) + np.uint64(stream))
+        bits = mix(np.asarray(index, dtype=np.uint64) * np.uint64(0x9e3779b97f4a7c15) ^ key)
+    return ((bits >> np.uint64(11)).astype(float) + 0.5) * 2.**-53
+
+
+def standard_normal(index, seed=0, stream=0):
+    """ Standard normal numbers at the counters `index` (Box-Muller on two
+        streams per counter). """
+    u1 = uniform(index, seed, 2*stream)
+    u2 = uniform(index, seed, 2*stream + 1)
+    return np.sqrt(-2*np.log(u1)) * np.cos(2*np.pi*u2)
+
+
+def block_index(gshape, slices):
+    """ Flat (C-order) global indices of the block `slices` of an array of
+        shape gshape. """
+    ranges = [np.arange(s.start, s.stop, dtype=np.uint64) for s in slices]
+    index = np.zeros(tuple(len(r) for r in ranges), dtype=np.uint64)
+    stride = 1
+    for axis in reversed(range(len(gshape))):
+        shape = [1]*len(gshape)
+        shape[axis] = -1
+        index += ranges[axis].reshape(shape) * np.uint64(stride)
+        stride *= int(gshape[axis])
+    return index
+
+
+def white(domain, seed=42, scales=1):
+    """ Local block of white noise on the grid, the same for any
+        decomposition. """
+    layout = domain.dist.grid_layout
+    index = block_index(layout.global_shape(scales=scales), layout.slices(scales=scales))
+    return standard_normal(index, seed)
+
+
+def mode_numbers(domain):
+    """ Local |m| of the coefficients (length of the vector of Fourier
+        mode numbers and Chebyshev degrees). """
+    slices = domain.dist.coeff_layout.slices(scales=1)
+    m2 = 0.
+    for axis, basis in enumerate(domain.bases):
+        shape = [1]*domain.dim
+        shape[axis] = -1
+        if isinstance(basis, de.Fourier):
+            a, b = basis.interval
+            m = np.abs(np.ravel(domain.elements(axis))) * (b - a)/(2*np.pi)
+        else:
+            m = np.arange(slices[axis].start, slices[axis].stop)
+        m2 = m2 + m.reshape(shape)**2
+    return np.sqrt(m2)
+
+
+def spectral(domain, seed=42, modes=(1, 16), slope=0., scales=1):
+    """ Local block of band-limited noise on the grid, with unit rms; the
+        same for any decomposition. """
+    layout = domain.dist.coeff_layout
+    index = block_index(layout.global_shape(scales=1), layout.slices(scales=1))
+    m = mode_numbers(domain)
+    lo, hi = modes
+    band = (m >= lo) & (m <= hi)
+    amplitude = np.where(band, np.maximum(m, 1)**slope, 0.)
+    field = domain.new_field()
+    field['c'] = amplitude * (standard_normal(index, seed, 0) +
+                              1j*standard_normal(index, seed, 1))
+    field.set_scales(scales)
+    data = np.copy(field['g'])
+    layout = domain.dist.grid_layout
+    size = np.prod(layout.global_shape(scales=scales))
+    sums = np.array([np.sum(data**2)])
+    domain.dist.comm_cart.Allreduce(MPI.IN_PLACE, sums, op=MPI.SUM)
+    if sums[0] == 0:
+        logger.warning('No modes with %g <= |m| <= %g; no noise' %(lo, hi))
+        return data
+    return data / np.sqrt(sums[0]/size)
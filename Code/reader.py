@@ -0,0 +1,210 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    reader.py: lazy, memory-bounded reader of merged snapshot files.
+
+    Snapshots opens one or more merged files (merge.py), or a file of plain
+    datasets such as Data/snapshot-3D-noslip-Ra3p2e11.h5, and exposes each
+    field as a lazy array with named axes (t, x, y, z). Nothing is read
+    until the field is sliced or reduced. Reductions (means over t, x and/or
+    y, and surface slices) stream over blocks of at most block_bytes,
+    aligned with the chunks written by merge.py, so peak memory does not
+    depend on the size of the file. Results can be written to any array
+    supporting slice assignment (e.g. np.memmap or an h5py dataset) when
+    they do not fit in memory either. Snapshots stored in reduced precision
+    (encoding.py) are decoded to float64 as they are read:
+
+        snaps = reader.Snapshots(sorted(glob.glob('snapshots/snapshots_s*.h5')))
+        b_ymean = snaps['b'].mean('y')            # (t, x, z)
+        b_bar = snaps['b'].mean(('t', 'y'))       # (x, z)
+        b_surface = snaps['b'].surface()          # (t, x, y)
+
+    Cesar Rocha et al.
+"""
+
+import h5py
+import numpy as np
+
+import encoding
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Memory used by one block of a streaming reduction
+block_bytes = 2**27
+
+
+def spatial_axes(ndim):
+    return ('x', 'z') if ndim == 2 else ('x', 'y', 'z')
+
+
+class Field:
+    """ Lazy field made of one dataset per file, joined along t (or a
+        single dataset without a time axis). """
+
+    def __init__(self, datasets, axes):
+        self.datasets = datasets
+        self.axes = tuple(axes)
+        shape = datasets[0].shape
+        if 't' in self.axes:
+            shape = (sum(d.shape[0] for d in datasets),) + shape[1:]
+        self.shape = shape
+        self.ndim = len(shape)
+        self.dtype = encoding.decoded_dtype(datasets[0])
+
+    def __repr__(self):
+        return '<Field %s %s>' %(dict(zip(self.axes, self.shape)), self.dtype)
+
+    def __getitem__(self, key):
+        """ Read a hyperslab, e.g. field[10:20, :, 0]; slices in time may
+            span several files. """
+        if 't' not in self.axes:
+            return encoding.read(self.datasets[0], key)
+        key = key if isinstance(key, tuple) else (key,)
+        t, rest = key[0], key[1:]
+        if isinstance(t, (int, np.integer)):
+            t = t % self.shape[0]
+            for d in self.datasets:
+                if t < d.shape[0]:
+                    return encoding.read(d, (t,) + rest)
+                t -= d.shape[0]
+        start, stop, step = t.indices(self.shape[0])
+        if step != 1:
+            return self[start:stop][(slice(None, None, step),) + rest]
+        parts = []
+        for t0, d in zip(self.offsets(), self.datasets):
+            a, b = max(start - t0, 0), min(stop - t0, d.shape[0])
+            if a < b:
+                parts.append(encoding.read(d, (slice(a, b),) + rest))
+        if not parts:
+            return np.zeros((0,) + self.datasets[0][(slice(0, 0),) + rest].shape[1:], self.dtype)
+        return np.concatenate(parts)
+
+    def offsets(self):
+        return np.cumsum([0] + [d.shape[0] for d in self.datasets])[:-1]
+
+    def axis(self, name):
+        if name not in self.axes:
+            raise ValueError("Field has no axis %r (axes %s)" %(name, self.axes))
+        return self.axes.index(name)
+
+    def blocks(self):
+        """ Index tuples of blocks of at most block_bytes, in whole writes
+            if possible and otherwise split along the first spatial axis
+            in multiples of the chunk size. """
+        lead = 1 if 't' in self.axes else 0
+        write = self.shape[lead:]
+        size = max(np.prod(write) * self.dtype.itemsize, 1)
+        nt = self.shape[0] if lead else 1
+        if size <= block_bytes:
+            step = max(1, int(block_bytes // size))
+            chunk = self.datasets[0].chunks
+            if lead and chunk:
+                step = max(chunk[0], step - step % chunk[0])
+            for t0 in range(0, nt, step):
+                yield (slice(t0, min(t0 + step, nt)),) if lead else ()
+            return
+        nx = write[0]
+        step = max(1, int(block_bytes // (size/nx)))
+        chunk = self.datasets[0].chunks
+        if chunk and chunk[lead] < step:
+            step -= step % chunk[lead]
+        for t in range(nt):
+            for x0 in range(0, nx, step):
+                yield ((slice(t, t+1),) if lead else ()) + (slice(x0, min(x0 + step, nx)),)
+
+    def mean(self, axes, out=None):
+        """ Mean over the named axes among t, x and y, streamed over blocks;
+            the means over x and y are exact on the Fourier grid. """
+        axes = (axes,) if isinstance(axes, str) else tuple(axes)
+        if 'z' in axes:
+            raise ValueError("Means over the Chebyshev direction need quadrature"
+                             " weights; average over t, x or y")
+        reduced = tuple(self.axis(a) for a in axes)
+        kept = [i for i in range(self.ndim) if i not in reduced]
+        if out is None:
+            out = np.zeros(tuple(self.shape[i] for i in kept))
+        count = np.prod([self.shape[i] for i in reduced])
+        zeroed = False
+        for block in self.blocks():
+            partial = self[block].sum(axis=reduced) / count
+            position = tuple(block[i] if i < len(block) else slice(None) for i in kept)
+            if any(i < len(block) for i in reduced):
+                # Blocks are summed over a reduced axis
+                if not zeroed:
+                    out[...] = 0
+                    zeroed = True
+                out[position] += partial
+            else:
+                out[position] = partial
+        return out
+
+    def surface(self, index=-1, out=None):
+        """ Slice at the z index `index` (the top, z = Lz, by default). """
+        z = self.axis('z')
+        shape = self.shape[:z] + self.shape[z+1:]
+        if out is None:
+            out = np.zeros(shape, dtype=self.dtype)
+        lead = 1 if 't' in self.axes else 0
+        nt = self.shape[0] if lead else 1
+        size = max(np.prod(shape[lead:]) * self.dtype.itemsize, 1)
+        step = max(1, int(block_bytes // size))
+        for t0 in range(0, nt, step):
+            block = (slice(t0, min(t0 + step, nt)),) if lead else ()
+            out[block] = self[block + (Ellipsis, index)]
+        return out
+
+
+class Snapshots:
+    """ Fields and grids of merged snapshot files, joined along t. """
+
+    def __init__(self, paths):
+        paths = [paths] if isinstance(paths, str) else list(paths)
+        self.files = [h5py.File(path, 'r') for path in paths]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for file in self.files:
+            file.close()
+
+    def tasks(self, file):
+        return file['tasks'] if 'tasks' in file else file
+
+    def __contains__(self, name):
+        return name in self.tasks(self.files[0])
+
+    def __getitem__(self, name):
+        datasets = [self.tasks(file)[name] for file in self.files]
+        d = datasets[0]
+        labels = tuple(dim.label for dim in d.dims)
+        if all(labels) and set(labels) <= {'t', 'x', 'y', 'z'}:
+            axes = labels
+        elif 'tasks' in self.files[0]:
+            axes = ('t',) + spatial_axes(d.ndim - 1)
+        else:
+            axes = spatial_axes(d.ndim)
+        return Field(datasets if 't' in axes else datasets[:1], axes)
+
+    def grid(self, name):
+        """ Grid of the axis `name` (x, y or z) at scale 1, or sim_time. """
+        file = self.files[0]
+        if 'scales' in file and name in file['scales']:
+            item = file['scales'][name]
+            if isinstance(item, h5py.Group):
+                item = item['1.0'] if '1.0' in item else list(item.values())[0]
+            if name in ('sim_time', 'write_number', 'iteration'):
+                return np.concatenate([f['scales'][name][:] for f in self.files])
+            return item[:]
+        return file[name][:]
+
+    @property
+    def sim_time(self):
+        return self.grid('sim_time')
@@ -0,0 +1,206 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    resolution.py: resolution adequacy from the spectral tails.
+
+    Every `cadence` iterations, SpectralMonitor takes the envelope of the
+    Fourier and Chebyshev coefficients of b, u, (v,) and w along each axis
+    (the maximum modulus of each mode over the other axes), reduced across
+    ranks in one Allreduce. A run is under-resolved when, along some axis, the
+    last `tail` fraction of the modes of a field is above `tol` times its
+    largest coefficient. The resolution needed along an axis is the number
+    of modes where the envelope falls below `tol` (extrapolated from the
+    decay of the upper half of the spectrum if it never does), with the
+    tail fraction added and rounded up to 2^n or 3*2^n; the largest needed
+    over the run is the recommendation, which may also be coarser than the
+    run's. With a surface layer (problems.z_basis) each subbasis of z gets
+    its own recommendation.
+
+    $ mpiexec -n 24 python3 2D_HC.py --Ra 1e10 --resolution-check
+    $ mpiexec -n 24 python3 2D_HC.py --Ra 1e10 --resolution-check --regrid
+
+    With --regrid, a run that stays under-resolved over `patience` checks
+    writes regrid.json with the recommended resolution, checkpoints and
+    stops; it continues on the new grid with
+    $ mpiexec -n 24 python3 2D_HC.py --resolution nx nz --init checkpoints --init-time
+    which sweep.py does by itself. The recommendations and the last
+    spectra are written to resolution.json at the end of a run.
+
+    Cesar Rocha et al.
+"""
+
+import json
+
+import numpy as np
+from mpi4py import MPI
+
+from dedalus import public as de
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def nice_size(n, minimum=8):
+    """ Smallest 2^k or 3*2^k not below n. """
+    n = max(int(np.ceil(n)), minimum)
+    k = int(np.ceil(np.log2(n)))
+    return 3*2**(k-2) if k >= 2 and 3*2**(k-2) >= n else 2**k
+
+
+def needed_modes(envelope, tol):
+    """ Number of modes above tol times the peak of an envelope, or its
+        extrapolation from the decay of the upper half of the spectrum. """
+    peak = envelope.max()
+    M = len(envelope)
+    # Running maximum from the highest mode down
+    upper = np.maximum.accumulate(envelope[::-1])[::-1] / peak
+    above = np.nonzero(upper > tol)[0]
+    if not len(above):
+        return 1
+    if above[-1] + 1 < M:
+        return above[-1] + 1
+    m = np.arange(M//2, M)
+    slope, intercept = np.polyfit(m, np.log(np.maximum(upper[M//2:], 1e-300)), 1)
+    if slope >= 0:
+        return 2*M
+    return min((np.log(tol) - intercept)/slope, 4*M)
+
+
+class SpectralMonitor:
+    """ Spectral tails of the state fields and the resolution they need. """
+
+    def __init__(self, solver, fields=('b', 'u', 'w'), cadence=500, tol=1e-6,
+                 tail=0.1, patience=3, enabled=True):
+        self.solver = solver
+        self.fields = fields
+        self.cadence = cadence
+        self.tol = tol
+        self.tail = tail
+        self.patience = patience
+        self.enabled = enabled
+        domain = solver.domain
+        self.comm = domain.dist.comm_cart
+        # Spectra along each axis ('x', 'y', 'z' or the subbases of a
+        # compound z): (name, axis, kind, local modes, grid size)
+        self.axes = []
+        slices = domain.dist.coeff_layout.slices(scales=1)
+        for axis, basis in enumerate(domain.bases):
+            index = np.arange(slices[axis].start, slices[axis].stop)
+            if isinstance(basis, de.Fourier):
+                a, b = basis.interval
+                k = np.abs(np.ravel(domain.elements(axis))) * (b - a)/(2*np.pi)
+                self.axes.append((basis.name, axis, 'fourier', np.rint(k).astype(int),
+                                  basis.base_grid_size))
+            else:
+                subbases = getattr(basis, 'subbases', [basis])
+                start = 0
+                for sub in subbases:
+                    n = sub.base_grid_size
+                    local = (index >= start) & (index < start + n)
+                    self.axes.append((sub.name, axis, 'chebyshev', (index - start, local), n))
+                    start += n
+        self.needed = {}
+        self.spectra = {}
+        self.under = 0
+        self.checks = 0
+
+    def envelopes(self):
+        """ Global envelope of each field along each axis. """
+        solver = self.solver
+        keys, parts = [], []
+        for name in self.fields:
+            data = np.abs(solver.state[name]['c'])
+            for axis_name, axis, kind, modes, size in self.axes:
+                env = np.zeros(size//2 + 1 if kind == 'fourier' else size)
+                if data.size:
+                    others = tuple(i for i in range(data.ndim) if i != axis)
+                    local = data.max(axis=others)
+                    if kind == 'fourier':
+                        np.maximum.at(env, modes, local)
+                    else:
+                        index, inside = modes
+                        env[index[inside]] = local[inside]
+                keys.append((name, axis_name))
+                parts.append(env)
+        buffer = np.concatenate(parts)
+        self.comm.Allreduce(MPI.IN_PLACE, buffer, op=MPI.MAX)
+        bounds = np.cumsum([0] + [len(env) for env in parts])
+        return {key: buffer[a:b] for key, a, b in zip(keys, bounds[:-1], bounds[1:])}
+
+    def process(self):
+        """ Check the spectra every cadence iterations; True once the run
+            has been under-resolved for `patience` consecutive checks. """
+        solver = self.solver
+        if not self.enabled or solver.iteration % self.cadence != 0:
+            return False
+        self.spectra = self.envelopes()
+        self.checks += 1
+        tails = {}
+        for (name, axis_name), env in self.spectra.items():
+            peak = env.max()
+            if peak == 0:
+                continue
+            tails[name, axis_name] = env[int((1 - self.tail)*len(env)):].max() / peak
+            needed = needed_modes(env, self.tol) / (1 - self.tail)
+            self.needed[axis_name] = max(self.needed.get(axis_name, 0), needed)
+        if not tails:
+            return False
+        name, axis_name = worst = max(tails, key=tails.get)
+        recommended = 'x'.join(map(str, self.recommended()))
+        if tails[worst] > self.tol:
+            self.under += 1
+            logger.warning('Under-resolved: tail of %s along %s is %.1e (tol %.0e);'
+                           ' recommended resolution %s'
+                           %(name, axis_name, tails[worst], self.tol, recommended))
+        else:
+            self.under = 0
+            logger.info('Resolution: largest tail %.1e (%s along %s); recommended %s'
+                        %(tails[worst], name, axis_name, recommended))
+        return self.under >= self.patience
+
+    def current(self):
+        return [size for *_, size in self.axes]
+
+    def recommended(self):
+        """ Cheapest adequate resolution along each axis (in grid points,
+            like --resolution), from the largest needs of the run. """
+        sizes = []
+        for axis_name, axis, kind, modes, size in self.axes:
+            if axis_name not in self.needed:
+                sizes.append(size)
+            elif kind == 'fourier':
+                sizes.append(nice_size(2*self.needed[axis_name]))
+            else:
+                sizes.append(nice_size(self.needed[axis_name]))
+        return sizes
+
+    def regrid(self, path='regrid.json'):
+        """ Write the recommended resolution (and surface-layer modes) for
+            the continuation of the run on a new grid (rank 0). """
+        sizes = self.recommended()
+        dim = self.solver.domain.dim
+        regrid = dict(resolution=sizes[:dim], z_layer=sum(sizes[dim:]),
+                      iteration=int(self.solver.iteration),
+                      sim_time=float(self.solver.sim_time))
+        if self.comm.rank == 0:
+            with open(path, 'w') as f:
+                json.dump(regrid, f, indent=1)
+        return regrid
+
+    def write(self, path='resolution.json'):
+        """ Recommendations and the last spectra (rank 0). """
+        if not self.enabled or not self.checks or self.comm.rank != 0:
+            return
+        summary = dict(axes=[a[0] for a in self.axes], resolution=self.current(),
+                       recommended=self.recommended(), tol=self.tol, tail=self.tail,
+                       checks=self.checks,
+                       spectra={'%s_%s' %key: env.tolist()
+                                for key, env in self.spectra.items()})
+        with open(path, 'w') as f:
+            json.dump(summary, f)
+        logger.info('Resolution %s, recommended %s (tol %.0e)'
+                    %('x'.join(map(str, summary['resolution'])),
+                      'x'.join(map(str, summary['recommended'])), self.tol))
@@ -0,0 +1,321 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    rundb.py: database of the time series and Nu statistics of all runs.
+
+    Each run, keyed by (dim, bc, Ra, Pr, resolution), is one append-only
+    file in the database directory, e.g.
+
+        Data/runs/2D_noslip_Ra1e9_Pr1_1024x256.h5
+
+    (runs with N more modes in a surface layer, see problems.z_basis, end
+    in +N), with one compressed, chunked column per quantity (time,
+    iteration, Nu, ke, Re, b_bottom) and the time of the first row of
+    each chunk as an index, so a time range is read without touching the
+    rest of the file. The run parameters and the final Nu statistics of
+    nusselt.py are attributes, so Nu-Ra tables need no time series at all.
+
+    Ra is that of the solvers (--Ra, based on the depth h); the paper's
+    Ra, based on Lx = 4h, is 64 times larger (see 2D_HC.py) and is stored
+    as the attribute Ra_paper. The npz files of the figures use the
+    paper's Ra.
+
+    The solvers stream into the database with
+    $ mpiexec -n 24 python3 2D_HC.py --rundb ../Data/runs
+    (sweep.py --rundb does so for all cases). Queries:
+
+        db = rundb.RunDB('../Data/runs')
+        db.runs(dim=2, bc='noslip', Ra=(1e6, 1e9))         # run attributes
+        db.query(key, ['time', 'Nu'], t0=5000, max_points=2000)
+        db.table(dim=3, bc='nostress')                     # Ra, Nu, error
+
+    table() keeps one run per (dim, bc, Ra, Pr): the converged one or, of
+    several (e.g. a run replaced by a finer one after --regrid), the one
+    of highest resolution.
+
+    The npz files read by the figures are exported from queries, e.g.
+    $ python3 rundb.py ../Data/runs nuvsra ../Data/NuVsRa.npz
+    $ python3 rundb.py ../Data/runs series ../Data/NuAndKE_2D_noslip_6p4e10.npz \\
+          --key 2D_noslip_Ra1e9_Pr1_1024x256 --columns time Nu ke
+
+    Cesar Rocha et al.
+"""
+
+import argparse
+import glob
+import os
+
+import h5py
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Rows per chunk of a column, and rows buffered before a write
+chunk_rows = 4096
+flush_rows = 100
+
+# Ra of the paper (based on Lx = 4h) over the Ra of the solvers (based on h)
+paper_ra = 4**3
+
+
+def ra_label(Ra):
+    """ Compact label of Ra, e.g. 6.4e10 -> 6p4e10. """
+    mantissa, exponent = ('%.6e' %Ra).split('e')
+    return '%se%i' %(mantissa.rstrip('0').rstrip('.').replace('.', 'p'), int(exponent))
+
+
+def run_key(dim, bc, Ra, Pr, resolution, layer=None):
+    key = '%iD_%s_Ra%s_Pr%g_%s' %(dim, bc, ra_label(Ra), Pr,
+                                  'x'.join(str(int(n)) for n in resolution))
+    if layer:
+        key += '+%i' %layer[0]
+    return key
+
+
+# Attributes written by RunWriter.close() (see Recorder.close)
+summary_attrs = ('Nu', 'Nu_error', 'Nu_t0', 'Nu_t1', 'converged')
+
+
+class RunWriter:
+    """ Appends rows to the columns of one run (a single writer). """
+
+    def __init__(self, path, attrs, columns, sim_time=0.):
+        self.path = path
+        self.columns = list(columns)
+        self.rows = []
+        with h5py.File(path, 'a') as file:
+            # The summary of a previous run of the file is stale once it
+            # continues (or restarts) until this one closes
+            for key in summary_attrs:
+                if key in file.attrs:
+                    del file.attrs[key]
+            for key, value in attrs.items():
+                file.attrs[key] = value
+            group = file.require_group('columns')
+            for name in ['time'] + self.columns:
+                if name not in group:
+                    group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=float,
+                                         chunks=(chunk_rows,), compression='lzf', shuffle=True)
+            if 'index' not in file:
+                file.create_dataset('index', shape=(0,), maxshape=(None,), dtype=float)
+            # A restarted run rewrites the rows after its checkpoint
+            n = group['time'].shape[0]
+            if n and group['time'][n-1] >= sim_time:
+                self.truncate(file, int(np.searchsorted(group['time'][:], sim_time)))
+
+    def truncate(self, file, n):
+        for dset in file['columns'].values():
+            dset.resize((n,))
+        file['index'].resize((-(-n // chunk_rows),))
+
+    def append(self, time, **values):
+        self.rows.append([time] + [values.get(name, np.nan) for name in self.columns])
+        if len(self.rows) >= flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        rows = np.array(self.rows, dtype=float)
+        with h5py.File(self.path, 'a') as file:
+            group = file['columns']
+            n = group['time'].shape[0]
+            m = n + len(rows)
+            for name, column in zip(['time'] + self.columns, rows.T):
+                group[name].resize((m,))
+                group[name][n:] = column
+            index = file['index']
+            starts = np.arange(-(-n // chunk_rows)*chunk_rows, m, chunk_rows)
+            if len(starts):
+                k = index.shape[0]
+                index.resize((k + len(starts),))
+                index[k:] = rows[starts - n, 0]
+        self.rows = []
+
+    def close(self, **summary):
+        """ Flush and store the summary (e.g. Nu statistics) as attributes. """
+        self.flush()
+        with h5py.File(self.path, 'a') as file:
+            for key, value in summary.items():
+                file.attrs[key] = value
+
+
+class RunDB:
+    """ Directory of run files. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def file(self, key):
+        return os.path.join(self.path, key + '.h5')
+
+    def writer(self, dim, bc, Ra, Pr, resolution, columns, sim_time=0., layer=None):
+        os.makedirs(self.path, exist_ok=True)
+        key = run_key(dim, bc, Ra, Pr, resolution, layer)
+        attrs = dict(key=key, dim=dim, bc=bc, Ra=Ra, Ra_paper=paper_ra*Ra, Pr=Pr,
+                     resolution=list(resolution))
+        if layer:
+            attrs.update(layer_modes=layer[0], layer_thickness=layer[1])
+        return RunWriter(self.file(key), attrs, columns, sim_time)
+
+    def runs(self, dim=None, bc=None, Ra=None, Pr=None, resolution=None):
+        """ Attributes of the runs matching the criteria; Ra may be a
+            (min, max) range. """
+        runs = []
+        for path in sorted(glob.glob(os.path.join(self.path, '*.h5'))):
+            with h5py.File(path, 'r') as file:
+                attrs = {k: (v.decode() if isinstance(v, bytes) else v)
+                         for k, v in file.attrs.items()}
+                attrs['rows'] = file['columns/time'].shape[0]
+            if dim is not None and attrs['dim'] != dim:
+                continue
+            if bc is not None and attrs['bc'] != bc:
+                continue
+            if Pr is not None and not np.isclose(attrs['Pr'], Pr):
+                continue
+            if resolution is not None and list(attrs['resolution']) != list(resolution):
+                continue
+            if Ra is not None:
+                lo, hi = Ra if np.ndim(Ra) else (Ra, Ra)
+                if not lo*(1 - 1e-9) <= attrs['Ra'] <= hi*(1 + 1e-9):
+                    continue
+            runs.append(attrs)
+        return sorted(runs, key=lambda r: (r['dim'], r['bc'], r['Ra'], list(r['resolution'])))
+
+    def query(self, key, columns=None, t0=-np.inf, t1=np.inf, max_points=None,
+              reduce='stride'):
+        """ Columns of a run for t0 <= time <= t1, downsampled to at most
+            max_points rows by striding or by block means. """
+        with h5py.File(self.file(key), 'r') as file:
+            group = file['columns']
+            columns = columns or list(group)
+            n = group['time'].shape[0]
+            index = file['index'][:]
+            # Rows that may be in range, from the chunk index
+            c0 = max(np.searchsorted(index, t0, side='right') - 1, 0)
+            c1 = np.searchsorted(index, t1, side='right')
+            a, b = c0*chunk_rows, min(c1*chunk_rows, n)
+            time = group['time'][a:b]
+            i0 = a + np.searchsorted(time, t0, side='left')
+            i1 = a + np.searchsorted(time, t1, side='right')
+            data = {name: group[name][i0:i1] for name in columns}
+        if max_points and i1 - i0 > max_points:
+            step = -(-(i1 - i0) // max_points)
+            for name, column in data.items():
+                if reduce == 'mean':
+                    m = len(column) // step * step
+                    data[name] = column[:m].reshape(-1, step).mean(axis=1)
+                else:
+                    data[name] = column[::step]
+        return data
+
+    def best(self, runs, column='Nu'):
+        """ One run per (dim, bc, Ra, Pr) among runs with statistics of
+            `column`: converged first, then the highest resolution, then
+            the longest. """
+        best = {}
+        for run in runs:
+            if column not in run:
+                continue
+            key = (run['dim'], run['bc'], float('%.6g' %run['Ra']), float('%.6g' %run['Pr']))
+            rank = (bool(run.get('converged', False)), int(np.prod(run['resolution'])),
+                    run.get('layer_modes', 0), run['rows'])
+            if key not in best or rank > best[key][0]:
+                best[key] = (rank, run)
+        return sorted((run for rank, run in best.values()),
+                      key=lambda r: (r['dim'], r['bc'], r['Ra']))
+
+    def table(self, column='Nu', paper=False, **criteria):
+        """ Ra (the paper's if `paper`) and the time mean (with error) of a
+            column over the runs matching the criteria, one run per Ra (see
+            best), from the stored statistics. """
+        Ra, mean, error = [], [], []
+        for run in self.best(self.runs(**criteria), column):
+            Ra.append(paper_ra*run['Ra'] if paper else run['Ra'])
+            mean.append(run[column])
+            error.append(run.get(column + '_error', np.nan))
+        return np.array(Ra), np.array(mean), np.array(error)
+
+
+class Recorder:
+    """ Streams the flow properties of a run into the database (rank 0).
+
+        flow is the diagnostics.Diagnostics handler or the
+        flow_tools.GlobalFlowProperty of the solver, with the volume averages
+        chi, K (kinetic energy) and b_bottom and the maximum Re. """
+
+    columns = ['iteration', 'Nu', 'ke', 'Re', 'b_bottom']
+
+    def __init__(self, solver, flow, path, config, chi_diff, cadence=10):
+        self.solver = solver
+        self.flow = flow
+        self.chi_diff = chi_diff
+        self.cadence = cadence
+        self.writer = None
+        if path and solver.domain.dist.comm_cart.rank == 0:
+            self.writer = RunDB(path).writer(config.dim, config.bc, config.Ra, config.Pr,
+                                             config.resolution, self.columns,
+                                             sim_time=solver.sim_time, layer=config.layer)
+
+    def process(self):
+        solver = self.solver
+        if self.writer is None or (solver.iteration-1) % self.cadence != 0:
+            return
+        flow = self.flow
+        self.writer.append(solver.sim_time, iteration=solver.iteration,
+                           Nu=flow.volume_average('chi')/self.chi_diff,
+                           ke=flow.volume_average('K'), Re=flow.max('Re'),
+                           b_bottom=flow.volume_average('b_bottom'))
+
+    def close(self, monitor=None):
+        """ Flush, with the Nu statistics of a nusselt.NusseltMonitor. """
+        if self.writer is None:
+            return
+        summary = {}
+        stats = monitor.statistics() if monitor is not None else None
+        if stats is not None:
+            summary = dict(Nu=stats['Nu'], Nu_error=stats['error'],
+                           Nu_t0=stats['t0'], Nu_t1=stats['t1'],
+                           converged=monitor.converged)
+        self.writer.close(**summary)
+
+
+def export_nuvsra(db, path):
+    """ NuVsRa.npz of Figures 6 and 7: the paper's Ra and Nu of each dim
+        and bc. """
+    data = {}
+    for dim in (2, 3):
+        for bc, label in (('noslip', 'NS'), ('nostress', 'FS')):
+            Ra, Nu, error = db.table(dim=dim, bc=bc, paper=True)
+            data['Ra_%iD_%s' %(dim, label)] = Ra
+            data['Nu_%iD_%s' %(dim, label)] = Nu
+    np.savez(path, **data)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s :: %(message)s')
+    parser = argparse.ArgumentParser(description="Query the run database.")
+    parser.add_argument('db', help="database directory")
+    parser.add_argument('command', choices=['list', 'nuvsra', 'series'])
+    parser.add_argument('output', nargs='?', help="npz file (nuvsra, series)")
+    parser.add_argument('--key', help="run of a series")
+    parser.add_argument('--columns', nargs='+', default=['time', 'Nu', 'ke'])
+    parser.add_argument('--t0', type=float, default=-np.inf)
+    parser.add_argument('--t1', type=float, default=np.inf)
+    parser.add_argument('--max-points', type=int, default=None)
+    args = parser.parse_args()
+
+    db = RunDB(args.db)
+    if args.command == 'list':
+        for run in db.runs():
+            print('%-45s %8i rows  Nu = %s' %(run['key'], run['rows'], run.get('Nu', '-')))
+    elif args.command == 'nuvsra':
+        export_nuvsra(db, args.output)
+    else:
+        np.savez(args.output, **db.query(args.key, args.columns, args.t0, args.t1,
+                                         args.max_points))
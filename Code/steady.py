@@ -0,0 +1,262 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    steady.py: steady 2D states and Nu(Ra) by Newton iteration.
+
+    At low and moderate Ra the 2D flow is steady, and 2D_HC.py integrates
+    to t = 18000 only to reach it. Here the steady state is solved for
+    directly, with Newton's method on the steady Boussinesq equations
+    (the nonlinear BVP of problems.boussinesq_steady), or with
+    Newton-Krylov (--method newton-krylov) on the Stokes-preconditioned
+    residual (Tuckerman's): one backward-Euler step (SBDF1) of a long time
+    T of the equations of 2D_HC.py,
+
+        F(X) = X(T) - X = (M + T L)^-1 T (N(X) - L X),
+
+    whose zeros are the steady states, and which tends to L^-1 (N(X) - L X)
+    for T much longer than the diffusive time (the default T is ten
+    diffusive times): the linear operator, factored once, preconditions the
+    residual, so GMRES needs few iterations. Newton-Krylov runs on one
+    process.
+
+    The Ra values are solved in increasing order, each from the states of
+    the previous ones extrapolated linearly in log(Ra) (natural-parameter
+    continuation with a secant predictor); a Ra step that fails to converge
+    is halved. For each Ra, Nu is written to steady.npz and the state to
+    steady_Ra<Ra>.h5, laid out like a merged snapshot file, so that a
+    time-dependent run can start from it (2D_HC.py --init).
+
+    $ mpiexec -n 4 python3 steady.py --Ra 1e2 1e3 1e4 4e4 --resolution 256 64
+    $ python3 steady.py --Ra-range 1e3 1e6 --points 20 --method newton-krylov
+    $ python3 steady.py --Ra 1e5 --init ../2D_noslip_Ra1e4_Pr1/snapshots/snapshots_s1.h5
+
+    Cesar Rocha et al.
+"""
+
+import argparse
+import os
+
+import h5py
+import numpy as np
+from mpi4py import MPI
+
+import problems
+import continuation
+import diagnostics
+import nusselt
+import rundb
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def state_vector(solver):
+    """ Coefficients of all state variables as one real vector. """
+    return np.concatenate([np.ascontiguousarray(f['c']).ravel().view(float)
+                           for f in solver.state.fields])
+
+
+def set_state_vector(solver, x):
+    start = 0
+    for field in solver.state.fields:
+        data = field['c']
+        n = data.size * data.itemsize // 8
+        field['c'] = x[start:start+n].view(data.dtype).reshape(data.shape)
+        start += n
+
+
+def diffusive_state(solver):
+    """ Purely diffusive solution b = cos(2kx) cosh(2kz)/cosh(2kLz). """
+    domain = solver.domain
+    k = np.pi/problems.Lx
+    x, z = domain.grid(0), domain.grid(1)
+    for field in solver.state.fields:
+        field.set_scales(1, keep_data=False)
+        field['g'] = 0.
+    b = solver.state['b']
+    b['g'] = np.cos(2*k*x) * np.cosh(2*k*z) / np.cosh(2*k*problems.Lz)
+    b.differentiate('x', out=solver.state['bx'])
+    b.differentiate('z', out=solver.state['bz'])
+
+
+def nusselt_number(solver, P):
+    """ Nu = P <|grad b|^2> / chi_diff of the state of `solver`. """
+    domain = solver.domain
+    weights = diagnostics.quadrature_weights(domain, domain.dealias)
+    bx, bz = solver.state['bx'], solver.state['bz']
+    bx.set_scales(domain.dealias, keep_data=True)
+    bz.set_scales(domain.dealias, keep_data=True)
+    local = np.array([np.sum(weights * (bx['g']**2 + bz['g']**2))])
+    domain.dist.comm_cart.Allreduce(MPI.IN_PLACE, local, op=MPI.SUM)
+    chi = P * local[0] / (problems.Lx*problems.Lz)
+    return chi / nusselt.chi_diffusive(P, np.pi/problems.Lx, problems.Lz)
+
+
+def newton(solver, tol=1e-10, max_iterations=20):
+    """ Newton iterations of a Dedalus NLBVP solver until the largest
+        perturbation is below tol; returns (converged, iterations). """
+    comm = solver.domain.dist.comm_cart
+    for iteration in range(1, max_iterations+1):
+        solver.newton_iteration()
+        norm = np.array([np.max(np.abs(solver.perturbations.data), initial=0.)])
+        comm.Allreduce(MPI.IN_PLACE, norm, op=MPI.MAX)
+        logger.info('Newton iteration %i: perturbation %.3e' %(iteration, norm[0]))
+        if not np.isfinite(norm[0]):
+            return False, iteration
+        if norm[0] < tol:
+            return True, iteration
+    return False, max_iterations
+
+
+def newton_krylov(solver, config, tol=1e-10, max_iterations=20, T=None):
+    """ Newton-Krylov iteration on the Stokes-preconditioned residual (one
+        backward-Euler step of T, default ten diffusive times), starting
+        from and ending in the state of `solver`. """
+    from scipy import optimize
+    if solver.domain.dist.comm_cart.size > 1:
+        raise ValueError("Newton-Krylov runs on a single process")
+    if T is None:
+        P, R = problems.diffusivities(config.Ra, config.Pr)
+        T = 10 * problems.Lz**2 / min(P, R)
+    # SBDF1 only uses the current state, so reset() leaves no history, and
+    # its factorization of M + T L is reused by every evaluation
+    ivp = problems.ivp_solver(config, comm=MPI.COMM_SELF, timestepper='SBDF1')
+    evaluations = [0]
+
+    def residual(x):
+        problems.reset(ivp)
+        set_state_vector(ivp, x)
+        ivp.step(T)
+        evaluations[0] += 1
+        return state_vector(ivp) - x
+
+    try:
+        x = optimize.newton_krylov(residual, state_vector(solver), f_tol=tol,
+                                   maxiter=max_iterations, method='lgmres')
+    except (optimize.NoConvergence, ValueError, FloatingPointError) as error:
+        logger.info('Newton-Krylov did not converge: %s' %error)
+        return False, evaluations[0]
+    set_state_vector(solver, x)
+    logger.info('Newton-Krylov converged after %i time-stepper evaluations'
+                %evaluations[0])
+    return True, evaluations[0]
+
+
+def write_state(solver, path, attrs):
+    """ State on the grid, as a merged snapshot file of one write. """
+    domain = solver.domain
+    comm = domain.dist.comm_cart
+    slices = domain.dist.grid_layout.slices(scales=1)
+    gshape = domain.dist.grid_layout.global_shape(scales=1)
+    blocks = {}
+    for field in solver.state.fields:
+        field.set_scales(1, keep_data=True)
+        blocks[field.name] = comm.gather((slices, np.copy(field['g'])), root=0)
+    if comm.rank != 0:
+        return
+    with h5py.File(path, 'w') as file:
+        for key, value in attrs.items():
+            file.attrs[key] = value
+        tasks = file.create_group('tasks')
+        for name, parts in blocks.items():
+            data = np.zeros(gshape)
+            for s, block in parts:
+                data[s] = block
+            tasks.create_dataset(name, data=data[np.newaxis])
+        scales = file.create_group('scales')
+        scales.create_dataset('sim_time', data=[0.])
+        scales.create_dataset('iteration', data=[0])
+        for axis, name in enumerate('xz'):
+            scales.create_dataset(name, data=np.ravel(domain.grid(axis, scales=1)))
+
+
+def solve(configs, output, method='newton', tol=1e-10, max_iterations=20, init=None,
+          min_step=1/64, T=None, comm=None):
+    """ Steady states of the 2D configs (in increasing Ra, with
+        continuation); returns Ra, Nu and the iterations of each. """
+    configs = sorted(configs, key=lambda c: c.Ra)
+    os.makedirs(output, exist_ok=True)
+    history = []    # (log Ra, state vector) of the last converged states
+    results = dict(Ra=[], Nu=[], iterations=[])
+    targets = [c.Ra for c in configs]
+    base = configs[0]
+    while targets:
+        config = base._replace(Ra=targets[0])
+        solver = problems.nlbvp_solver(config, comm)
+        if history:
+            lr, x = history[-1]
+            if len(history) > 1:
+                lr0, x0 = history[-2]
+                x = x + (x - x0) * (np.log(config.Ra) - lr)/(lr - lr0)
+            set_state_vector(solver, x)
+        elif init:
+            continuation.initial_state(solver, init)
+        else:
+            diffusive_state(solver)
+        logger.info('Steady state at Ra = %g' %config.Ra)
+        if method == 'newton':
+            converged, iterations = newton(solver, tol, max_iterations)
+        else:
+            converged, iterations = newton_krylov(solver, config, tol, max_iterations, T)
+        if not converged:
+            if not history:
+                raise RuntimeError("No steady state at Ra = %g from the initial guess"
+                                   %config.Ra)
+            step = np.log(config.Ra) - history[-1][0]
+            if step < min_step:
+                raise RuntimeError("Continuation stalled at Ra = %g" %config.Ra)
+            logger.info('Not converged; halving the step in log(Ra)')
+            targets.insert(0, float(np.exp(history[-1][0] + step/2)))
+            continue
+        targets.pop(0)
+        history = (history + [(np.log(config.Ra), state_vector(solver))])[-2:]
+        P, R = problems.diffusivities(config.Ra, config.Pr)
+        Nu = nusselt_number(solver, P)
+        logger.info('Ra = %g: Nu = %.8f (%i iterations)' %(config.Ra, Nu, iterations))
+        results['Ra'].append(config.Ra)
+        results['Nu'].append(Nu)
+        results['iterations'].append(iterations)
+        write_state(solver, os.path.join(output, 'steady_Ra%s.h5' %rundb.ra_label(config.Ra)),
+                    dict(Ra=config.Ra, Pr=config.Pr, bc=config.bc, Nu=Nu))
+    results = {key: np.array(value) for key, value in results.items()}
+    if (comm or MPI.COMM_WORLD).rank == 0:
+        np.savez(os.path.join(output, 'steady.npz'), **results)
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s :: %(message)s')
+    parser = argparse.ArgumentParser(description="Steady 2D states by Newton iteration.")
+    parser.add_argument('--Ra', type=float, nargs='+', default=[1e2, 1e3, 1e4],
+                        help="Rayleigh numbers (solved in increasing order)")
+    parser.add_argument('--Ra-range', type=float, nargs=2, default=None, metavar=('MIN', 'MAX'),
+                        help="log-spaced Rayleigh numbers instead of --Ra")
+    parser.add_argument('--points', type=int, default=10,
+                        help="number of Ra of --Ra-range (default %(default)i)")
+    parser.add_argument('--Pr', type=float, default=1.)
+    parser.add_argument('--bc', choices=['noslip', 'nostress'], default='noslip')
+    parser.add_argument('--resolution', type=int, nargs=2, default=[128, 32],
+                        metavar=('nx', 'nz'))
+    parser.add_argument('--method', choices=['newton', 'newton-krylov'], default='newton',
+                        help="Newton on the steady BVP or Newton-Krylov on the"
+                             " time-stepper residual (default %(default)s)")
+    parser.add_argument('--tol', type=float, default=1e-10,
+                        help="Newton tolerance (default %(default)g)")
+    parser.add_argument('--max-iterations', type=int, default=20)
+    parser.add_argument('--T', type=float, default=None,
+                        help="time step of the Newton-Krylov residual (default: ten"
+                             " diffusive times)")
+    parser.add_argument('--init', metavar='PATH',
+                        help="initial guess at the first Ra from a checkpoint or"
+                             " snapshot file (default: the diffusive solution)")
+    parser.add_argument('--output', default='steady')
+    args = parser.parse_args()
+
+    Ra = np.logspace(*np.log10(args.Ra_range), args.points) if args.Ra_range else args.Ra
+    configs = [problems.Config(2, args.bc, r, args.Pr, tuple(args.resolution)) for r in Ra]
+    solve(configs, args.output, args.method, args.tol, args.max_iterations, args.init,
+          T=args.T)
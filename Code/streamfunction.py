@@ -0,0 +1,161 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    streamfunction.py: batched streamfunction inversion of snapshots.
+
+    The streamfunction of the 2D (or y-averaged 3D) velocity solves
+
+        dx(dx(psi)) + dz(dz(psi)) = dx(w) - dz(u),    psi = 0 at z = 0, Lz,
+
+    which is solved here without Dedalus: u and w are transformed to
+    Fourier (x) and Chebyshev (z) coefficients, and the Chebyshev tau
+    operator of each wavenumber is inverted once per grid. A whole
+    series of snapshots is then inverted with a few batched matrix
+    products. The grid in z is whatever grid the data is given on
+    (Dedalus' Gauss-Chebyshev grid by default).
+
+    Time series of the overturning strength (max and min of psi) of
+    merged snapshot files, one file per worker process:
+
+    $ python3 streamfunction.py snapshots/snapshots_s*.h5 -n 8 --output overturning.npz
+
+    Cesar Rocha et al.
+"""
+
+import argparse
+import multiprocessing
+
+import h5py
+import numpy as np
+from numpy.polynomial import chebyshev
+
+import encoding
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Memory used for a batch of snapshots
+batch_bytes = 2**28
+
+
+def gauss_grid(nz, Lz=1.):
+    """ Dedalus' Chebyshev grid on (0, Lz). """
+    x = -np.cos(np.pi*(np.arange(nz) + 1/2)/nz)
+    return (x + 1)/2 * Lz
+
+
+def derivative_matrix(n):
+    """ d/dx of Chebyshev coefficients on [-1, 1]. """
+    D = np.zeros((n, n))
+    for j in range(1, n):
+        D[(j-1)%2:j:2, j] = 2*j
+    D[0] /= 2
+    return D
+
+
+class Inverter:
+    """ Streamfunction of the velocity on an (nx, len(z)) grid, periodic
+        in x with period Lx and with psi = 0 at z = 0 and z = Lz. """
+
+    def __init__(self, nx, z, Lx=4., Lz=1.):
+        nz = len(z)
+        self.nx = nx
+        self.z = np.asarray(z)
+        # Chebyshev collocation and its inverse
+        self.T = chebyshev.chebvander(2*self.z/Lz - 1, nz - 1)
+        self.Tinv = np.linalg.inv(self.T)
+        self.D = derivative_matrix(nz) * 2/Lz
+        D2 = self.D @ self.D
+        # Tau operators with the boundary rows psi(0) = psi(Lz) = 0, inverted
+        # at once for all wavenumbers; only the equation rows are kept
+        self.k = 2*np.pi/Lx * np.arange(nx//2 + 1)
+        A = np.repeat(D2[None], len(self.k), axis=0)
+        A -= self.k[:, None, None]**2 * np.eye(nz)
+        A[:, -2] = (-1.)**np.arange(nz)
+        A[:, -1] = 1.
+        self.G = np.linalg.inv(A)[:, :, :-2]
+
+    def __call__(self, u, w):
+        """ psi of u and w of shape (..., nx, nz). """
+        u = np.fft.rfft(u, axis=-2) @ self.Tinv.T
+        w = np.fft.rfft(w, axis=-2) @ self.Tinv.T
+        rhs = 1j*self.k[:, None]*w - u @ self.D.T
+        if self.nx % 2 == 0:
+            rhs[..., -1, :] = 0
+        psi = np.einsum('kij,...kj->...ki', self.G, rhs[..., :-2])
+        return np.fft.irfft(psi @ self.T.T, n=self.nx, axis=-2)
+
+
+# Inverters built in this process, by grid
+inverters = {}
+
+
+def inverter(nx, z, Lx=4., Lz=1.):
+    key = (nx, len(z), np.asarray(z).tobytes(), Lx, Lz)
+    if key not in inverters:
+        inverters[key] = Inverter(nx, z, Lx, Lz)
+    return inverters[key]
+
+
+def invert(u, w, z=None, Lx=4., Lz=1.):
+    """ Streamfunction of one or many snapshots of shape (..., nx, nz). """
+    nx, nz = np.shape(u)[-2:]
+    if z is None:
+        z = gauss_grid(nz, Lz)
+    return inverter(nx, z, Lx, Lz)(u, w)
+
+
+def scale(file, name):
+    """ Grid of a merged Dedalus file (scales/<name>/<scale> or scales/<name>). """
+    item = file['scales'][name]
+    if isinstance(item, h5py.Group):
+        item = item['1.0'] if '1.0' in item else list(item.values())[0]
+    return item[:]
+
+
+def overturning(path):
+    """ Simulation time and max and min of psi of the snapshots of a
+        merged file, y-averaging 3D velocities. """
+    with h5py.File(path, 'r') as file:
+        u, w = file['tasks']['u'], file['tasks']['w']
+        z = scale(file, 'z')
+        sim_time = file['scales']['sim_time'][:]
+        size = max(np.prod(u.shape[1:]) * 8, 1)
+        batch = int(max(1, batch_bytes // (4*size)))
+        psi_max = np.zeros(u.shape[0])
+        psi_min = np.zeros(u.shape[0])
+        for t0 in range(0, u.shape[0], batch):
+            ub = encoding.read(u, slice(t0, t0+batch))
+            wb = encoding.read(w, slice(t0, t0+batch))
+            if ub.ndim == 4:
+                ub, wb = ub.mean(axis=2), wb.mean(axis=2)
+            psi = invert(ub, wb, z)
+            psi_max[t0:t0+batch] = psi.max(axis=(-2, -1))
+            psi_min[t0:t0+batch] = psi.min(axis=(-2, -1))
+    return sim_time, psi_max, psi_min
+
+
+def overturning_files(paths, processes=None):
+    """ Overturning time series of many files, concatenated in time. """
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(overturning, paths)
+    t, psi_max, psi_min = (np.concatenate(r) for r in zip(*results))
+    order = np.argsort(t, kind='stable')
+    return t[order], psi_max[order], psi_min[order]
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s :: %(message)s')
+    parser = argparse.ArgumentParser(description="Overturning streamfunction of snapshots.")
+    parser.add_argument('paths', nargs='+', help="merged snapshot files")
+    parser.add_argument('-n', '--processes', type=int, default=None,
+                        help="worker processes (default: number of cores)")
+    parser.add_argument('--output', default='overturning.npz')
+    args = parser.parse_args()
+    t, psi_max, psi_min = overturning_files(args.paths, args.processes)
+    np.savez(args.output, t=t, psi_max=psi_max, psi_min=psi_min)
+    logger.info('Wrote %i snapshots to %s' %(len(t), args.output))
@@ -0,0 +1,366 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    sweep.py: run a campaign of 2D_HC.py/3D_HC.py cases from one manifest.
+
+    The manifest is a JSON file with a list of cases, optionally preceded
+    by defaults shared by all cases:
+
+        {"defaults": {"dim": 2, "Pr": 1, "bc": "noslip"},
+         "cases": [{"Ra": 1e5, "resolution": [128, 32], "stop_sim_time": 18000},
+                   {"Ra": 1e9, "resolution": [1024, 256], "stop_sim_time": 18000},
+                   {"dim": 3, "Ra": 1e7, "resolution": [256, 64, 64],
+                    "stop_sim_time": 2500, "ranks": 64}]}
+
+    A case may also set "z_layer", the --z-layer option of the solvers.
+
+    With --regrid (or "regrid": true in a case), the resolution of each
+    case is monitored (see resolution.py); an under-resolved case stops,
+    and is continued from its last checkpoint on the recommended grid.
+
+    Each case runs in its own directory, runs/<name>/, where <name> is
+    built from dim, bc, Ra and Pr (e.g. 2D_noslip_Ra6p4e10_Pr1). The number
+    of ranks of a case is given by "ranks" or estimated from its resolution,
+    so that small low-Ra cases are packed side by side and big cases get
+    more ranks. Cases that finished successfully are skipped on a rerun,
+    and interrupted cases resume from their latest checkpoint.
+
+    On a workstation, cases are launched as separate mpiexec jobs that
+    share a pool of cores:
+    $ python3 sweep.py manifest.json --cores 24
+
+    On a cluster, one mpiexec launch is split into MPI sub-communicators,
+    each running a queue of cases:
+    $ mpiexec -n 992 python3 sweep.py manifest.json --mpi
+    Consecutive cases of a queue keep the domains of problems.py, so cases
+    with the same resolution do not rebuild their transforms, and a case
+    repeating the previous one also reuses its solver.
+
+    Cesar Rocha et al.
+"""
+
+import argparse
+import glob
+import json
+import os
+import runpy
+import shlex
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import options
+
+import logging
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s %(name)s %(levelname)s :: %(message)s')
+logger = logging.getLogger('sweep')
+
+here = os.path.dirname(os.path.abspath(__file__))
+scripts = {2: os.path.join(here, '2D_HC.py'), 3: os.path.join(here, '3D_HC.py')}
+
+
+def ra_label(Ra):
+    """ Compact label used in file names, e.g. 6.4e10 -> '6p4e10'. """
+    mantissa, exponent = ('%.3e' %Ra).split('e')
+    mantissa = mantissa.rstrip('0').rstrip('.').replace('.', 'p')
+    return '%se%i' %(mantissa, int(exponent))
+
+
+def load_manifest(path):
+    """ Read the manifest and return the list of fully specified cases. """
+    with open(path) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {'cases': manifest}
+    cases = []
+    for entry in manifest['cases']:
+        case = dict(manifest.get('defaults', {}))
+        case.update(entry)
+        dim = case.setdefault('dim', 2)
+        for key, value in options.defaults[dim].items():
+            case.setdefault(key, value)
+        if len(case['resolution']) != dim:
+            raise ValueError("Case %r: resolution must have %i entries"
+                             %(entry, dim))
+        case.setdefault('name', '%iD_%s_Ra%s_Pr%g' %(dim, case['bc'],
+                                                    ra_label(case['Ra']),
+                                                    case['Pr']))
+        cases.append(case)
+    names = [case['name'] for case in cases]
+    if len(set(names)) != len(names):
+        raise ValueError("Case names in the manifest are not unique")
+    return cases
+
+
+def work(case):
+    """ Rough cost of a case: grid points times number of time steps.
+        The CFL time step shrinks with the grid spacing, so the number of
+        steps grows like the largest resolution times the stop time. """
+    points = np.prod(case['resolution'], dtype=float)
+    return points * max(case['resolution']) * case['stop_sim_time']
+
+
+def power_of_two(n):
+    """ Largest power of two not exceeding n (at least 1). """
+    return 2**int(np.floor(np.log2(max(n, 1))))
+
+
+def assign_ranks(cases, cores, points_per_rank):
+    """ Give each case a power-of-two number of ranks such that each rank
+        holds roughly points_per_rank grid points, unless set explicitly. """
+    for case in cases:
+        if 'ranks' not in case:
+            points = np.prod(case['resolution'], dtype=float)
+            case['ranks'] = power_of_two(points/points_per_rank)
+        case['ranks'] = int(max(1, min(case['ranks'], power_of_two(cores))))
+
+
+def latest_checkpoint(path):
+    """ Latest complete checkpoint set of a case and its info.json. """
+    sets = glob.glob(os.path.join(path, 'checkpoints', '*_s*', 'info.json'))
+    if not sets:
+        return None, None
+    latest = max(sets, key=lambda p: int(os.path.dirname(p).rsplit('_s', 1)[1]))
+    with open(latest) as f:
+        return os.path.dirname(latest), json.load(f)
+
+
+def regridded(case, path):
+    """ The case on the grid of its last regrid (see resolution.py). """
+    try:
+        with open(os.path.join(path, 'regrid.json')) as f:
+            regrid = json.load(f)
+    except (OSError, ValueError):
+        return case
+    return dict(case, resolution=regrid['resolution'], z_layer=regrid['z_layer'])
+
+
+def grid_matches(case, info):
+    """ True if a checkpoint (its info.json) is on the grid of a case. """
+    resolution = list(case['resolution'])
+    resolution[-1] += case.get('z_layer', 0)
+    return (info['resolution'] == resolution and
+            len(info.get('z_bases') or [None]) == (2 if case.get('z_layer') else 1))
+
+
+def regrid_pending(case, path):
+    """ True if the case stopped to continue on a new grid. """
+    new = regridded(case, path)
+    latest, info = latest_checkpoint(path)
+    return new is not case and info is not None and not grid_matches(new, info)
+
+
+def case_argv(case, path, resume=True):
+    """ Solver arguments of a case, resuming from its latest checkpoint
+        if a previous sweep was interrupted (see checkpoint.py), or
+        continuing it on the grid of its last regrid. With resume=False
+        (a rerun with --force) the case starts from scratch. """
+    case = regridded(case, path)
+    argv = options.case_argv(case)
+    latest, info = latest_checkpoint(path)
+    if resume and info is not None:
+        if grid_matches(case, info):
+            argv += ['--restart', 'checkpoints']
+        else:
+            argv += ['--init', os.path.relpath(latest, path), '--init-time',
+                     '--init-noise', '0']
+    return argv
+
+
+def status_path(case, output):
+    return os.path.join(output, case['name'], 'case.json')
+
+
+def is_done(case, output):
+    """ True if the case finished successfully in a previous sweep. """
+    try:
+        with open(status_path(case, output)) as f:
+            return json.load(f).get('returncode') == 0
+    except (OSError, ValueError):
+        return False
+
+
+def write_status(case, output, **status):
+    with open(status_path(case, output), 'w') as f:
+        json.dump(dict(case, **status), f, indent=1)
+
+
+def run_pool(cases, output, cores, mpiexec, poll=5., force=False):
+    """ Launch each case as a separate mpiexec job on a pool of cores.
+        Cases are started longest-first; whenever cores free up, the first
+        pending case that fits is started, so small cases back-fill.
+        With force, the first launch of each case ignores its checkpoints. """
+    pending = sorted(cases, key=lambda c: work(c)/c['ranks'], reverse=True)
+    running = []
+    started = set()
+    free = cores
+    while pending or running:
+        for case in list(pending):
+            if case['ranks'] <= free:
+                path = os.path.join(output, case['name'])
+                os.makedirs(path, exist_ok=True)
+                command = (shlex.split(mpiexec.format(ranks=case['ranks'])) +
+                           [sys.executable, scripts[case['dim']]] +
+                           case_argv(case, path, resume=not force or
+                                     case['name'] in started))
+                started.add(case['name'])
+                log = open(os.path.join(path, 'run.log'), 'w')
+                process = subprocess.Popen(command, cwd=path, stdout=log,
+                                           stderr=subprocess.STDOUT)
+                running.append((case, process, log, time.time()))
+                pending.remove(case)
+                free -= case['ranks']
+                logger.info('Started %s on %i ranks (%i cores free)'
+                            %(case['name'], case['ranks'], free))
+        time.sleep(poll)
+        for item in list(running):
+            case, process, log, start = item
+            if process.poll() is not None:
+                log.close()
+                running.remove(item)
+                free += case['ranks']
+                path = os.path.join(output, case['name'])
+                if process.returncode == 0 and regrid_pending(case, path):
+                    logger.info('Regridding %s to %s' %(case['name'], 'x'.join(
+                        map(str, regridded(case, path)['resolution']))))
+                    pending.insert(0, case)
+                    continue
+                write_status(case, output, returncode=process.returncode,
+                             wall_time=time.time()-start)
+                logger.info('Finished %s with return code %i after %.1f sec'
+                            %(case['name'], process.returncode, time.time()-start))
+
+
+def plan_lanes(cases, size):
+    """ Split `size` ranks into lanes and queue cases on them.
+        Cases are placed longest-first, each where it would finish
+        earliest: on a new lane of its own rank count (or of the ranks that
+        are left), or at the end of the queue of an existing lane. """
+    lanes = []
+    for case in sorted(cases, key=work, reverse=True):
+        left = size - sum(lane['ranks'] for lane in lanes)
+        best = min(lanes, default=None,
+                   key=lambda l: l['load'] + work(case)/l['ranks'])
+        if left > 0:
+            ranks = power_of_two(min(case['ranks'], left))
+            if best is None or (work(case)/ranks <
+                                best['load'] + work(case)/best['ranks']):
+                best = dict(ranks=ranks, cases=[], load=0.)
+                lanes.append(best)
+        best['cases'].append(case)
+        best['load'] += work(case)/best['ranks']
+    return lanes
+
+
+def run_mpi(cases, output, force=False):
+    """ Run the cases on MPI sub-communicators of COMM_WORLD.
+        Each lane runs its queue in-process, one case after another.
+        With force, the first run of each case ignores its checkpoints. """
+    from mpi4py import MPI
+
+    world = MPI.COMM_WORLD
+    lanes = plan_lanes(cases, world.size)
+    starts = np.cumsum([0] + [lane['ranks'] for lane in lanes])
+    color = MPI.UNDEFINED
+    for i, lane in enumerate(lanes):
+        if starts[i] <= world.rank < starts[i+1]:
+            color = i
+    comm = world.Split(color, world.rank)
+    if world.rank == 0:
+        for i, lane in enumerate(lanes):
+            logger.info('Lane %i: %i ranks, cases %s' %(i, lane['ranks'],
+                        ', '.join(c['name'] for c in lane['cases'])))
+    if color == MPI.UNDEFINED:
+        logger.info('Rank %i is not used by any lane' %world.rank)
+        return
+
+    cwd = os.getcwd()
+    argv = sys.argv
+    options.comm = comm
+    try:
+        for case in lanes[color]['cases']:
+            path = os.path.join(output, case['name'])
+            if comm.rank == 0:
+                os.makedirs(path, exist_ok=True)
+            comm.Barrier()
+            start = time.time()
+            returncode = 0
+            regrid = True
+            resume = not force
+            while regrid and not returncode:
+                os.chdir(path)
+                sys.argv = [scripts[case['dim']]] + case_argv(case, path, resume)
+                resume = True
+                try:
+                    runpy.run_path(scripts[case['dim']], run_name='__main__')
+                except SystemExit as exit:
+                    # argparse errors and sys.exit() in a script end the
+                    # case, not the lane
+                    if exit.code not in (None, 0):
+                        logger.error('Case %s exited with %s' %(case['name'], exit.code))
+                        returncode = exit.code if isinstance(exit.code, int) else 1
+                except Exception:
+                    logger.exception('Case %s failed' %case['name'])
+                    returncode = 1
+                finally:
+                    os.chdir(cwd)
+                comm.Barrier()
+                regrid = regrid_pending(case, path)
+            if comm.rank == 0:
+                write_status(case, output, returncode=returncode,
+                             wall_time=time.time()-start)
+    finally:
+        sys.argv = argv
+        options.comm = None
+        comm.Free()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help="JSON manifest of cases")
+    parser.add_argument('--output', default='runs',
+                        help="directory holding one subdirectory per case")
+    parser.add_argument('--cores', type=int, default=os.cpu_count(),
+                        help="cores available to the pool (default: all)")
+    parser.add_argument('--points-per-rank', type=float, default=2**15,
+                        help="grid points per rank when a case does not set"
+                             " 'ranks' (default %(default)g)")
+    parser.add_argument('--mpiexec', default='mpiexec -n {ranks}',
+                        help="launcher command for the pool (default '%(default)s')")
+    parser.add_argument('--mpi', action='store_true',
+                        help="run inside one mpiexec launch using sub-communicators")
+    parser.add_argument('--rundb', default=None,
+                        help="run database the cases stream their time series into")
+    parser.add_argument('--regrid', action='store_true',
+                        help="check the resolution of the cases and continue"
+                             " under-resolved ones on a finer grid")
+    parser.add_argument('--force', action='store_true',
+                        help="rerun cases that already finished")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    cases = load_manifest(args.manifest)
+    if args.rundb:
+        for case in cases:
+            case['rundb'] = os.path.abspath(args.rundb)
+    if args.regrid:
+        for case in cases:
+            case['regrid'] = True
+    if not args.force:
+        cases = [case for case in cases if not is_done(case, output)]
+
+    if args.mpi:
+        from mpi4py import MPI
+        assign_ranks(cases, MPI.COMM_WORLD.size, args.points_per_rank)
+        run_mpi(cases, output, args.force)
+    else:
+        assign_ranks(cases, args.cores, args.points_per_rank)
+        os.makedirs(output, exist_ok=True)
+        run_pool(cases, output, args.cores, args.mpiexec, force=args.force)
@@ -0,0 +1,104 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    threads.py: hybrid MPI + threads execution of 2D_HC.py and 3D_HC.py.
+
+    At high rank counts the 2D solver spends most of a step in transposes,
+    whose messages shrink with the local pencils. In hybrid mode a node
+    runs fewer ranks, each with --threads threads: the FFTs are planned
+    with FFTW's threads (fftw_plan_with_nthreads of the FFTW Dedalus'
+    transforms are linked against, see autotune.fftw_library), and the
+    BLAS/OpenMP libraries get as many threads (threadpoolctl if it is
+    installed, and the usual environment variables for the libraries
+    loaded later). The pencil solves are not threaded: Dedalus solves the
+    pencils one after another with SuperLU, which is serial, so a hybrid
+    layout trades their parallelism for smaller transposes, which
+    benchmark.py hybrid measures. Without --threads the environment is
+    left alone. The ranks must be bound to as many cores each, e.g. with
+    Open MPI (6 ranks x 4 threads on 24 cores):
+
+    $ OMP_NUM_THREADS=4 mpiexec -n 6 --map-by slot:PE=4 python3 2D_HC.py --threads 4
+
+    Pure-MPI and hybrid layouts of a node are compared with
+    $ python3 benchmark.py hybrid --cores 24 --dims 2
+
+    Cesar Rocha et al.
+"""
+
+import ctypes
+import ctypes.util
+import os
+
+import autotune
+
+import logging
+logger = logging.getLogger(__name__)
+
+variables = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+             'BLIS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def environment(threads):
+    """ Environment variables giving the libraries `threads` threads. """
+    return {name: str(threads) for name in variables}
+
+
+def threads_library(fftw):
+    """ The threads interface of the FFTW instance `fftw`: fftw itself if
+        it was built with threads, else the fftw3_threads library if it
+        uses the same instance (the same address of fftw_execute), else
+        None. """
+    if hasattr(fftw, 'fftw_plan_with_nthreads'):
+        return fftw
+    name = ctypes.util.find_library('fftw3_threads')
+    if not name:
+        return None
+    try:
+        library = ctypes.CDLL(name, mode=ctypes.RTLD_GLOBAL)
+        same = autotune.address(library, 'fftw_execute') == autotune.address(fftw, 'fftw_execute')
+    except (OSError, AttributeError):
+        return None
+    if not same:
+        logger.warning('%s is linked against another FFTW than Dedalus' %name)
+        return None
+    return library
+
+
+def fftw_threads(threads):
+    """ Plan the FFTs of Dedalus from now on with `threads` threads; False
+        if its FFTW has no threads interface. """
+    fftw = autotune.fftw_library()
+    library = threads_library(fftw) if fftw is not None else None
+    if library is None or not library.fftw_init_threads():
+        return False
+    library.fftw_plan_with_nthreads(ctypes.c_int(threads))
+    if hasattr(library, 'fftw_planner_nthreads'):    # FFTW >= 3.3.9
+        return library.fftw_planner_nthreads() == threads
+    return True
+
+
+def limit(threads):
+    """ Threads of the BLAS/OpenMP libraries already loaded. """
+    try:
+        import threadpoolctl
+    except ImportError:
+        return None
+    return threadpoolctl.threadpool_limits(limits=threads)
+
+
+def configure(threads, rank=0):
+    """ Threads of this rank (None: leave the environment and libraries
+        alone); call before the domain is built, so that the FFTs are
+        planned with them. """
+    if not threads or threads < 1:
+        return
+    os.environ.update(environment(threads))
+    limits = limit(threads)
+    fftw = fftw_threads(threads) if threads > 1 else False
+    if rank == 0:
+        logger.info('%i thread%s per rank (FFTW threads: %s, BLAS limits: %s)'
+                    %(threads, 's' if threads > 1 else '', 'yes' if fftw else 'no',
+                      'threadpoolctl' if limits is not None else 'environment only'))
@@ -0,0 +1,223 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    timestep.py: predictive time-step controller.
+
+    flow_tools.CFL evaluates the velocities and reduces their maximum
+    frequency across all ranks every `cadence` iterations. PredictiveCFL
+    keeps the history of the global maxima and extrapolates it linearly in
+    time. The velocities are only evaluated and reduced when the prediction
+    may be off: after a reduction whose value the previous prediction
+    missed by more than `accuracy`, the next one comes after `cadence`
+    iterations; while predictions hold, the interval doubles up to
+    `max_interval`. Between reductions dt follows the predicted frequency,
+    whose change is inflated by the recent prediction error, and may only
+    shrink; it grows at reductions, within max_change. Velocities are
+    evaluated on demand at the start of the step, so any iteration can be
+    checkpointed, and the controller state is saved with the checkpoints
+    (see checkpoint.py).
+
+    With `tol`, dt is also limited by a temporal smoothness heuristic. It
+    is not an estimate of the local error of RK443, which has no embedded
+    pair: the third divided difference of b over the last four steps,
+    relative to max|b| and reduced in the same Allreduce as the CFL
+    frequency, measures how far b departs from a quadratic in time over
+    a step, and dt shrinks when it exceeds tol:
+
+        r = max|b[t0,t1,t2,t3]| dt^3 / max|b|,  dt <- 0.9 dt (tol/r)^(1/3)
+
+    This flags time scales that dt does not resolve but does not bound
+    the error of a step. The last steps of b are saved with the
+    checkpoints, so restarts stay bit-for-bit.
+
+    $ mpiexec -n 24 python3 2D_HC.py --dt-control predictive
+    $ mpiexec -n 24 python3 2D_HC.py --dt-control predictive --dt-tol 1e-5
+
+    Cesar Rocha et al.
+"""
+
+import collections
+import time
+
+import numpy as np
+from mpi4py import MPI
+
+from dedalus.core.evaluator import DictionaryHandler
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PredictiveCFL:
+    """ Drop-in replacement of flow_tools.CFL with predicted frequencies,
+        adaptive reductions and an optional temporal smoothness limit. """
+
+    def __init__(self, solver, initial_dt, cadence=10, safety=1., max_change=np.inf,
+                 min_change=0., max_dt=np.inf, min_dt=0., threshold=0.,
+                 max_interval=None, accuracy=0.05, history=4, tol=None,
+                 smoothness_field='b'):
+        self.solver = solver
+        self.stored_dt = initial_dt
+        self.cadence = cadence
+        self.safety = safety
+        self.max_change = max_change
+        self.min_change = min_change
+        self.max_dt = max_dt
+        self.min_dt = min_dt
+        self.threshold = threshold
+        self.max_interval = max_interval or 8*cadence
+        self.accuracy = accuracy
+        self.tol = tol
+        self.smoothness_field = smoothness_field
+        domain = solver.domain
+        self.comm = domain.dist.comm_cart
+        self.handler = DictionaryHandler(domain, solver.evaluator.vars)
+        self.spacings = []
+        self.groups = []
+        self.excluded = set()
+        self.samples = collections.deque(maxlen=history)
+        self.states = collections.deque(maxlen=4)
+        self.interval = cadence
+        self.next_reduction = solver.iteration
+        self.uncertainty = 0.
+        self.reductions = 0
+        self.steps = 0
+
+    def add_velocity(self, velocity, axis, group=0):
+        domain = self.solver.domain
+        self.handler.add_task(velocity, layout='g', name='v%i' %len(self.spacings),
+                              scales=domain.dealias)
+        self.spacings.append(domain.grid_spacing(axis, scales=domain.dealias))
+        self.groups.append(group)
+
+    def add_velocities(self, components):
+        """ Add a velocity; the frequencies of separate velocities (e.g. of
+            the cases of an ensemble) are not summed. """
+        group = max(self.groups, default=-1) + 1
+        for axis, component in enumerate(components):
+            self.add_velocity(component, axis, group)
+        return group
+
+    def exclude(self, group):
+        """ Stop limiting the step by the velocity `group` (e.g. of a case
+            of an ensemble that is done); the next step reduces anew. """
+        self.excluded.add(group)
+        self.samples.clear()
+        self.next_reduction = self.solver.iteration
+
+    def local_frequency(self):
+        """ Local maximum of sum(|v_i| / spacing_i) over the velocities
+            (no communication). """
+        solver = self.solver
+        solver.evaluator.evaluate_handlers([self.handler], world_time=time.time(),
+                                           wall_time=0., sim_time=solver.sim_time,
+                                           timestep=self.stored_dt,
+                                           iteration=solver.iteration)
+        freq = {}
+        for field, spacing, group in zip(self.handler.fields.values(), self.spacings,
+                                         self.groups):
+            if group in self.excluded:
+                continue
+            field.set_scales(self.solver.domain.dealias, keep_data=True)
+            freq[group] = freq.get(group, 0.) + np.abs(field['g']) / spacing
+        return max((np.max(f) for f in freq.values() if np.size(f)), default=0.)
+
+    def local_roughness(self):
+        """ Local max of the third divided difference in time of the
+            smoothness field and of the field itself over the last four
+            steps. """
+        if len(self.states) < 4:
+            return 0., 0.
+        t = [s[0] for s in self.states]
+        d = [s[1] for s in self.states]
+        for order in range(1, 4):
+            d = [(d[i+1] - d[i]) / (t[i+order] - t[i]) for i in range(len(d) - 1)]
+        return np.max(np.abs(d[0]), initial=0.), np.max(np.abs(self.states[-1][1]), initial=0.)
+
+    def predict(self, t):
+        """ Frequency at time t extrapolated from the reduced samples. """
+        if len(self.samples) < 2:
+            return self.samples[-1][1]
+        ts, fs = np.array(self.samples).T
+        slope, intercept = np.polyfit(ts - ts[-1], fs, 1)
+        return max(intercept + slope*(t - ts[-1]), 0.)
+
+    def limit(self, dt):
+        dt = min(dt, self.max_dt, self.max_change*self.stored_dt)
+        return max(dt, self.min_dt, self.min_change*self.stored_dt)
+
+    def compute_dt(self):
+        solver = self.solver
+        self.steps += 1
+        if self.tol:
+            field = solver.state[self.smoothness_field]
+            self.states.append((solver.sim_time, np.copy(field['c'])))
+        if solver.iteration < self.next_reduction:
+            # Predicted frequency, with its change inflated by the recent
+            # prediction error
+            last = self.samples[-1][1]
+            freq = self.predict(solver.sim_time)
+            freq += 2*self.uncertainty*abs(freq - last)
+            if freq > 0:
+                self.stored_dt = max(min(self.stored_dt, self.safety/freq), self.min_dt)
+            return self.stored_dt
+
+        # Global reduction of the frequency (and smoothness measure)
+        local = np.array([self.local_frequency()] + list(self.local_roughness()))
+        self.comm.Allreduce(MPI.IN_PLACE, local, op=MPI.MAX)
+        freq, d3, scale = local
+        self.reductions += 1
+        t = solver.sim_time
+        if self.samples:
+            miss = abs(self.predict(t) - freq) / max(freq, 1e-300)
+            self.uncertainty = miss
+            if miss <= self.accuracy:
+                self.interval = min(2*self.interval, self.max_interval)
+            else:
+                self.interval = self.cadence
+        self.samples.append((t, freq))
+        self.next_reduction = solver.iteration + self.interval
+
+        dt = self.safety/freq if freq > 0 else self.max_dt
+        if self.tol and d3 > 0 and scale > 0:
+            roughness = d3 * self.stored_dt**3 / scale
+            dt = min(dt, 0.9 * self.stored_dt * (self.tol/roughness)**(1/3))
+        dt = self.limit(dt)
+        if abs(dt - self.stored_dt) > self.threshold * self.stored_dt:
+            self.stored_dt = dt
+        return self.stored_dt
+
+    def get_state(self):
+        """ Controller state, saved with the checkpoints (the history of
+            the smoothness field goes in arrays()). """
+        return dict(stored_dt=self.stored_dt, samples=list(self.samples),
+                    interval=self.interval, next_reduction=self.next_reduction,
+                    uncertainty=self.uncertainty,
+                    state_times=[t for t, c in self.states])
+
+    def arrays(self):
+        """ Local coefficients of the last steps of the smoothness field. """
+        return {'%s_%i' %(self.smoothness_field, i): c
+                for i, (t, c) in enumerate(self.states)}
+
+    def set_state(self, state, arrays=None):
+        self.stored_dt = state['stored_dt']
+        self.samples.clear()
+        self.samples.extend(tuple(s) for s in state['samples'])
+        self.interval = state['interval']
+        self.next_reduction = state['next_reduction']
+        self.uncertainty = state['uncertainty']
+        self.states.clear()
+        for i, t in enumerate(state.get('state_times', [])):
+            key = '%s_%i' %(self.smoothness_field, i)
+            if arrays and key in arrays:
+                self.states.append((t, arrays[key]))
+
+    def report(self):
+        """ Log how many reductions the run needed (rank 0). """
+        if self.comm.rank == 0 and self.steps:
+            logger.info('Time-step controller: %i global reductions in %i steps'
+                        %(self.reductions, self.steps))
@@ -0,0 +1,200 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    timing.py: per-step instrumentation and cpu-hour accounting.
+
+    With --timing, the hot paths of Dedalus are wrapped with timers that
+    split each step into
+
+        linear_solve   pencil LU solves (dedalus.libraries.matsolvers)
+        transform      spectral transforms (Transform.increment/decrement)
+        transpose      MPI transposes between layouts (Transpose.*)
+        evaluate       remaining evaluation of the nonlinear terms and tasks
+        file_io        Dedalus file handlers
+        diagnostics    shared diagnostics (diagnostics.py)
+        cfl            CFL time step (flow_tools.CFL or timestep.py)
+        checkpoint     checkpoints (checkpoint.py)
+        timestepper    remaining time in solver.step (RHS assembly, ...)
+
+    Times are exclusive (a transform inside an evaluation counts as
+    transform only) and accumulated per rank. Every `every` iterations
+    rank 0 appends one JSON line with the mean and maximum over ranks of
+    each category to timing.jsonl; at the end of the run it logs a report
+    with the time per step, load imbalance and cpu-hours of each category
+    and writes timing.json with the totals of every rank.
+
+    $ mpiexec -n 24 python3 2D_HC.py --timing
+
+    Cesar Rocha et al.
+"""
+
+import functools
+import importlib
+import json
+import time
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+categories = ['linear_solve', 'transform', 'transpose', 'evaluate', 'file_io',
+              'diagnostics', 'cfl', 'checkpoint', 'timestepper']
+
+# (module, class, method, category) of the wrapped hot paths
+targets = [('dedalus.core.solvers', 'InitialValueSolver', 'step', 'timestepper'),
+           ('dedalus.core.evaluator', 'Evaluator', 'evaluate_scheduled', 'evaluate'),
+           ('dedalus.core.evaluator', 'Evaluator', 'evaluate_group', 'evaluate'),
+           ('dedalus.core.evaluator', 'FileHandler', 'process', 'file_io'),
+           ('output', 'AsyncFileHandler', 'process', 'file_io'),
+           ('dedalus.core.distributor', 'Transform', 'increment', 'transform'),
+           ('dedalus.core.distributor', 'Transform', 'decrement', 'transform'),
+           ('dedalus.core.distributor', 'Transpose', 'increment', 'transpose'),
+           ('dedalus.core.distributor', 'Transpose', 'decrement', 'transpose'),
+           ('dedalus.extras.flow_tools', 'CFL', 'compute_dt', 'cfl'),
+           ('timestep', 'PredictiveCFL', 'compute_dt', 'cfl'),
+           ('diagnostics', 'Diagnostics', 'process', 'diagnostics'),
+           ('checkpoint', 'Checkpoint', 'write', 'checkpoint')]
+
+# Timers collecting the wrapped calls (methods are wrapped only once per
+# process, so that sweep.py can run several cases in one process)
+active = None
+wrapped = set()
+
+
+def timed(function, category):
+    @functools.wraps(function)
+    def wrapper(*args, **kw):
+        if active is None:
+            return function(*args, **kw)
+        active.start(category)
+        try:
+            return function(*args, **kw)
+        finally:
+            active.stop(category)
+    return wrapper
+
+
+def wrap(owner, name, category):
+    key = (owner, name)
+    if key not in wrapped and hasattr(owner, name):
+        setattr(owner, name, timed(getattr(owner, name), category))
+        wrapped.add(key)
+
+
+def wrap_targets():
+    for module, cls, method, category in targets:
+        try:
+            owner = getattr(importlib.import_module(module), cls)
+        except (ImportError, AttributeError):
+            logger.debug('Cannot time %s.%s.%s' %(module, cls, method))
+            continue
+        wrap(owner, method, category)
+    try:
+        from dedalus.libraries import matsolvers
+        for solver in matsolvers.matsolvers.values():
+            wrap(solver, 'solve', 'linear_solve')
+    except (ImportError, AttributeError):
+        logger.debug('Cannot time the linear solves')
+
+
+class StepTimers:
+    """ Exclusive timers of the categories above for one solver.
+        Disabled timers cost nothing and report nothing. """
+
+    def __init__(self, solver, enabled=True, path='timing.jsonl', every=100):
+        global active
+        self.enabled = enabled
+        if not enabled:
+            return
+        self.solver = solver
+        self.comm = solver.domain.dist.comm_cart
+        self.path = path
+        self.every = every
+        self.index = {c: i for i, c in enumerate(categories)}
+        self.totals = np.zeros(len(categories))
+        self.calls = np.zeros(len(categories), dtype=int)
+        self.last_totals = self.totals.copy()
+        self.last_iteration = solver.iteration
+        self.stack = []
+        wrap_targets()
+        active = self
+        self.start_time = time.time()
+        self.start_iteration = solver.iteration
+        if self.comm.rank == 0 and path:
+            open(path, 'w').close()
+
+    def start(self, category):
+        self.stack.append([category, time.perf_counter(), 0.])
+
+    def stop(self, category):
+        category, start, children = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        i = self.index[category]
+        self.totals[i] += elapsed - children
+        self.calls[i] += 1
+        if self.stack:
+            self.stack[-1][2] += elapsed
+        elif category == 'timestepper':
+            self.step_done()
+
+    def step_done(self):
+        """ Append a record to the log every `every` iterations. """
+        iteration = self.solver.iteration
+        if iteration % self.every:
+            return
+        steps = max(iteration - self.last_iteration, 1)
+        per_step = (self.totals - self.last_totals) / steps
+        mean = np.zeros_like(per_step)
+        peak = np.zeros_like(per_step)
+        from mpi4py import MPI
+        self.comm.Reduce(per_step, mean, op=MPI.SUM, root=0)
+        self.comm.Reduce(per_step, peak, op=MPI.MAX, root=0)
+        self.last_totals = self.totals.copy()
+        self.last_iteration = iteration
+        if self.comm.rank == 0 and self.path:
+            record = dict(iteration=int(iteration), sim_time=float(self.solver.sim_time),
+                          wall_time=time.time() - self.start_time,
+                          mean={c: float(v) for c, v in zip(categories, mean/self.comm.size)},
+                          max={c: float(v) for c, v in zip(categories, peak)})
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def report(self, path='timing.json'):
+        """ Log the per-category breakdown and cpu-hours, and write the
+            totals of every rank. Must be called on every rank. """
+        global active
+        if not self.enabled:
+            return
+        if active is self:
+            active = None
+        wall = time.time() - self.start_time
+        steps = max(self.solver.iteration - self.start_iteration, 1)
+        totals = self.comm.gather(self.totals, root=0)
+        calls = self.comm.gather(self.calls, root=0)
+        if self.comm.rank != 0:
+            return
+        totals = np.array(totals)
+        size = self.comm.size
+        logger.info('Timing over %i steps on %i ranks (%.2f sec, %.4f cpu-hr):'
+                    %(steps, size, wall, wall*size/3600))
+        logger.info('%-13s %12s %8s %10s %10s' %('category', 'ms/step', '% wall',
+                                               'imbalance', 'cpu-hr'))
+        rows = list(zip(categories, totals.T)) + [('untimed', wall - totals.sum(axis=1))]
+        for category, t in rows:
+            logger.info('%-13s %12.3f %8.1f %10.2f %10.4f'
+                        %(category, 1e3*t.mean()/steps, 100*t.mean()/wall,
+                          t.max()/t.mean() if t.mean() > 0 else 1., t.sum()/3600))
+        sim_time = self.solver.sim_time - getattr(self.solver, 'initial_sim_time', 0.)
+        if sim_time > 0:
+            logger.info('cpu-hr per unit simulation time: %.4g' %(wall*size/3600/sim_time))
+        if path:
+            with open(path, 'w') as f:
+                json.dump(dict(ranks=size, steps=steps, wall_time=wall,
+                               cpu_hours=wall*size/3600, sim_time=sim_time,
+                               categories=categories,
+                               totals=totals.tolist(),
+                               calls=np.array(calls).tolist()), f)
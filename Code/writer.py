@@ -0,0 +1,254 @@
+"""
+    Script for 'The heat flux of horizontal convection:
+    definition of the Nusselt number,'
+    by C.B. Rocha, T. Bossy, N.C. Constantinou, S.G. Llewellyn Smith
+    & W.R. Young, submitted to JFM.
+
+    writer.py: background writer of the output files (see output.py).
+
+    Writer queues writes (appends to h5 files) and performs them in a
+    background thread, or in a writer process (this module run as a
+    script, reading the pickled writes on its standard input and
+    acknowledging each on its standard output), so that the HDF5 library
+    never holds the interpreter of the solver. The queue is bounded in
+    bytes: a write that does not fit waits for the writer (backpressure),
+    and the time spent waiting is accounted for. The data of a write count
+    until it is written. A failed write (e.g. a full disk) stops the
+    writer, and the next submit() or close() raises its error.
+
+    This module imports neither Dedalus nor MPI, so that the writer
+    process starts quickly and stays out of the MPI job.
+
+    Cesar Rocha et al.
+"""
+
+import collections
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+import h5py
+import numpy as np
+
+import encoding
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def append(path, meta, grids, tasks, labels=(), encoded=None, attrs=None):
+    """ Append one write to a per-process file of a Dedalus file handler.
+
+        meta: {'sim_time': ..., 'iteration': ..., ...} of the write
+        grids: {basis: {scale: global grid}}
+        tasks: {name: (global_shape, start, count, data or None, dtype)}
+        encoded: (encoding, tol, compression) of the tasks (see encoding.py)
+        attrs: file attributes (e.g. the bases of coefficient data) """
+    name, tol, compression = encoded or ('float64', None, None)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with h5py.File(path, 'a') as file:
+        if 'scales' not in file:
+            scales = file.create_group('scales')
+            for key, value in meta.items():
+                scales.create_dataset(key, shape=(0,), maxshape=(None,),
+                                      dtype=np.asarray(value).dtype)
+            for basis, grid in grids.items():
+                group = scales.create_group(basis)
+                for scale, values in grid.items():
+                    group.create_dataset(scale, data=values)
+            file.create_group('tasks')
+        n = file['scales/sim_time'].shape[0]
+        for key, value in meta.items():
+            dset = file['scales'][key]
+            dset.resize((n+1,))
+            dset[n] = value
+        for task, (gshape, start, count, data, dtype) in tasks.items():
+            if task not in file['tasks']:
+                dset = file['tasks'].create_dataset(task, shape=(0,) + tuple(count),
+                                                    maxshape=(None,) + tuple(count),
+                                                    **encoding.creation(name, compression,
+                                                                        count, dtype))
+                for key, value in encoding.attributes(name, tol).items():
+                    dset.attrs[key] = value
+                dset.attrs['global_shape'] = gshape
+                dset.attrs['start'] = start
+                dset.attrs['count'] = count
+                for axis, label in enumerate(('t',) + tuple(labels)):
+                    dset.dims[axis].label = label
+            dset = file['tasks'][task]
+            dset.resize(n+1, axis=0)
+            if data is not None:
+                dset[n] = encoding.encode(data, name, tol)
+        for key, value in (attrs or {}).items():
+            file.attrs[key] = value
+        file.attrs['writes'] = n + 1
+
+
+def append_rows(path, names, dim, rows):
+    """ Append buffered rows (sim_time, wall_time, iteration, timestep,
+        values) of volume averages to a merged diagnostics file. """
+    sim_time, wall_time, iteration, timestep, values = zip(*rows)
+    values = np.array(values)
+    with h5py.File(path, 'a') as file:
+        if 'tasks' not in file:
+            scales = file.create_group('scales')
+            for name in ['sim_time', 'wall_time', 'iteration', 'timestep', 'write_number']:
+                scales.create_dataset(name, shape=(0,), maxshape=(None,),
+                                      dtype=int if name in ('iteration', 'write_number') else float)
+            tasks = file.create_group('tasks')
+            for name in names:
+                tasks.create_dataset(name, shape=(0,) + (1,)*dim,
+                                     maxshape=(None,) + (1,)*dim, dtype=float)
+        n = file['scales/sim_time'].shape[0]
+        m = n + len(rows)
+        columns = dict(sim_time=sim_time, wall_time=wall_time, iteration=iteration,
+                       timestep=timestep, write_number=np.arange(n, m) + 1)
+        for name, column in columns.items():
+            dset = file['scales'][name]
+            dset.resize((m,))
+            dset[n:] = column
+        for i, name in enumerate(names):
+            dset = file['tasks'][name]
+            dset.resize((m,) + (1,)*dim)
+            dset[n:] = values[:, i].reshape((-1,) + (1,)*dim)
+        file.attrs['writes'] = m
+
+
+functions = {'append': append, 'append_rows': append_rows}
+
+
+def perform(job):
+    name, args = job
+    functions[name](*args)
+
+
+class Writer:
+    """ Bounded queue of writes performed in the background.
+
+        max_bytes: largest size of the queued data; submit() waits for
+                   the writer beyond it
+        mode: write in a writer 'process', in a 'thread' of this one, or
+              synchronously in submit() ('off') """
+
+    def __init__(self, max_bytes=2**28, mode='process'):
+        self.max_bytes = max_bytes
+        self.jobs = collections.deque()
+        self.queued = 0
+        self.condition = threading.Condition()
+        self.error = None
+        self.closed = False
+        self.stats = dict(writes=0, bytes=0, stalls=0, stall_time=0., max_queued=0)
+        self.process = None
+        if mode == 'off':
+            self.closed = True
+            return
+        if mode == 'process':
+            self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__)],
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.thread = threading.Thread(target=self._run, name='writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, name, *args, nbytes=0):
+        """ Queue the write functions[name](*args) of nbytes of data. """
+        job = (name, args)
+        if self.closed:
+            perform(job)
+            return
+        with self.condition:
+            if self.queued and self.queued + nbytes > self.max_bytes:
+                start = time.time()
+                while self.queued and self.queued + nbytes > self.max_bytes and not self.error:
+                    self.condition.wait()
+                self.stats['stalls'] += 1
+                self.stats['stall_time'] += time.time() - start
+            if self.error:
+                raise RuntimeError("Output writer failed") from self.error
+            self.jobs.append((job, nbytes))
+            self.queued += nbytes
+            self.stats['max_queued'] = max(self.stats['max_queued'], self.queued)
+            self.condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                job, nbytes = self.jobs[0]
+            if job is None:
+                return
+            try:
+                if self.process:
+                    self._send(job)
+                else:
+                    perform(job)
+            except Exception as error:
+                logger.error('Output writer failed: %r' %error)
+                with self.condition:
+                    self.error = error
+                    self.condition.notify_all()
+                return
+            with self.condition:
+                self.jobs.popleft()
+                self.queued -= nbytes
+                self.stats['writes'] += 1
+                self.stats['bytes'] += nbytes
+                self.condition.notify_all()
+
+    def _send(self, job):
+        """ Perform a write in the writer process and wait for it. """
+        pickle.dump(job, self.process.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+        self.process.stdin.flush()
+        try:
+            failure = pickle.load(self.process.stdout)
+        except EOFError:
+            raise RuntimeError("Writer process exited with code %s"
+                               %self.process.wait()) from None
+        if failure is not None:
+            raise RuntimeError("Write failed in the writer process:\n%s" %failure)
+
+    def close(self):
+        """ Wait for the queued writes; later writes are synchronous. """
+        if self.closed:
+            return
+        with self.condition:
+            self.jobs.append((None, 0))
+            self.condition.notify_all()
+        self.thread.join()
+        if self.process:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            if self.process.wait() and not self.error:
+                self.error = RuntimeError("Writer process exited with code %i"
+                                          %self.process.returncode)
+                logger.error('Output writer failed: %r' %self.error)
+        self.closed = True
+        if self.error:
+            raise RuntimeError("Output writer failed") from self.error
+
+
+if __name__ == '__main__':
+    # Writer process: perform the pickled writes read from stdin and
+    # acknowledge each on stdout (None, or the traceback of a failure,
+    # which ends the process)
+    stdin = sys.stdin.buffer
+    acks = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    sys.stdout = sys.stderr
+    while True:
+        try:
+            job = pickle.load(stdin)
+        except EOFError:
+            break
+        try:
+            perform(job)
+        except Exception:
+            pickle.dump(traceback.format_exc(), acks)
+            acks.flush()
+            sys.exit(1)
+        pickle.dump(None, acks)
+        acks.flush()